@@ -8,6 +8,38 @@ import time
 import subprocess
 import argparse
 
+from lot_tracking import (CompletionListener, LotCompletionTracker,
+                          LotFailureMonitor, add_failure_arguments)
+from lot_speculation import (LotSpeculator, add_speculation_arguments,
+                             check_speculation_arguments)
+from lot_packing import (add_packing_arguments, get_pack_size,
+                         get_pack_request, pack_work_items, get_pack_name,
+                         get_array_task_ids)
+from lot_workers import (LotWorkerPool, add_worker_arguments,
+                         write_worker_scripts)
+from lot_scheduler import (LotGroup, LotScheduler, write_lot_table,
+                           write_failed_lots)
+from executors import (add_executor_arguments, create_executor,
+                       write_command_script, get_follow_up_command)
+from state_store import JobStateStore, write_status
+from resource_sizing import (add_resource_arguments, create_resource_sizer,
+                             get_script_request, get_max_request,
+                             parse_elapsed)
+from scratch_ledger import (add_scratch_arguments, estimate_lot_scratch,
+                            get_scratch_env, get_scratch_options,
+                            write_scratch_ledger_script)
+from lot_planning import add_planning_arguments, plan_num_of_lots
+from reference_cache import (add_reference_cache_arguments,
+                             get_reference_cache_env,
+                             write_reference_cache_script)
+from fastq_compression import (add_compression_arguments,
+                               get_compression_env,
+                               write_fastq_writer_script)
+from output_staging import (add_staging_arguments, get_staging_env,
+                            write_stage_script)
+from seq_results_parquet import add_parquet_arguments, get_parquet_env
+from lot_manifest import add_manifest_arguments, discard_unverified_lots
+
 ## This part is currently run sequentially
 
 merging_shell_script="""#!/bin/bash
@@ -22,10 +54,17 @@ lots_list=${LOTS_LIST}
 
 lots_list=($(echo $lots_list))
 
+mkdir -p ${INPUT_DIR}/${TYPE}/purity_${PURITY}/usage
+USAGE_FILE=${INPUT_DIR}/${TYPE}/purity_${PURITY}/usage/merge.${TYPE}.${PURITY}.time
+rm -f ${USAGE_FILE}
+
+# every tier merges its lots with the merged lots of the previous tier
+previous_lots=0
 for i in ${lots_list[@]}
 do
-  echo "singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} Rscript ${DIR}/ProCESS_merge_rds.R ${i} ${SPN} ${INPUT_DIR} ${PURITY} ${TYPE} ${MAX_COVERAGE} ${TOT_LOTS}"
-  singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} Rscript ${DIR}/ProCESS_merge_rds.R ${i} ${SPN} ${INPUT_DIR} ${PURITY} ${TYPE} ${MAX_COVERAGE} ${TOT_LOTS}
+  echo "singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} Rscript ${DIR}/ProCESS_merge_rds.R ${i} ${SPN} ${INPUT_DIR} ${PURITY} ${TYPE} ${MAX_COVERAGE} ${TOT_LOTS} ${previous_lots}"
+  /usr/bin/time -v -a -o ${USAGE_FILE} singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} Rscript ${DIR}/ProCESS_merge_rds.R ${i} ${SPN} ${INPUT_DIR} ${PURITY} ${TYPE} ${MAX_COVERAGE} ${TOT_LOTS} ${previous_lots}
+  previous_lots=${i}
 done
 """
 
@@ -33,13 +72,15 @@ merging_R_script=merging_R_script="""rm(list = ls())
 library(dplyr)
 args <- commandArgs(trailingOnly = TRUE)
 
-if (length(args) != 7) {
+if (length(args) != 8) {
   stop(paste("Syntax error: ProCESS_merge_rds.R",
-             "<num_of_lots> <SPN> <input_dir> <purity> <type> <max_coverage> <tot_num_of_lots>"),
+             "<num_of_lots> <SPN> <input_dir> <purity> <type> <max_coverage> <tot_num_of_lots>",
+             "<previous_num_of_lots>"),
        call. = FALSE)
 }
 
 lot_end <- as.double(args[1])
+previous_lot <- as.double(args[8])
 spn <- args[2]
 input_dir <- args[3]
 purity <- args[4]
@@ -48,6 +89,23 @@ p_info <- ps::ps_handle()
 start_time <- Sys.time()
 initial_cpu <- ps::ps_cpu_times(p_info)
 initial_mem <- ps::ps_memory_info(p_info)["rss"] / 1024^3
+
+seq_results_parquet <- Sys.getenv("SEQ_RESULTS_PARQUET") != ""
+
+save_merged_results <- function(result, rds_file) {
+  saveRDS(result, file = rds_file)
+  if (seq_results_parquet) {
+    parquet_dir <- paste0(tools::file_path_sans_ext(rds_file), ".parquet")
+    tmp_dir <- paste0(parquet_dir, ".tmp_", Sys.getpid())
+    arrow::write_dataset(dplyr::ungroup(result), tmp_dir,
+                         format = "parquet", partitioning = "chr")
+    unlink(parquet_dir, recursive = TRUE)
+    if (!file.rename(tmp_dir, parquet_dir)) {
+      stop(paste("Failed to rename", tmp_dir, "into", parquet_dir))
+    }
+  }
+}
+
 if (type=="tumour"){
   muts_dir <- paste0(input_dir,"/tumour/purity_",purity,"/data/mutations/")
   max_coverage <- as.double(args[6]) #200 ## this is hard-coded now
@@ -55,18 +113,20 @@ if (type=="tumour"){
   coverage<-(max_coverage*lot_end)/num_of_lots
   data <- list()
  
-  if (lot_end<=10){
+  if (previous_lot==0){
     rds_files <- list.files(path = muts_dir, pattern = paste0("seq_results_muts_",spn,"_"),full.names = T)[1:lot_end]
     data <- lapply(rds_files,function(x){
       readRDS(x)  %>%
         dplyr::select(-ends_with(".VAF"))
     })
   } else{
-    lot_start<-lot_end-10+1
-    previous_lot <- lot_end-10
+    lot_start<-previous_lot+1
     previous_coverage <- (max_coverage*previous_lot)/num_of_lots
     print(previous_coverage)
-    previous_lots <- list.files(path = muts_dir, pattern = paste0("seq_results_muts_merged_coverage_",previous_coverage),full.names = T)
+    previous_lots <- list.files(path = muts_dir, pattern = paste0("seq_results_muts_merged_coverage_",previous_coverage,"x\\\\.rds$"),full.names = T)
+    if (length(previous_lots) != 1) {
+      stop(paste0("Missing the merged rds of coverage ", previous_coverage, "x"))
+    }
     rds_files <- list.files(path = muts_dir, pattern = paste0("seq_results_muts_",spn,"_"),full.names = T)[lot_start:lot_end]
     
     rds_files_all <- c(rds_files,previous_lots)
@@ -102,7 +162,7 @@ if (type=="tumour"){
     print(s)
   }
   print("Saving merged rds...")
-  saveRDS(result, file = paste0(muts_dir,"seq_results_muts_merged_coverage_",coverage,"x", ".rds"))
+  save_merged_results(result, paste0(muts_dir,"seq_results_muts_merged_coverage_",coverage,"x", ".rds"))
   print("Done merging!")
 } else if (type=="normal"){
   max_coverage <- as.double(args[6])
@@ -131,7 +191,7 @@ if (type=="tumour"){
   col_name_VAF <- paste0(s,".VAF")
   result <- result %>% 
     mutate(!!col_name_VAF := .data[[col_name_NV]] / .data[[col_name_DP]])
-  saveRDS(result, file = paste0(muts_dir,"seq_results_muts_merged_coverage_",max_coverage,"x", ".rds"))
+  save_merged_results(result, paste0(muts_dir,"seq_results_muts_merged_coverage_",max_coverage,"x", ".rds"))
 }
 
 end_time <- Sys.time()
@@ -208,11 +268,88 @@ shell_script="""#!/bin/bash
 #SBATCH --cpus-per-task=5
 #SBATCH --time=24:00:00
 #SBATCH --mem={MEMORY}GB
+#SBATCH --requeue
 
 module load singularity
-singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} Rscript ${DIR}/ProCESS_seq.R ${PHYLO_FOREST} ${SPN} ${LOT} ${NODE_SCRATCH} ${DEST} ${COVERAGE} ${TYPE} 4 ${SEED} ${PURITY}
 
-rm -rf ${NODE_SCRATCH}/${SPN}_${LOT}
+if [ -n "${SLURM_ARRAY_TASK_ID}" ]; then
+    read DEST COVERAGE TYPE PURITY LOT SEED LOT_SCRATCH <<< $(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" ${LOT_TABLE})
+    PACK=${LOT%%:*}
+    if [ "${LOT}" != "${PACK}" ]; then
+        PACK=${PACK}-${LOT##*:}
+    fi
+    exec > ${DEST}/log/lot_${PACK}.log 2>&1
+fi
+
+LOT_SCRATCH_DIR=${NODE_SCRATCH}
+if [ -n "${SPECULATIVE}" ]; then
+    LOT_SCRATCH_DIR=${NODE_SCRATCH}/copy_$$
+    mkdir -p ${LOT_SCRATCH_DIR}
+fi
+
+if [ -n "${REFERENCE_CACHE_MIN_FREE}" ]; then
+    export REFERENCE_CACHE_DIR=${NODE_SCRATCH}/ProCESS_reference_cache
+    export REFERENCE_CACHE_SCRIPT=${DIR}/ProCESS_reference_cache.sh
+fi
+export FASTQ_WRITER_SCRIPT=${DIR}/ProCESS_fastq_writer.sh
+export STAGE_SCRIPT=${DIR}/ProCESS_stage.sh
+
+notify() {
+    if [ -n "${NOTIFY_ADDR}" ]; then
+        NOTIFIED_LOT=$1
+        shift
+        echo "dest=${DEST} lot=${NOTIFIED_LOT} node=$(hostname) $*" | timeout 10 bash -c "cat > /dev/tcp/${NOTIFY_ADDR%:*}/${NOTIFY_ADDR##*:}" 2>/dev/null
+    fi
+}
+
+# a lot not fitting in the node scratch leaves its allocation at once: its
+# job is requeued if possible, otherwise the lot exits with the status that
+# the builder resubmits without counting a failure
+defer_lot() {
+    echo "Deferring ${SPN}_${LOT}: not enough node scratch on $(hostname)"
+    if [ -n "${SLURM_JOB_ID}" ] && command -v scontrol > /dev/null \\
+            && scontrol requeue ${SLURM_JOB_ID}; then
+        exit 0
+    fi
+    for L in ${LOT//:/ }; do
+        notify ${L} event=end status=75
+    done
+    exit 75
+}
+
+if [ -n "${SCRATCH_PER_NODE}" ]; then
+    if ! bash ${DIR}/ProCESS_scratch_ledger.sh reserve ${NODE_SCRATCH} ${SCRATCH_PER_NODE} $$ ${LOT_SCRATCH} ${SPN}_${LOT}; then
+        defer_lot
+    fi
+    trap "bash ${DIR}/ProCESS_scratch_ledger.sh release ${NODE_SCRATCH} $$ ${SPN}_${LOT}" EXIT
+fi
+
+LOT_START=$(date +%s)
+for L in ${LOT//:/ }; do
+    notify ${L} event=start start=${LOT_START}
+done
+
+mkdir -p ${DEST}/usage
+USAGE_FILE=${DEST}/usage/lot.${TYPE}.${LOT}.time
+
+/usr/bin/time -v -o ${USAGE_FILE} singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} Rscript ${DIR}/ProCESS_seq.R ${PHYLO_FOREST} ${SPN} ${LOT} ${LOT_SCRATCH_DIR} ${DEST} ${COVERAGE} ${TYPE} 4 ${SEED} ${PURITY}
+LOT_STATUS=$?
+
+for L in ${LOT//:/ }; do
+    rm -rf ${LOT_SCRATCH_DIR}/${SPN}_${L}
+done
+rm -rf ${LOT_SCRATCH_DIR}/${SPN}_${LOT%%:*}_reference
+if [ -n "${SPECULATIVE}" ]; then
+    rmdir ${LOT_SCRATCH_DIR}
+fi
+
+LOT_END=$(date +%s)
+for L in ${LOT//:/ }; do
+    LOT_SIZE=$(du -cb ${DEST}/*/${L}_* 2>/dev/null | tail -n 1 | cut -f 1)
+    notify ${L} event=end status=${LOT_STATUS} start=${LOT_START} end=${LOT_END} size=${LOT_SIZE:-0}
+done
+
+exit ${LOT_STATUS}
 """
 
 R_script="""rm(list = ls())
@@ -220,28 +357,38 @@ library(ProCESS)
 library(dplyr)
 library(bench)
 
-args <- commandArgs(trailingOnly = TRUE)
+if (exists("worker_args")) {
+  # sourced by ProCESS_worker.R
+  args <- worker_args
+} else {
+  args <- commandArgs(trailingOnly = TRUE)
+}
 
 if (length(args) != 10) {
   stop(paste("Syntax error: ProCESS_seq.R",
-	         "<phylo_forest> <SPN> <lot_name>",
+	         "<phylo_forest> <SPN> <lot_names>",
 	         "<node_local_dir> <output_dir>",
 	         "<coverage> <type> <num_of_cores>",
-	         "<seed> <purity>"),
+	         "<seeds> <purity>"),
        call. = FALSE)
 }
 
 phylo_forest_filename <- args[1]
 spn_name <- args[2]
-lot_name <- args[3]
+lot_names <- strsplit(args[3], ":")[[1]]
 node_local_dir <- args[4]
 output_dir <- args[5]
 coverage <- as.double(args[6])
 type <- args[7]
 num_of_cores <- strtoi(args[8])
-seed <- strtoi(args[9])
+seeds <- strtoi(strsplit(args[9], ":")[[1]])
 purity <- as.double(args[10])
 
+if (length(lot_names) != length(seeds)) {
+  stop("<lot_names> and <seeds> must have the same number of elements.",
+       call. = FALSE)
+}
+
 if (type == "tumour") {
     seq_tumour <- TRUE
 } else if (type == "normal") {
@@ -258,35 +405,343 @@ if (type == "tumour") {
 }
 
 merge_sams <- function(output_local_dir, BAM_file,
-                       sam_filename_prefix, chromosomes, num_of_cores, resources_dir) {
-    
-    SAM_files <- ""
-    for (i in 1:length(chromosomes)) {
-        chr_SAM_file <- file.path(output_local_dir,
-                                  paste0(sam_filename_prefix,
-                                         chromosomes[i], ".sam"))
-
-        SAM_files <- paste(SAM_files, chr_SAM_file)
-    }
+                       sam_filename_prefixes, chromosomes, num_of_threads, resources_dir) {
     
-    name <- paste0(resources_dir, "/out_samtools_merge_", purity, "_", sam_filename_prefix, chromosomes[i])
-    cmd <- paste("/usr/bin/time -o", name, "-p -v samtools merge -fc -@", num_of_cores,
-		 "-o", BAM_file, SAM_files)
+    chr_files <- file.path(output_local_dir,
+                           paste0(sam_filename_prefixes, chromosomes,
+                                  chr_file_extension))
+
+    start <- Sys.time()
+    merge <- get_chr_merge_command(chr_files, chromosomes, BAM_file,
+                                   num_of_threads)
+    name <- paste0(resources_dir, "/out_samtools_", merge$method, "_", purity, "_", sam_filename_prefixes[1], chromosomes[length(chromosomes)])
+    cmd <- paste("/usr/bin/time -o", name, "-p -v sh -c", shQuote(merge$cmd))
     print(cmd)
     invisible(system(cmd, intern = TRUE))
+    unlink(merge$header_file)
+
+    cat(sprintf("(samtools %s: %.1f seconds)...", merge$method,
+                as.double(difftime(Sys.time(), start, units = "secs"))))
 }
 
-delete_sams <- function(output_local_dir, sam_filename_prefix, chromosomes) {
+delete_sams <- function(output_local_dir, sam_filename_prefixes, chromosomes) {
     for (i in 1:length(chromosomes)) {
         chr_SAM_file <- file.path(output_local_dir,
-                                  paste0(sam_filename_prefix,
-                                         chromosomes[i], ".sam"))
+                                  paste0(sam_filename_prefixes[i],
+                                         chromosomes[i], chr_file_extension))
 
         unlink(chr_SAM_file)
     }
 }
 
-simulate_seq_resources <- function(c,tumour,ref_path,coverage,purity){
+# the chromosomes are simulated longest first and, if SHARD_CHROMOSOMES is
+# set, the longest ones are split in shards, each simulating a fraction of
+# the lot coverage, so that the cores do not idle while the last
+# chromosomes are simulated; the shards write their own SAM files and use
+# their own read names
+get_seq_tasks <- function(phylo_forest, coverage, num_of_cores,
+                          filename_prefix, template_name_prefix) {
+    chr_positions <- phylo_forest$get_absolute_chromosome_positions()
+    lengths <- chr_positions$to - chr_positions$from + 1
+    num_of_shards <- rep(1, length(lengths))
+    if (Sys.getenv("SHARD_CHROMOSOMES") != "") {
+        shard_length <- sum(lengths)/(2*num_of_cores)
+        num_of_shards <- pmax(1, ceiling(lengths/shard_length))
+    }
+
+    tasks <- data.frame(chr = rep(chr_positions$chr, num_of_shards),
+                        length = rep(lengths/num_of_shards, num_of_shards),
+                        coverage = rep(coverage/num_of_shards, num_of_shards),
+                        shard = sequence(num_of_shards))
+    tasks$sam_prefix <- ifelse(tasks$shard == 1,
+                               paste0(filename_prefix, "_chr_"),
+                               paste0(filename_prefix, "_shard", tasks$shard,
+                                      "_chr_"))
+    tasks$template_prefix <- ifelse(tasks$shard == 1,
+                                    paste0(template_name_prefix, "r"),
+                                    paste0(template_name_prefix, "s",
+                                           tasks$shard, "r"))
+
+    tasks[order(tasks$length, decreasing = TRUE), ]
+}
+
+# sums up the read counts of the mutations simulated by several shards
+sum_shard_mutations <- function(mutations) {
+    VAF_columns <- grep("\\\\.VAF$", colnames(mutations), value = TRUE)
+    mutations <- mutations %>%
+      dplyr::select(-ends_with(".VAF")) %>%
+      group_by(chr, chr_pos, ref, alt, classes, causes) %>%
+      summarize(across(everything(), sum), .groups = "drop")
+    for (VAF_column in VAF_columns) {
+        sample_name <- sub("\\\\.VAF$", "", VAF_column)
+        mutations[[VAF_column]] <- (mutations[[paste0(sample_name, ".occurrences")]]
+                                    / mutations[[paste0(sample_name, ".coverage")]])
+    }
+    mutations
+}
+
+# the thread budget of the lot is the number of CPUs allocated by Slurm
+# to the job, when known, or the number of cores
+thread_budget <- strtoi(Sys.getenv("SLURM_CPUS_PER_TASK"))
+if (is.na(thread_budget) || thread_budget < 1) {
+    thread_budget <- num_of_cores
+}
+
+# splits a thread budget among concurrent samtools processes: each of them
+# runs its main thread and the returned number of "-@" threads
+get_samtools_threads <- function(num_of_threads, num_of_processes = 1) {
+    max(0, num_of_threads %/% num_of_processes - 1)
+}
+
+# joins the headers of the chromosome files of a lot, which must agree on
+# the reference sequences (@HD and @SQ lines), by collecting their read
+# groups, programs, and comments; NULL is returned when they do not agree
+# or when two read groups, or programs, share an identifier
+join_chr_headers <- function(chr_files) {
+    headers <- lapply(chr_files, function(chr_file) {
+        system2("samtools", c("view", "-H", chr_file), stdout = TRUE)
+    })
+    header <- headers[[1]]
+    is_shared <- function(lines) !grepl("^@(RG|PG|CO)", lines)
+    for (chr_header in headers[-1]) {
+        if (!identical(chr_header[is_shared(chr_header)],
+                       header[is_shared(header)])) {
+            return(NULL)
+        }
+        header <- c(header, setdiff(chr_header, header))
+    }
+
+    id_lines <- grep("^@(RG|PG)", header, value = TRUE)
+    ids <- paste(substr(id_lines, 1, 3),
+                 sub(".*\\tID:([^\\t]*).*", "\\\\1", id_lines))
+    if (any(duplicated(ids))) {
+        return(NULL)
+    }
+
+    header
+}
+
+# returns the command printing the joined header and the records of the
+# chromosome files as a single SAM stream
+get_chr_stream <- function(chr_files, header_file) {
+    if (stream_sams) {
+        return(paste("samtools cat -h", header_file,
+                     paste(chr_files, collapse = " "),
+                     "| samtools view -h -"))
+    }
+    paste0("{ cat ", header_file, "; awk '!/^@/' ",
+           paste(chr_files, collapse = " "), "; }")
+}
+
+# the chromosome files of a lot are concatenated, rather than merged, when
+# every chromosome is in one file and their headers can be joined: they
+# are concatenated in the reference sequence order, so the lot BAM file is
+# sorted if they are
+get_chr_merge_command <- function(chr_files, chromosomes, BAM_file,
+                                  num_of_threads) {
+    header <- NULL
+    if (!any(duplicated(chromosomes))) {
+        header <- join_chr_headers(chr_files)
+    }
+    if (is.null(header)) {
+        return(list(method = "merge",
+                    cmd = paste("samtools merge -fc -@",
+                                get_samtools_threads(num_of_threads),
+                                "-o", BAM_file,
+                                paste(chr_files, collapse = " "))))
+    }
+
+    sequences <- sub(".*\\tSN:([^\\t]*).*", "\\\\1",
+                     grep("^@SQ", header, value = TRUE))
+    chr_files <- chr_files[order(match(chromosomes, sequences))]
+    header_file <- paste0(BAM_file, ".header.sam")
+    writeLines(header, header_file)
+    if (stream_sams) {
+        cmd <- paste("samtools cat -h", header_file, "-o", BAM_file,
+                     paste(chr_files, collapse = " "))
+    } else {
+        cmd <- paste(get_chr_stream(chr_files, header_file),
+                     "| samtools view -b -@",
+                     get_samtools_threads(num_of_threads),
+                     "-o", BAM_file, "-")
+    }
+    list(method = "cat", cmd = cmd, header_file = header_file)
+}
+
+# a FASTQ source is a command printing a SAM stream and the header of the
+# stream: the FASTQ-only lots read their chromosome files, the other ones
+# the lot BAM file
+get_chr_fastq_source <- function(output_local_dir, sam_filename_prefixes,
+                                 chromosomes) {
+    chr_files <- file.path(output_local_dir,
+                           paste0(sam_filename_prefixes, chromosomes,
+                                  chr_file_extension))
+    header <- join_chr_headers(chr_files)
+    if (is.null(header)) {
+        return(NULL)
+    }
+    header_file <- file.path(output_local_dir, "chr_header.sam")
+    writeLines(header, header_file)
+
+    list(cmd = get_chr_stream(chr_files, header_file), header = header,
+         header_file = header_file)
+}
+
+get_BAM_fastq_source <- function(BAM_file) {
+    list(cmd = paste("samtools view -h", BAM_file),
+         header = system2("samtools", c("view", "-H", BAM_file),
+                          stdout = TRUE))
+}
+
+# routes the records of a SAM stream by read group to one FASTQ writer per
+# read group, which writes the files
+# <prefix>_<read group>.{R1,R2,unpaired,singleton}.fastq.gz; hence, the
+# stream is read once and no sample BAM file is written
+fastq_router <- paste(
+  'BEGIN { FS = "\\t" }',
+  '/^@/ { header = header $0 ORS; next }',
+  '{',
+  '  rg = ""',
+  '  for (i = 12; i <= NF; i++) {',
+  '    if (substr($i, 1, 5) == "RG:Z:") { rg = substr($i, 6); break }',
+  '  }',
+  '  if (rg == "") {',
+  '    print "Error: a record has no read group" > "/dev/stderr"',
+  '    exit 1',
+  '  }',
+  '  if (!(rg in writers)) {',
+  '    writers[rg] = fastq " " prefix "_" rg',
+  '    printf "%s", header | writers[rg]',
+  '  }',
+  '  print | writers[rg]',
+  '}', sep = "\\n")
+
+# the FASTQ writers compress their files according to the FASTQ_COMPRESSION
+# profile, i.e., "<codec>:<level>", and share the thread budget left by the
+# process reading the SAM stream
+fastq_compression <- strsplit(Sys.getenv("FASTQ_COMPRESSION", "bgzf:9"),
+                              ":")[[1]]
+fastq_writer <- Sys.getenv("FASTQ_WRITER_SCRIPT", "ProCESS_fastq_writer.sh")
+
+get_fastq_command <- function(fastq_source, fastq_prefix, num_of_threads) {
+    num_of_read_groups <- max(1, length(grep("^@RG", fastq_source$header)))
+    fastq_cmd <- paste("bash", fastq_writer, fastq_compression[1],
+                       fastq_compression[2],
+                       get_samtools_threads(num_of_threads - 1,
+                                            num_of_read_groups))
+
+    paste(fastq_source$cmd, "| awk -v", paste0("prefix=", fastq_prefix),
+          "-v", shQuote(paste0("fastq=", fastq_cmd)), shQuote(fastq_router))
+}
+
+# with STAGE_SLOTS set to a positive number, the lot outputs are staged
+# into the output directory in background by ProCESS_stage.sh, which takes
+# one of the cluster-wide staging slots in STAGE_TOKEN_DIR, while the lot
+# goes on; otherwise, the lot waits for them
+stage_script <- Sys.getenv("STAGE_SCRIPT", "ProCESS_stage.sh")
+stage_slots <- Sys.getenv("STAGE_SLOTS", "0")
+stagers <- list()
+
+# the done files of the lots whose FASTQ files are staged: they are written
+# from the manifests of the FASTQ stagers once all the stagers succeeded, so
+# that no lot is done while its BAM file is still being staged
+pending_done_files <- character()
+
+# stages hard links of the files, made in staging_dir, into dest_dir and
+# creates done_file afterwards
+stage_outputs <- function(files, staging_dir, dest_dir, done_file) {
+    unlink(staging_dir, recursive = TRUE)
+    dir.create(staging_dir)
+    invisible(file.link(files, file.path(staging_dir, basename(files))))
+
+    stage_args <- shQuote(c(stage_script, Sys.getenv("STAGE_TOKEN_DIR"),
+                            stage_slots, staging_dir, dest_dir, done_file))
+    if (stage_slots == "0") {
+        if (system2("bash", stage_args) != 0) {
+            stop(paste("Failed to stage the lot outputs into", dest_dir))
+        }
+    } else {
+        stagers[[length(stagers) + 1]] <<- parallel::mcparallel(
+          system2("bash", stage_args))
+    }
+}
+
+wait_for_stagers <- function() {
+    if (length(stagers) > 0) {
+        statuses <- parallel::mccollect(stagers)
+        stagers <<- list()
+        if (any(unlist(statuses) != 0)) {
+            stop("Failed to stage some lot outputs")
+        }
+    }
+    for (done_file in pending_done_files) {
+        if (!file.rename(paste0(done_file, ".staged"), done_file)) {
+            stop(paste("Failed to write", done_file))
+        }
+    }
+    pending_done_files <<- character()
+}
+
+# with STREAM_SAMS set, the SAM file of every simulated chromosome is a
+# named pipe read by "samtools view", which writes the chromosome BAM file,
+# so that no SAM file is written to the node scratch
+stream_sams <- Sys.getenv("STREAM_SAMS") != ""
+chr_file_extension <- if (stream_sams) ".bam" else ".sam"
+
+# with FASTQ_ONLY set, the FASTQ files are generated from the chromosome
+# files on the node scratch, and no lot BAM file reaches the output
+# directory
+fastq_only <- Sys.getenv("FASTQ_ONLY") != ""
+
+# with SEQ_RESULTS_PARQUET set, the mutation tables are also saved as
+# Parquet datasets partitioned by chromosome next to their RDS files
+seq_results_parquet <- Sys.getenv("SEQ_RESULTS_PARQUET") != ""
+if (seq_results_parquet && !requireNamespace("arrow", quietly = TRUE)) {
+    stop("The Parquet mutation tables require the R package arrow")
+}
+
+save_seq_results_parquet <- function(seq_results, rds_file) {
+    parquet_dir <- paste0(tools::file_path_sans_ext(rds_file), ".parquet")
+    tmp_dir <- paste0(parquet_dir, ".tmp_", Sys.getpid())
+    arrow::write_dataset(dplyr::ungroup(seq_results), tmp_dir,
+                         format = "parquet", partitioning = "chr")
+    unlink(parquet_dir, recursive = TRUE)
+    if (!file.rename(tmp_dir, parquet_dir)) {
+        stop(paste("Failed to rename", tmp_dir, "into", parquet_dir))
+    }
+}
+
+simulate_chr <- function(output_local_dir, sam_filename_prefix, chromosome,
+                         simulate) {
+    if (!stream_sams) {
+        return(simulate())
+    }
+
+    chr_file <- file.path(output_local_dir,
+                          paste0(sam_filename_prefix, chromosome))
+    SAM_pipe <- paste0(chr_file, ".sam")
+    unlink(SAM_pipe)
+    system2("mkfifo", SAM_pipe)
+    compressor <- parallel::mcparallel(
+      system2("samtools", c("view", "-b", "-o", paste0(chr_file, ".bam"),
+                            SAM_pipe)))
+
+    result <- tryCatch(simulate(), error = function(e) {
+        # unblocks the compressor if the pipe was never opened
+        close(fifo(SAM_pipe, open = "w", blocking = TRUE))
+        stop(e)
+    })
+    status <- parallel::mccollect(compressor)[[1]]
+    unlink(SAM_pipe)
+    if (status != 0) {
+        stop(paste("samtools failed to compress", SAM_pipe), call. = FALSE)
+    }
+
+    result
+}
+
+simulate_seq_resources <- function(c,tumour,ref_path,coverage,purity,
+                                   sam_prefix,template_prefix){
   p_info <- ps::ps_handle()
   start_time <- Sys.time()
   initial_cpu <- ps::ps_cpu_times(p_info)
@@ -304,8 +759,8 @@ simulate_seq_resources <- function(c,tumour,ref_path,coverage,purity){
                             output_dir = output_local_dir,
                             include_non_sequenced_mutations = TRUE,
                             update_SAM = TRUE,
-                            filename_prefix = sam_filename_prefix,
-                            template_name_prefix = paste0(lot_name,'r'),
+                            filename_prefix = sam_prefix,
+                            template_name_prefix = template_prefix,
                             with_normal_sample = FALSE)
   } else{
     cat("simulate_normal_seq")
@@ -318,8 +773,8 @@ simulate_seq_resources <- function(c,tumour,ref_path,coverage,purity){
                                    insert_size_mean = 350,
                                    include_non_sequenced_mutations = TRUE,
                                    insert_size_stddev = 10,
-                                   filename_prefix = sam_filename_prefix,
-                                   template_name_prefix = paste0(lot_name,'r'),
+                                   filename_prefix = sam_prefix,
+                                   template_name_prefix = template_prefix,
                                    output_dir = output_local_dir,
                                    with_preneoplastic = with_preneoplastic,
                                    update_SAM = TRUE)
@@ -351,212 +806,277 @@ if (!file.exists(node_local_dir)) {
   dir.create(node_local_dir)
 }
 
-output_local_dir <- file.path(node_local_dir,
-                              paste0(spn_name, "_",
-                                     lot_name))
-if (file.exists(output_local_dir)) {
-  unlink(output_local_dir, recursive=TRUE)
+# the lots are simulated back to back and share the phylogenetic forest
+# and the reference genome copy, which a ProCESS worker also keeps across
+# its requests
+if (exists("worker_cache")) {
+  lot_cache <- worker_cache
+} else {
+  lot_cache <- new.env()
+  lot_cache$ref_local_dir <- file.path(node_local_dir,
+                                       paste0(spn_name, "_", lot_names[1],
+                                              "_reference"))
+  if (file.exists(lot_cache$ref_local_dir)) {
+    unlink(lot_cache$ref_local_dir, recursive=TRUE)
+  }
 }
-dir.create(output_local_dir)
+phylo_forest <- lot_cache$phylo_forest
+ref_path <- lot_cache$ref_path
+
+# the lots running on a node share the reference genome copies of the
+# node reference cache, when it is enabled
+copy_reference <- function(reference_path) {
+  cache_dir <- Sys.getenv("REFERENCE_CACHE_DIR")
+  if (cache_dir != "") {
+    cache_script <- Sys.getenv("REFERENCE_CACHE_SCRIPT")
+    cached_path <- suppressWarnings(
+      system2("bash", c(cache_script, "acquire", cache_dir, reference_path,
+                        Sys.getpid(), Sys.getenv("REFERENCE_CACHE_MIN_FREE")),
+              stdout = TRUE))
+    if (is.null(attr(cached_path, "status")) && length(cached_path) == 1) {
+      lot_cache$release_args <- c(cache_script, "release", cache_dir,
+                                  cached_path, Sys.getpid())
+      return(cached_path)
+    }
+    cat("the node reference cache failed: copying the reference...")
+  }
 
-if (!file.exists(output_dir)) {
-  dir.create(output_dir)
-}
+  dir.create(lot_cache$ref_local_dir)
+  local_path <- file.path(lot_cache$ref_local_dir, "reference.fasta")
+  invisible(file.copy(reference_path, local_path))
 
-bam_dir <- file.path(output_dir, "BAM")
-if (!file.exists(bam_dir)) {
-  dir.create(bam_dir)
+  local_path
 }
 
-fastq_dir <- file.path(output_dir, "FASTQ")
-if (!file.exists(fastq_dir)) {
-  dir.create(fastq_dir)
-}
+for (lot_idx in seq_along(lot_names)) {
+    lot_name <- lot_names[lot_idx]
+    seed <- seeds[lot_idx]
 
-resources_dir <- file.path(output_dir, "TIME")
-if (!file.exists(resources_dir)) {
-  dir.create(resources_dir)
-}
+    output_local_dir <- file.path(node_local_dir,
+                                  paste0(spn_name, "_",
+                                         lot_name))
+    if (file.exists(output_local_dir)) {
+      unlink(output_local_dir, recursive=TRUE)
+    }
+    dir.create(output_local_dir)
 
-data_dir_muts <- file.path(output_dir, "data/mutations")
-data_dir_params <- file.path(output_dir, "data/parameters")
-data_dir_resources <- file.path(output_dir, "data/resources")
+    if (!file.exists(output_dir)) {
+      dir.create(output_dir)
+    }
 
-if (!file.exists(data_dir_muts)) {
-  dir.create(data_dir_muts,recursive = T)
-}
+    bam_dir <- file.path(output_dir, "BAM")
+    if (!fastq_only && !file.exists(bam_dir)) {
+      dir.create(bam_dir)
+    }
 
-if (!file.exists(data_dir_params)) {
-  dir.create(data_dir_params,recursive = T)
-}
+    fastq_dir <- file.path(output_dir, "FASTQ")
+    if (!file.exists(fastq_dir)) {
+      dir.create(fastq_dir)
+    }
 
-if (!file.exists(data_dir_resources)) {
-  dir.create(data_dir_resources,recursive = T)
-}
+    resources_dir <- file.path(output_dir, "TIME")
+    if (!file.exists(resources_dir)) {
+      dir.create(resources_dir)
+    }
 
+    data_dir_muts <- file.path(output_dir, "data/mutations")
+    data_dir_params <- file.path(output_dir, "data/parameters")
+    data_dir_resources <- file.path(output_dir, "data/resources")
 
-set.seed(seed)
+    if (!file.exists(data_dir_muts)) {
+      dir.create(data_dir_muts,recursive = T)
+    }
 
-filename_prefix <- lot_name
+    if (!file.exists(data_dir_params)) {
+      dir.create(data_dir_params,recursive = T)
+    }
 
-sam_filename_prefix <- paste0(filename_prefix, "_chr_")
+    if (!file.exists(data_dir_resources)) {
+      dir.create(data_dir_resources,recursive = T)
+    }
 
-BAM_filename <- paste0(filename_prefix, ".bam")
 
-BAM_file <- file.path(bam_dir, BAM_filename)
-BAM_local_file <- file.path(output_local_dir, BAM_filename)
+    set.seed(seed)
 
-BAM_done_filename <- file.path(output_dir, paste0(lot_name, "_BAM.done"))
+    filename_prefix <- lot_name
 
-step <- 1
+    BAM_filename <- paste0(filename_prefix, ".bam")
 
-if (!file.exists(BAM_done_filename) || !file.exists(BAM_file)) {
-    unlink(BAM_done_filename)
+    BAM_file <- file.path(bam_dir, BAM_filename)
+    BAM_local_file <- file.path(output_local_dir, BAM_filename)
 
-    cat("1. Reading phylogenetic forest...\\n")
-    phylo_forest <- load_phylogenetic_forest(phylo_forest_filename)
-    
-    cat("done\\n2. Copying reference genome...")
-    
-    ref_path <- file.path(output_local_dir, "reference.fasta")
-    
-    invisible(file.copy(phylo_forest$get_reference_path(), ref_path))
-    
-    cat("done\\n3. Simulating reads...\\n")
+    BAM_done_filename <- file.path(output_dir, paste0(lot_name, "_BAM.done"))
+
+    step <- 1
+
+    if (!file.exists(BAM_done_filename) || !file.exists(BAM_file)) {
+        unlink(BAM_done_filename)
+
+        if (is.null(phylo_forest)) {
+            cat("1. Reading phylogenetic forest...\\n")
+            phylo_forest <- load_phylogenetic_forest(phylo_forest_filename)
+
+            cat("done\\n2. Copying reference genome...")
+
+            ref_path <- copy_reference(phylo_forest$get_reference_path())
+
+            lot_cache$phylo_forest <- phylo_forest
+            lot_cache$ref_path <- ref_path
+
+            cat("done\\n")
+        }
+
+        cat("3. Simulating reads...\\n")
     
-    # Simulate sequencing ####
-    basic_seq <- BasicIlluminaSequencer(1e-3) ## only for testing purpose
-    chromosomes <- phylo_forest$get_absolute_chromosome_positions()$chr
-    cat("parallel::mclapply(",chromosomes,",simulate_seq_resources,mc.cores = 4,tumour = ",
-    seq_tumour,",ref_path=",ref_path,",coverage = ",coverage,",purity=",purity,")")
+        # Simulate sequencing ####
+        basic_seq <- BasicIlluminaSequencer(1e-3) ## only for testing purpose
+        tasks <- get_seq_tasks(phylo_forest, coverage, 4,
+                               filename_prefix, lot_name)
+        task_seeds <- sample.int(.Machine$integer.max, nrow(tasks))
+        cat("parallel::mclapply(",tasks$chr,",simulate_seq_resources,mc.cores = 4,tumour = ",
+        seq_tumour,",ref_path=",ref_path,",coverage = ",tasks$coverage,",purity=",purity,")")
     
-    seq_results <- parallel::mclapply(chromosomes, simulate_seq_resources,
-                          mc.cores = 4,
-                          tumour = seq_tumour, ref_path= ref_path,
-                          coverage = coverage, purity = purity)
+        seq_results <- parallel::mclapply(seq_len(nrow(tasks)), function(i) {
+                                set.seed(task_seeds[i])
+                                simulate_chr(output_local_dir, tasks$sam_prefix[i],
+                                             tasks$chr[i], function() {
+                                  simulate_seq_resources(tasks$chr[i],
+                                      tumour = seq_tumour, ref_path= ref_path,
+                                      coverage = tasks$coverage[i], purity = purity,
+                                      sam_prefix = tasks$sam_prefix[i],
+                                      template_prefix = tasks$template_prefix[i])
+                                })
+                              }, mc.cores = 4, mc.preschedule = FALSE)
                           
-    seq_results_muts_final <- lapply(1:length(seq_results), function(i) {
-        s <- seq_results[[i]]$mutations
-        }) %>% do.call(bind_rows, .)
-
-
-    seq_results_params_final <- lapply(1:length(chromosomes), function(i) {
-        pp <- seq_results[[i]]$parameters
-        dplyr::tibble(chr = chromosomes[i], parameters = list(pp))
-        }) %>% do.call("bind_rows", .)
+        seq_results_muts_final <- lapply(1:length(seq_results), function(i) {
+            s <- seq_results[[i]]$mutations
+            }) %>% do.call(bind_rows, .)
+        if (any(tasks$shard > 1)) {
+            seq_results_muts_final <- sum_shard_mutations(seq_results_muts_final)
+        }
+
+
+        seq_results_params_final <- lapply(1:nrow(tasks), function(i) {
+            pp <- seq_results[[i]]$parameters
+            dplyr::tibble(chr = tasks$chr[i], parameters = list(pp))
+            }) %>% do.call("bind_rows", .)
         
-    seq_results_resources_final <- lapply(1:length(seq_results), function(i) {
-        s <- seq_results[[i]]$resource_usage
-        }) %>% do.call(bind_rows, .)
-
-    saveRDS(seq_results_muts_final,
-            file.path(data_dir_muts,
-                      paste0("/seq_results_muts_", spn_name,
-    			  "_", lot_name, ".rds")))
-    saveRDS(seq_results_params_final,
-            file.path(data_dir_params,
-                      paste0("/seq_results_params_", spn_name,
-                  "_", lot_name, ".rds")))
+        seq_results_resources_final <- lapply(1:length(seq_results), function(i) {
+            s <- seq_results[[i]]$resource_usage
+            }) %>% do.call(bind_rows, .)
+
+        seq_results_muts_file <- file.path(data_dir_muts,
+                                           paste0("/seq_results_muts_",
+                                                  spn_name, "_", lot_name,
+                                                  ".rds"))
+        saveRDS(seq_results_muts_final, seq_results_muts_file)
+        if (seq_results_parquet) {
+            save_seq_results_parquet(seq_results_muts_final,
+                                     seq_results_muts_file)
+        }
+        saveRDS(seq_results_params_final,
+                file.path(data_dir_params,
+                          paste0("/seq_results_params_", spn_name,
+                      "_", lot_name, ".rds")))
                   
-    saveRDS(seq_results_resources_final,
-            file.path(data_dir_resources,
-                      paste0("/seq_results_resources_", spn_name,
-                  "_", lot_name, ".rds")))
+        saveRDS(seq_results_resources_final,
+                file.path(data_dir_resources,
+                          paste0("/seq_results_resources_", spn_name,
+                      "_", lot_name, ".rds")))
     
 
-    cat("done\\n4. Building overall BAM file...")
-    merge_sams(output_local_dir, BAM_local_file,
-               sam_filename_prefix, chromosomes,
-    		   num_of_cores, resources_dir)
-    
-    cat("done\\n5. Deleting SAM files...")
-    delete_sams(output_local_dir, sam_filename_prefix, chromosomes)
-    
-    cat("done\\n6. Moving the BAM file to output directory...")
-    cmd <- paste0("cp ", BAM_local_file, " ", bam_dir, "/")
-    invisible(system(cmd, intern = TRUE))
-
-    invisible(file.create(BAM_done_filename))
-    cat("done\\n")
-    remove_local_bam <- TRUE
-    step <- 7
-
-} else {
+        fastq_source <- NULL
+        if (fastq_only) {
+            fastq_source <- get_chr_fastq_source(output_local_dir,
+                                                 tasks$sam_prefix, tasks$chr)
+        }
+
+        if (is.null(fastq_source)) {
+            cat("done\\n4. Building overall BAM file...")
+            merge_sams(output_local_dir, BAM_local_file,
+                       tasks$sam_prefix, tasks$chr,
+            		   thread_budget, resources_dir)
+        
+            cat("done\\n5. Deleting SAM files...")
+            delete_sams(output_local_dir, tasks$sam_prefix, tasks$chr)
+        
+            if (fastq_only) {
+                cat("done\\n")
+                step <- 6
+            } else {
+                cat("done\\n6. Staging the BAM file to output directory...")
+                stage_outputs(BAM_local_file, paste0(output_local_dir, "_BAM"),
+                              bam_dir, BAM_done_filename)
+                cat("done\\n")
+                step <- 7
+            }
+            fastq_source <- get_BAM_fastq_source(BAM_local_file)
+        } else {
+            cat("done\\n")
+            step <- 4
+        }
+        remove_local_bam <- TRUE
+
+    } else {
     
-    BAM_local_file <- BAM_file
-    cat("Found the lot BAM file\\n")
-    remove_local_bam <- FALSE
-    step <- 1
-}
+        BAM_local_file <- BAM_file
+        cat("Found the lot BAM file\\n")
+        fastq_source <- get_BAM_fastq_source(BAM_file)
+        remove_local_bam <- FALSE
+        step <- 1
+    }
 
-cat(paste0(step, ". Splitting BAM file by sample..."))
-step <- step + 1
+    cat(paste0(step, ". Generating the FASTQs..."))
+    step <- step + 1
 
-split_bam_by_samples <- function(output_local_dir, BAM_file, remove_local_bam, num_of_cores, resources_dir) {
-    name <- strsplit(BAM_file, '/') %>% unlist()
-    name <- name[length(name)]
-    cmd <- paste0("/usr/bin/time -o ", resources_dir, "/out_samtools_split_", purity,"_",
-                  name, " -p -v samtools split -f \\"",
-                  file.path(output_local_dir,"%*_%!.bam"),
-                  "\\" ", BAM_file, " -@ ", num_of_cores)
+    name <- paste0(resources_dir, "/out_fastq_", purity, "_", filename_prefix)
+    cmd <- get_fastq_command(fastq_source,
+                             file.path(output_local_dir, filename_prefix),
+                             thread_budget)
+    cmd <- paste("/usr/bin/time -o", name, "-p -v sh -c", shQuote(cmd))
     invisible(system(cmd, intern = TRUE))
 
     if (remove_local_bam) {
-        file.remove(BAM_file)
+        unlink(BAM_local_file)
     }
-}
-invisible(split_bam_by_samples(output_local_dir, BAM_local_file, remove_local_bam, num_of_cores, resources_dir))
-## unlink(bam_dir, recursive = TRUE)
-
-cat(paste0("done\\n", step,
-           ". Generating the FASTQs and deleting the BAMs..."))
-step <- step + 1
-
-BAM_files <- list.files(output_local_dir, pattern = "\\\\.bam$")
-
-generate_fastq <- function(orig_file, fastq_dir, resources_dir) {
-  base_orig_file <- tools::file_path_sans_ext(basename(orig_file))
-
-  file_prefix <- file.path(fastq_dir, base_orig_file)
-  R1 <- paste0(file_prefix, ".R1.fastq.gz")
-  R2 <- paste0(file_prefix, ".R2.fastq.gz")
-  unpaired <- paste0(file_prefix, ".unpaired.fastq.gz")
-  singleton <- paste0(file_prefix, ".singleton.fastq.gz")
-
-  prefix <- strsplit(file_prefix,'/') %>% unlist()
-  prefix <- prefix[length(prefix)]
-  name <- paste0(resources_dir, "/out_fastq_", purity,"_",prefix) 
-  cmd <- paste("/usr/bin/time -o", name, "-p -v samtools fastq -@ 20 -c 9 -N -1", R1, "-2", R2, "-0", unpaired, 
-               "-s", singleton, orig_file)
-  invisible(system(cmd, intern = TRUE))
-}
-
-result <- parallel::mclapply(BAM_files, function(c) {
-    curr_BAM_file <- file.path(output_local_dir, c)
-    if (BAM_file != curr_BAM_file) {
-        generate_fastq(curr_BAM_file, output_local_dir, resources_dir)
-
-        unlink(curr_BAM_file)
+    if (!is.null(fastq_source$header_file)) {
+        unlink(fastq_source$header_file)
+        delete_sams(output_local_dir, tasks$sam_prefix, tasks$chr)
     }
-}, mc.cores = num_of_cores)
 
-cat(paste0("done\\n", step,
-           ". Moving the FASTQ files to output directory..."))
-step <- step + 1
+    cat(paste0("done\\n", step,
+               ". Staging the FASTQ files to output directory..."))
+    step <- step + 1
 
-cmd <- paste0("mv ", file.path(output_local_dir, "*.fastq.gz"),
-              " ", fastq_dir, "/")
-invisible(system(cmd, intern = TRUE))
+    fastq_files <- list.files(output_local_dir, pattern = "\\\\.fastq\\\\.gz$",
+                              full.names = TRUE)
+    done_filename <- file.path(output_dir, paste0(lot_name, "_final.done"))
+    stage_outputs(fastq_files, paste0(output_local_dir, "_FASTQ"), fastq_dir,
+                  paste0(done_filename, ".staged"))
+    pending_done_files <- c(pending_done_files, done_filename)
 
-cat(paste0("done\\n", step, ". Removing local files..."))
-step <- step + 1
+    cat(paste0("done\\n", step, ". Removing local files..."))
+    step <- step + 1
 
-unlink(output_local_dir, recursive = TRUE)
+    unlink(output_local_dir, recursive = TRUE)
 
-done_filename <- file.path(output_dir, paste0(lot_name, "_final.done"))
-invisible(file.create(done_filename))
+    cat("done\\n")
+}
 
-cat("done\\n")
+if (length(stagers) > 0) {
+    cat("Waiting for the lot outputs to be staged...")
+    wait_for_stagers()
+    cat("done\\n")
+} else {
+    wait_for_stagers()
+}
+
+if (!exists("worker_cache")) {
+  if (!is.null(lot_cache$release_args)) {
+    invisible(system2("bash", lot_cache$release_args))
+  }
+  unlink(lot_cache$ref_local_dir, recursive = TRUE)
+}
 """
 
 sarek_file_launcher="""#!/bin/bash
@@ -850,6 +1370,23 @@ if (__name__ == '__main__'):
                               + "node (in GB)."))
     parser.add_argument('-M', '--mem_per_node', type=float, default=512,
                         help="The memory of each node in GB")
+    parser.add_argument('-a', '--array_jobs', action='store_true',
+                        help=("A Boolean flag to submit all the lots as "
+                              + "a single Slurm job array"))
+    parser.add_argument('-i', '--poll_interval', type=float, default=None,
+                        help=("The number of seconds between two scans of "
+                              + "the lot done files (default: 60 without "
+                              + "lot notifications, 600 otherwise)"))
+    parser.add_argument('--no_notifications', action='store_true',
+                        help=("A Boolean flag to disable the lot "
+                              + "completion notifications"))
+    parser.add_argument('--notify_host', type=str, default=None,
+                        help=("The host name the lot jobs use to notify "
+                              + "their completion (default: this host)"))
+    parser.add_argument('--notify_port', type=int, default=0,
+                        help=("The port on which lot completion "
+                              + "notifications are received (default: any "
+                              + "free port)"))
     parser.add_argument('-I', '--image_path', type=str, default="",
                         help="Path to singularity image")
     parser.add_argument('-C', '--config', type=str, default="",
@@ -858,7 +1395,42 @@ if (__name__ == '__main__'):
                        help="Path to sarek launching dir")
     parser.add_argument('-TD', '--tumourevo_output_dir', type=str, default="",
                        help="Path to tumourevo result path")
-    
+    parser.add_argument('-D', '--dag', action='store_true',
+                        help=("A Boolean flag to submit the whole pipeline "
+                              + "as Slurm jobs linked by dependencies and "
+                              + "exit"))
+    parser.add_argument('--sample_sheets_only', action='store_true',
+                        help=("A Boolean flag to only write the sarek and "
+                              + "tumourevo files of the completed lots"))
+    parser.add_argument('--status', action='store_true',
+                        help=("A Boolean flag to print the state of the "
+                              + "lots recorded in the cohort state "
+                              + "database and exit"))
+    parser.add_argument('--shard_chromosomes', action='store_true',
+                        help=("A Boolean flag to split the simulation of "
+                              + "the longest chromosomes of a lot in "
+                              + "shards of lower coverage"))
+    parser.add_argument('--stream_sams', action='store_true',
+                        help=("A Boolean flag to compress the chromosome "
+                              + "SAM files of a lot into BAM files while "
+                              + "they are simulated, through named pipes"))
+    parser.add_argument('--fastq_only', action='store_true',
+                        help=("A Boolean flag to produce the lot FASTQ "
+                              + "files from the node scratch BAM file "
+                              + "without saving it in the output directory"))
+    add_executor_arguments(parser)
+    add_resource_arguments(parser)
+    add_scratch_arguments(parser)
+    add_reference_cache_arguments(parser)
+    add_compression_arguments(parser)
+    add_staging_arguments(parser)
+    add_parquet_arguments(parser)
+    add_manifest_arguments(parser)
+    add_failure_arguments(parser)
+    add_speculation_arguments(parser)
+    add_packing_arguments(parser)
+    add_worker_arguments(parser)
+    add_planning_arguments(parser)
 
     cohorts = { 'normal': {
                     'max_coverage': 30,
@@ -870,11 +1442,12 @@ if (__name__ == '__main__'):
                     }
                 }
 
-    num_of_lots_T = 40
-    num_of_lots_N = 6
+    # tuned for 8 EPYC nodes: see --nodes
+    default_num_of_lots = {'normal': 6, 'tumour': 40}
     
     cohort_coverages = list([50, 100, 150, 200])
     args = parser.parse_args()
+    check_speculation_arguments(parser, args)
 
     if args.account is None:
         process = subprocess.Popen(['whoami'],
@@ -883,10 +1456,23 @@ if (__name__ == '__main__'):
     else:
         account = args.account
 
+    if args.status:
+        if not os.path.exists(args.output_dir):
+            sys.stdout.write('No cohort in {}\n'.format(args.output_dir))
+            sys.exit(1)
+        store = JobStateStore(args.output_dir)
+        store.reconcile()
+        write_status(store)
+        sys.exit(0)
+
+    executor = create_executor(args, account)
+
     gender_filename = os.path.join(os.path.dirname(args.phylogenetic_forest),
                                    "subject_gender.txt")
 
     curr_dir = os.getcwd()
+    image_env = {'IMAGE': args.image_path, 'DIR': curr_dir}
+    gender_job_id = None
     if not os.path.exists(gender_filename):
         with open('ProCESS_subject_gender.R', 'w') as outstream:
             outstream.write(gender_R_script)
@@ -894,27 +1480,126 @@ if (__name__ == '__main__'):
         with open('ProCESS_subject_gender.sh', 'w') as outstream:
             outstream.write(gender_shell_script)
 
-        cmd = ['sbatch', '--account={}'.format(account),
-            '--partition={}'.format(args.partition),
-            ('--export=PHYLO_FOREST={},IMAGE={},DIR={}').format(args.phylogenetic_forest,
-                                                args.image_path, curr_dir),
-            './ProCESS_subject_gender.sh']
-
-        subprocess.run(cmd)
+        gender_job_id = executor.submit('./ProCESS_subject_gender.sh',
+                                                        env={'PHYLO_FOREST': args.phylogenetic_forest,
+                                             **image_env})
 
     with open('ProCESS_seq.R', 'w') as outstream:
         outstream.write(R_script)
 
-    space_per_lot = 3 * cohorts['tumour']['max_coverage'] * 5 / num_of_lots_T
-    memory_per_lot = math.ceil(args.mem_per_node*space_per_lot/args.scratch_per_node)
+    if not args.no_reference_cache:
+        write_reference_cache_script()
+    write_fastq_writer_script()
+    write_stage_script()
+    write_scratch_ledger_script()
+
+    # the lots of the default plan get the node memory share of their
+    # scratch, but at least a fifth of the node memory
+    default_lot_scratch = estimate_lot_scratch(
+        cohorts['tumour']['max_coverage']/default_num_of_lots['tumour'],
+        args.num_of_samples, args.scratch_per_x)
+    memory_per_lot = math.ceil(args.mem_per_node*default_lot_scratch
+                               / args.scratch_per_node)
     memory_per_lot = max(memory_per_lot, math.ceil(args.mem_per_node/5))
     shell_script = shell_script.replace('{MEMORY}', str(memory_per_lot))
 
     with open('ProCESS_seq.sh', 'w') as outstream:
         outstream.write(shell_script)
 
+    default_lot_request = get_script_request('ProCESS_seq.sh')
+    sizer = create_resource_sizer(args)
+    lot_requests = dict()
+
+    def size_lot_request(seq_type, lot_coverage=None):
+        if sizer is None:
+            return default_lot_request
+
+        # the lots never get less CPUs than the cores used by ProCESS_seq.R
+        return sizer.get_request('lot', seq_type, default_lot_request,
+                                 lot_coverage=lot_coverage,
+                                 min_cpus=default_lot_request.cpus)
+
+    def get_lot_request(seq_type, lot_coverage=None):
+        request = size_lot_request(seq_type, lot_coverage)
+        if sizer is not None and str(request) != lot_requests.get(seq_type):
+            lot_requests[seq_type] = str(request)
+            sys.stdout.write('Requesting {} per {} lot\n'.format(request, seq_type))
+            sys.stdout.flush()
+        return request
+
+    def get_lot_scratch(group):
+        if group.seq_type == 'normal':
+            num_of_samples = 1
+        else:
+            fastq_dir = os.path.join(group.output_dir, 'FASTQ')
+            num_of_samples = len(get_sample_names_from_FASTQ(fastq_dir))
+            if num_of_samples == 0:
+                num_of_samples = args.num_of_samples
+        return estimate_lot_scratch(group.lot_coverage, num_of_samples,
+                                    args.scratch_per_x)
+
+    if args.pack_time_limit is None:
+        pack_time_limit = None
+    else:
+        pack_time_limit = parse_elapsed(args.pack_time_limit)
+    pack_sizes = dict()
+
+    def get_lot_pack_size(group):
+        pack_size = get_pack_size(get_lot_request(group.seq_type,
+                                                  group.lot_coverage),
+                                  args.pack_lots, pack_time_limit,
+                                  args.mem_per_node, args.pack_memory_growth)
+        if pack_size < args.pack_lots and pack_sizes.get(group) != pack_size:
+            sys.stdout.write(('Packing at most {} lots of {} per job: the '
+                              + '--pack_time_limit or --mem_per_node do not '
+                              + 'fit {} lots\n').format(pack_size, group,
+                                                        args.pack_lots))
+            sys.stdout.flush()
+        pack_sizes[group] = pack_size
+        return pack_size
+
+    def get_lot_pack_request(pack):
+        return get_pack_request(get_lot_request(pack[0].group.seq_type,
+                                                pack[0].group.lot_coverage),
+                                len(pack), args.pack_memory_growth)
+
+    if args.no_notifications or args.dag or args.sample_sheets_only:
+        listener = None
+    else:
+        listener = CompletionListener(args.notify_host, args.notify_port)
+
+    poll_interval = args.poll_interval
+    if poll_interval is None:
+        poll_interval = 60 if listener is None else 600
+
     if not os.path.exists(args.output_dir):
         os.mkdir(args.output_dir)
+
+    store = JobStateStore(args.output_dir)
+
+    tracker = LotCompletionTracker(get_completed_jobs, listener,
+                                   poll_interval, store)
+
+    if listener is None:
+        notify_env = dict()
+    else:
+        notify_env = {'NOTIFY_ADDR': listener.address}
+
+    scratch_env = get_scratch_env(args)
+    # the environment of ProCESS_seq.R
+    seq_env = get_reference_cache_env(args)
+    if args.shard_chromosomes:
+        seq_env['SHARD_CHROMOSOMES'] = 1
+    if args.stream_sams:
+        seq_env['STREAM_SAMS'] = 1
+    if args.fastq_only:
+        seq_env['FASTQ_ONLY'] = 1
+    seq_env.update(get_compression_env(args))
+    seq_env.update(get_staging_env(args))
+    seq_env.update(get_parquet_env(args))
+
+    monitor = LotFailureMonitor(executor, store, args.failure_check_interval,
+                                args.node_failure_limit)
     
     sarek_dir = os.path.join(args.output_dir, 'sarek')
     tumourevo_dir = os.path.join(args.output_dir, 'tumourevo')
@@ -926,14 +1611,38 @@ if (__name__ == '__main__'):
     if not os.path.exists(tumourevo_dir):
         os.mkdir(tumourevo_dir)  
         
+    def submit_copy(work_item, copy_dir, node):
+        return submit_lot([work_item], monitor.get_exclude_options(
+            ','.join(n for n in [args.exclude, node] if n)), copy_dir)
+
+    if args.speculation:
+        speculator = LotSpeculator(executor, store, tracker, submit_copy,
+                                   args.speculation_percentile,
+                                   check_interval=args.failure_check_interval)
+    else:
+        speculator = None
+
+    if args.array_jobs:
+        scheduler = LotScheduler(tracker, None, monitor, args.max_retries,
+                                 args.retry_delay)
+    else:
+        scheduler = LotScheduler(tracker, args.parallel_jobs*args.pack_lots,
+                                 monitor, args.max_retries, args.retry_delay,
+                                 speculator, args.pack_lots)
+
+    def get_planned_lot_scratch(seq_type, lot_coverage):
+        num_of_samples = 1 if seq_type == 'normal' else args.num_of_samples
+        return estimate_lot_scratch(lot_coverage, num_of_samples,
+                                    args.scratch_per_x)
+
+    planned_lots = plan_num_of_lots(args, cohorts, cohort_coverages,
+                                    default_num_of_lots, size_lot_request,
+                                    get_planned_lot_scratch)
+
+    unverified_lots = list()
     for seq_type, cohorts_data in cohorts.items():
-        if seq_type == 'normal':
-            num_of_lots = num_of_lots_N
-        else:
-            num_of_lots = num_of_lots_T
-            
-        zeros = math.ceil(math.log10(num_of_lots))
-        
+        num_of_lots = planned_lots[seq_type]
+
         lot_coverage = cohorts_data['max_coverage']/num_of_lots
         lot_prefix = get_lot_prefix(seq_type)
         type_output_dir = f'{args.output_dir}/{seq_type}'
@@ -955,213 +1664,366 @@ if (__name__ == '__main__'):
 
             if args.force_completed_jobs:
                 remove_old_done_files(output_dir, lot_prefix)
-            
-            lot_ids = set(range(num_of_lots))
+                store.reset(output_dir, lot_prefix)
+            elif args.verify_outputs != 'none':
+                unverified_lots.extend(
+                    discard_unverified_lots(output_dir, lot_prefix, store,
+                                            args.verify_outputs == 'full',
+                                            args.verification_threads))
+
+            scheduler.add_group(LotGroup(seq_type, purity, output_dir,
+                                         log_dir, lot_prefix, lot_coverage,
+                                         num_of_lots))
+
+    def submit_lot(pack, exclude_options, copy_dir=None):
+        group = pack[0].group
+        pack_name = get_pack_name(pack)
+        request = get_lot_pack_request(pack)
+        lot_scratch = get_lot_scratch(group)
+        if copy_dir is None:
+            dest, suffix, copy_env = group.output_dir, '', notify_env
+        else:
+            # the copies are resolved by LotSpeculator through their done files
+            dest, suffix, copy_env = copy_dir, '_copy', {'SPECULATIVE': 1}
+
+        return executor.submit('./ProCESS_seq.sh',
+                               job_name='{}_{}_{}{}'.format(args.SPN, group.purity, pack_name, suffix),
+                               env={'PHYLO_FOREST': args.phylogenetic_forest,
+                                    'SPN': args.SPN,
+                                    'LOT': ':'.join(work_item.lot_name
+                                                    for work_item in pack),
+                                    'DEST': dest,
+                                    'COVERAGE': group.lot_coverage,
+                                    'TYPE': group.seq_type,
+                                    'NODE_SCRATCH': args.node_scratch_directory,
+                                    'SEED': ':'.join(str(work_item.lot_id)
+                                                     for work_item in pack),
+                                    'PURITY': group.purity,
+                                    'LOT_SCRATCH': lot_scratch, **image_env,
+                                    **scratch_env, **seq_env,
+                                    **copy_env},
+                               output='{}/lot_{}{}.log'.format(group.log_dir, pack_name, suffix),
+                               options=(exclude_options + request.get_options()
+                                        + get_scratch_options(args, lot_scratch)))
+
+    def get_lot_args(pack):
+        group = pack[0].group
+        return [args.phylogenetic_forest, args.SPN,
+                ':'.join(work_item.lot_name for work_item in pack),
+                args.node_scratch_directory, group.output_dir,
+                group.lot_coverage, group.seq_type, 4,
+                ':'.join(str(work_item.lot_id) for work_item in pack),
+                group.purity]
+
+    def submit_lots(work_items):
+        exclude_options = monitor.get_exclude_options(args.exclude)
+        if sizer is not None:
+            sizer.refresh()
+
+        for pack in pack_work_items(work_items, get_lot_pack_size):
+            sys.stdout.write('Submitting lot {}...'.format(get_pack_name(pack)))
+            sys.stdout.flush()
+
+            if pool is None:
+                job_id = submit_lot(pack, exclude_options)
+            else:
+                job_id = pool.submit(get_lot_args(pack),
+                                     get_lot_scratch(pack[0].group))
+            for work_item in pack:
+                store.mark_submitted(work_item.group.output_dir,
+                                     work_item.lot_name, job_id)
+            sys.stdout.write('done\n')
+            sys.stdout.flush()
+
+    def submit_lot_array(work_items):
+        exclude_options = monitor.get_exclude_options(args.exclude)
+        array_log_dir = os.path.join(args.output_dir, 'log')
+        if not os.path.exists(array_log_dir):
+            os.mkdir(array_log_dir)
+
+        table_filename = os.path.abspath(os.path.join(array_log_dir,
+                                                      'lot_table_{}.txt'.format(int(time.time()))))
+        if sizer is not None:
+            sizer.refresh()
+        packs = pack_work_items(work_items, get_lot_pack_size)
+        write_lot_table(table_filename, packs, get_lot_scratch)
+
+        request = get_max_request(get_lot_pack_request(pack) for pack in packs)
+        lot_scratch = max(get_lot_scratch(work_item.group)
+                          for work_item in work_items)
+
+        sys.stdout.write('Submitting {} lots as a job array...'.format(len(work_items)))
+        sys.stdout.flush()
+
+        job_id = executor.submit('./ProCESS_seq.sh',
+                        job_name='{}_lots'.format(args.SPN),
+                        array='0-{}%{}'.format(len(packs)-1, args.parallel_jobs),
+                        env={'PHYLO_FOREST': args.phylogenetic_forest,
+                             'SPN': args.SPN,
+                             'NODE_SCRATCH': args.node_scratch_directory,
+                             'LOT_TABLE': table_filename, **scratch_env, **image_env,
+                             **seq_env, **notify_env},
+                        output='{}/lot_array_%A_%a.log'.format(array_log_dir),
+                        options=(exclude_options + request.get_options()
+                                 + get_scratch_options(args, lot_scratch)))
+        for task_id, pack in enumerate(packs):
+            for work_item in pack:
+                store.mark_submitted(work_item.group.output_dir,
+                                     work_item.lot_name,
+                                     '{}_{}'.format(job_id, task_id))
+        sys.stdout.write('done\n')
+        sys.stdout.flush()
+
+        return job_id, packs
+
+    def submit_merge(group, dependencies=None):
+        with open('ProCESS_merge_rds.R', 'w') as outstream:
+            outstream.write(merging_R_script)
+
+        with open('ProCESS_merge_rds.sh', 'w') as outstream:
+            outstream.write(merging_shell_script)
+
+        request = get_script_request('ProCESS_merge_rds.sh')
+        if sizer is not None:
+            sizer.refresh()
+            request = sizer.get_request('merge', group.seq_type, request)
+
+        max_coverage = cohorts[group.seq_type]['max_coverage']
+        if group.seq_type == 'normal':
+            num_of_lots_list = [max_coverage]
+        else:
+            num_of_lots_list = [math.ceil((cohort_cov*group.num_of_lots)/max_coverage)
+                                for cohort_cov in cohort_coverages]
+
+        lots=''
+        for l in num_of_lots_list:
+          lots = lots+' '+str(l)
+
+        return executor.submit('./ProCESS_merge_rds.sh',
+                               job_name='merge_{}_{}_{}_{}'.format(group.seq_type, args.SPN, group.purity, max_coverage),
+                               dependencies=dependencies,
+                               env={'LOTS_LIST': lots, 'SPN': args.SPN,
+                                    'INPUT_DIR': args.output_dir,
+                                    'PURITY': group.purity,
+                                    'TYPE': group.seq_type,
+                                    'MAX_COVERAGE': max_coverage,
+                                    'TOT_LOTS': group.num_of_lots,
+                                    **get_parquet_env(args), **image_env},
+                               options=request.get_options(),
+                               output='{}/merge_{}_{}_{}_{}.log'.format(group.log_dir, group.seq_type, args.SPN, group.purity, max_coverage))
+
+    pool = None
+    if args.workers > 0 and not (args.dag or args.array_jobs or args.sample_sheets_only):
+        write_worker_scripts('module load singularity',
+                             'singularity exec --bind /orfeo:/orfeo --no-home ${IMAGE} ',
+                             '${DIR}/')
+        worker_time_limit = parse_elapsed(args.worker_time_limit)
+
+        def submit_worker(worker_dir):
+            request = get_max_request(
+                get_lot_request(seq_type, cohorts[seq_type]['max_coverage']
+                                / planned_lots[seq_type])
+                for seq_type in cohorts)
+            request.time_limit = worker_time_limit
+            return executor.submit('./ProCESS_worker.sh',
+                                   job_name='{}_worker'.format(args.SPN),
+                                   env={'WORKER_DIR': worker_dir,
+                                        'SPN': args.SPN,
+                                        'NODE_SCRATCH': args.node_scratch_directory,
+                                        'WORKER_IDLE_TIME': args.worker_idle_time, **image_env,
+                                        **scratch_env, **seq_env,
+                                        **notify_env},
+                                   output=os.path.join(worker_dir, 'worker.log'),
+                                   options=(monitor.get_exclude_options(args.exclude)
+                                            + request.get_options()))
+
+        pool = LotWorkerPool(executor, os.path.join(args.output_dir, 'workers'),
+                             args.workers, submit_worker,
+                             args.failure_check_interval, store)
+
+    if args.dag:
+        dependencies = list()
+        if gender_job_id is not None:
+            dependencies.append(gender_job_id)
+
+        array_job_id, packs = None, list()
+        work_items = scheduler.get_missing_lots()
+        if len(work_items) != 0:
+            array_job_id, packs = submit_lot_array(work_items)
+            dependencies.append(array_job_id)
+
+        for group in scheduler.groups:
+            submit_merge(group, get_array_task_ids(array_job_id, packs,
+                                                   group))
+
+        os.makedirs(os.path.join(args.output_dir, 'log'), exist_ok=True)
+        write_command_script('ProCESS_sample_sheets.sh',
+                             get_follow_up_command(['-D', '--dag', '-F',
+                                                    '--force_completed_jobs'],
+                                                   ['--sample_sheets_only']))
+        job_id = executor.submit('./ProCESS_sample_sheets.sh',
+                                 job_name='{}_sample_sheets'.format(args.SPN),
+                                 dependencies=dependencies,
+                                 output='{}/log/sample_sheets.log'.format(args.output_dir))
+        sys.stdout.write('Submitted the sample sheet job {}\n'.format(job_id))
+        sys.stdout.flush()
+
+        executor.shutdown()
+        sys.exit(0)
+
+    if args.array_jobs:
+        def submit(work_items):
+            submit_lot_array(work_items)
+    else:
+        submit = submit_lots
+
+    if args.sample_sheets_only:
+        if len(unverified_lots) != 0:
+            sys.stderr.write('{} lots failed the output verification: '
+                             'run the builder to simulate them '
+                             'again\n'.format(len(unverified_lots)))
+            sys.exit(1)
+        completed_groups = scheduler.groups
+    else:
+        completed_groups = scheduler.run(submit)
 
-            completed_ids = get_completed_jobs(output_dir, lot_prefix)
-            submitted = list(completed_ids)
-            lot_ids = list(lot_ids.difference(set(completed_ids)))
+    for group in completed_groups:
+        seq_type = group.seq_type
+        purity = group.purity
+        num_of_lots = group.num_of_lots
+        zeros = group.zeros
+        log_dir = group.log_dir
 
-            while len(lot_ids) != 0:
-                completed_ids = get_completed_jobs(output_dir, lot_prefix)
+        if seq_type == 'normal':
+            with open(gender_filename, "r") as gender_file:
+                subject_gender = gender_file.read().strip('\n')
+            
+            normal_fastq_dir = os.path.join(f'{args.output_dir}', 'normal/purity_1/FASTQ')
+            lines = math.ceil(math.log10(num_of_lots+1))
+            with open(f'{sarek_dir}/sarek_normal.csv', 'w') as sarek_file:
+                sarek_file.write('patient,sex,status,sample,lane,fastq_1,fastq_2')
+                write_sarek_sample_lines(sarek_file, args.SPN, 'normal', 'normal_sample', num_of_lots, normal_fastq_dir, zeros, lines)
+            
+            job_id=seq_type
+            sarek_file_launcher_orig = sarek_file_normal_launcher
+            sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{ACCOUNT}', str(account))
+            sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{JOB_NAME}', str(job_id))
+            sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{INPUT_DIR}', str(sarek_dir))
+            sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{CONFIG}', str(config_file))
+            sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir))
+
+            with open(f'{sarek_dir}/sarek_mapping_vc_normal.sh', 'w') as outstream:
+                outstream.write(sarek_file_normal_launcher)
+            sarek_file_normal_launcher = sarek_file_launcher_orig
+
+            if not args.sample_sheets_only:
+                submit_merge(group)
+                
+        else:
+            with open(gender_filename, "r") as gender_file:
+                subject_gender = gender_file.read().strip('\n')
                 
-                to_be_submitted = (args.parallel_jobs
-                                + len(completed_ids)
-                                - len(submitted))
-
-                for i in lot_ids[:to_be_submitted]:
-                    lot_name = '{}{}'.format(lot_prefix, str(i).zfill(zeros))
-
-                    sys.stdout.write('Submitting lot {}...'.format(lot_name))
-                    sys.stdout.flush()
-
-                    cmd = ['sbatch', '--account={}'.format(account),
-                        '--partition={}'.format(args.partition),
-                        '--job-name={}_{}_{}'.format(args.SPN, purity,lot_name),
-                        ('--export=PHYLO_FOREST={},SPN={},LOT={},DEST={},'
-                            + 'COVERAGE={},TYPE={},NODE_SCRATCH={},'
-                            + 'SEED={},PURITY={},IMAGE={},DIR={}').format(args.phylogenetic_forest,
-                                                args.SPN, lot_name,
-                                                output_dir, lot_coverage,
-                                                seq_type, args.node_scratch_directory,
-                                                i, purity, args.image_path, curr_dir),
-                        '--output={}/lot_{}.log'.format(log_dir, lot_name),
-                        './ProCESS_seq.sh']
-                    if args.exclude != "":
-                        cmd.insert(-1,"--exclude={}".format(args.exclude))
-
-                    subprocess.run(cmd)
-                    sys.stdout.write('done\n')
-                    sys.stdout.flush()
-
-                if to_be_submitted>0:
-                    submitted.extend(lot_ids[:to_be_submitted])
-                    lot_ids = lot_ids[to_be_submitted:]
-                time.sleep(60)  # wait 1 minute
-            completed_ids = get_completed_jobs(output_dir, lot_prefix)
+            tumour_fastq_dir = os.path.join(f'{args.output_dir}', f'tumour/purity_{purity}/FASTQ')
+            sample_names = get_sample_names_from_FASTQ(tumour_fastq_dir)
+            lines = math.ceil(math.log10(num_of_lots*(len(sample_names)+1)))
             
-            while (len(completed_ids) != len(submitted)):
-                time.sleep(60)
-                completed_ids = get_completed_jobs(output_dir, lot_prefix)
-
-            if seq_type == 'normal':
-                with open(gender_filename, "r") as gender_file:
-                    subject_gender = gender_file.read().strip('\n')
+            for cohort_cov in cohort_coverages:
+                num_of_tumour_lots = math.ceil((cohort_cov*num_of_lots)/cohorts['tumour']['max_coverage'])
                 
-                normal_fastq_dir = os.path.join(f'{args.output_dir}', 'normal/purity_1/FASTQ')
-                lines = math.ceil(math.log10(num_of_lots+1))
-                with open(f'{sarek_dir}/sarek_normal.csv', 'w') as sarek_file:
+                with open(f'{sarek_dir}/sarek_{cohort_cov}x_{purity}p.csv', 'w') as sarek_file, open(f'{sarek_dir}/sarek_variant_calling_{cohort_cov}x_{purity}p.csv', 'w') as sarek_file_vc:
                     sarek_file.write('patient,sex,status,sample,lane,fastq_1,fastq_2')
-                    write_sarek_sample_lines(sarek_file, args.SPN, 'normal', 'normal_sample', num_of_lots, normal_fastq_dir, zeros, lines)
+                    sarek_file_vc.write('patient,sex,status,sample,cram,crai')
+                    cram_normal = os.path.join(f'{args.sarek_output_dir}', f'normal/preprocessing/recalibrated/normal_sample/normal_sample.recal.cram')
+                    crai_normal = os.path.join(f'{args.sarek_output_dir}', f'normal/preprocessing/recalibrated/normal_sample/normal_sample.recal.cram.crai')
+                    sarek_file_vc.write(f'\n{args.SPN},{subject_gender},0,normal_sample,{cram_normal},{crai_normal}')
+                    for sample_name in sample_names:
+                        write_sarek_sample_lines(sarek_file, args.SPN, 'tumour', sample_name, num_of_tumour_lots, tumour_fastq_dir, zeros, lines)
+                        write_sarek_sample_variant_calling_lines(sarek_file_vc, args.SPN, 'tumour', sample_name, args.sarek_output_dir,cohort_cov,purity)
+
+                #sarek mapping sh file
+                sarek_file_launcher_orig = sarek_file_launcher    
+                job_id=f'{cohort_cov}x_{purity}p'
+
+                sarek_file_launcher = sarek_file_launcher.replace('{ACCOUNT}', str(account))
+                sarek_file_launcher = sarek_file_launcher.replace('{JOB_NAME}', str(job_id))
+                sarek_file_launcher = sarek_file_launcher.replace('{INPUT_DIR}', str(sarek_dir))
+                sarek_file_launcher = sarek_file_launcher.replace('{CONFIG}', str(config_file))
+                sarek_file_launcher = sarek_file_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir)) 
+
+                with open(f'{sarek_dir}/sarek_mapping_{cohort_cov}x_{purity}p.sh', 'w') as outstream:
+                    outstream.write(sarek_file_launcher)
+                sarek_file_launcher = sarek_file_launcher_orig
                 
-                job_id=seq_type
-                sarek_file_launcher_orig = sarek_file_normal_launcher
-                sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{ACCOUNT}', str(account))
-                sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{JOB_NAME}', str(job_id))
-                sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{INPUT_DIR}', str(sarek_dir))
-                sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{CONFIG}', str(config_file))
-                sarek_file_normal_launcher = sarek_file_normal_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir))
-
-                with open(f'{sarek_dir}/sarek_mapping_vc_normal.sh', 'w') as outstream:
-                    outstream.write(sarek_file_normal_launcher)
-                sarek_file_normal_launcher = sarek_file_launcher_orig
-                with open('ProCESS_merge_rds.R', 'w') as outstream:
-                    outstream.write(merging_R_script)
-
-                with open('ProCESS_merge_rds.sh', 'w') as outstream:
-                    outstream.write(merging_shell_script)
-                num_of_normal_lots_list = [cohorts['normal']['max_coverage']]
-
-                lots=''
-                for l in num_of_normal_lots_list:
-                  lots = lots+' '+str(l)
-                cmd = ['sbatch', '--account={}'.format(account),
-                    '--partition={}'.format(args.partition),
-                    '--output={}/merge_normal_{}_{}_{}.log'.format(log_dir,args.SPN, 1,cohorts['normal']['max_coverage']),
-                    '--job-name=merge_normal_{}_{}_{}'.format(args.SPN, 1,cohorts['normal']['max_coverage']),
-                    ('--export=LOTS_LIST={},SPN={},INPUT_DIR={},PURITY={},TYPE={},IMAGE={},DIR={},MAX_COVERAGE={},TOT_LOTS={}').format(lots,args.SPN,
-                                                        args.output_dir,purity,seq_type,
-                                                        args.image_path, curr_dir,cohorts['normal']['max_coverage'],num_of_lots_N),
-                    './ProCESS_merge_rds.sh']
-
-                subprocess.run(cmd)
-                    
-            else:
-                with open(gender_filename, "r") as gender_file:
-                    subject_gender = gender_file.read().strip('\n')
-                    
-                tumour_fastq_dir = os.path.join(f'{args.output_dir}', f'tumour/purity_{purity}/FASTQ')
-                sample_names = get_sample_names_from_FASTQ(tumour_fastq_dir)
-                lines = math.ceil(math.log10(num_of_lots*(len(sample_names)+1)))
+                #sarek VC sh file
+                sarek_variant_calling_launcher_orig = sarek_variant_calling_launcher
+                job_id=f'{cohort_cov}x_{purity}p'
+                
+                sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{ACCOUNT}', str(account))
+                sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{JOB_NAME}', str(job_id))
+                sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{INPUT_DIR}', str(sarek_dir))
+                sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{CONFIG}', str(config_file))
+                sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir))
                 
-                for cohort_cov in cohort_coverages:
-                    num_of_tumour_lots = math.ceil((cohort_cov*num_of_lots)/cohorts['tumour']['max_coverage'])
-                    
-                    with open(f'{sarek_dir}/sarek_{cohort_cov}x_{purity}p.csv', 'w') as sarek_file, open(f'{sarek_dir}/sarek_variant_calling_{cohort_cov}x_{purity}p.csv', 'w') as sarek_file_vc:
-                        sarek_file.write('patient,sex,status,sample,lane,fastq_1,fastq_2')
-                        sarek_file_vc.write('patient,sex,status,sample,cram,crai')
-                        cram_normal = os.path.join(f'{args.sarek_output_dir}', f'normal/preprocessing/recalibrated/normal_sample/normal_sample.recal.cram')
-                        crai_normal = os.path.join(f'{args.sarek_output_dir}', f'normal/preprocessing/recalibrated/normal_sample/normal_sample.recal.cram.crai')
-                        sarek_file_vc.write(f'\n{args.SPN},{subject_gender},0,normal_sample,{cram_normal},{crai_normal}')
+                with open(f'{sarek_dir}/sarek_variant_calling_{cohort_cov}x_{purity}p.sh', 'w') as outstream:
+                    outstream.write(sarek_variant_calling_launcher)
+                sarek_variant_calling_launcher = sarek_variant_calling_launcher_orig
+                
+                #sequenza sh file
+                sequenza_launcher_orig = sequenza_launcher
+                job_id=f'{cohort_cov}x_{purity}p'
+                process_path = '/'.join(str(config_file).split('/')[:-2]) + '/sequenza'
+                
+                sequenza_launcher = sequenza_launcher.replace('{ACCOUNT}', str(account))
+                sequenza_launcher = sequenza_launcher.replace('{JOB_NAME}', str(job_id))
+                sequenza_launcher = sequenza_launcher.replace('{INPUT_DIR}', str(sarek_dir))
+                sequenza_launcher = sequenza_launcher.replace('{CONFIG}', str(config_file))
+                sequenza_launcher = sequenza_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir))
+                sequenza_launcher = sequenza_launcher.replace('{PROCESS_DIR}', str(process_path))
+
+                
+                with open(f'{sarek_dir}/sequenza_{cohort_cov}x_{purity}p.sh', 'w') as outstream:
+                    outstream.write(sequenza_launcher)
+                sequenza_launcher = sequenza_launcher_orig
+                
+                #tumourevo sh file and csv file
+                variant_callers = ['freebayes', 'strelka', 'mutect2']
+                cn_caller = 'ascat'
+                combinations = []
+                for vc in variant_callers:
+                        combinations.append([vc, cn_caller])
+                
+                for comb in combinations:
+                    vc = comb[0]
+                    cc = comb[1]
+                    with open(f'{tumourevo_dir}/tumourevo_{cohort_cov}x_{purity}p_{vc}_{cc}.csv', 'w') as tumourevo_file:
+                        if comb[0] == 'mutect2':
+                            tumourevo_file.write('dataset,patient,tumour_sample,normal_sample,vcf,tbi,cna_segments,cna_extra,cna_caller,cancer_type')
+                        else:
+                            tumourevo_file.write('dataset,patient,tumour_sample,normal_sample,vcf,tbi,cna_segments,cna_extra,cna_caller,cancer_type,tumour_alignment,tumour_alignment_index')
+                            
                         for sample_name in sample_names:
-                            write_sarek_sample_lines(sarek_file, args.SPN, 'tumour', sample_name, num_of_tumour_lots, tumour_fastq_dir, zeros, lines)
-                            write_sarek_sample_variant_calling_lines(sarek_file_vc, args.SPN, 'tumour', sample_name, args.sarek_output_dir,cohort_cov,purity)
-
-                    #sarek mapping sh file
-                    sarek_file_launcher_orig = sarek_file_launcher    
-                    job_id=f'{cohort_cov}x_{purity}p'
-
-                    sarek_file_launcher = sarek_file_launcher.replace('{ACCOUNT}', str(account))
-                    sarek_file_launcher = sarek_file_launcher.replace('{JOB_NAME}', str(job_id))
-                    sarek_file_launcher = sarek_file_launcher.replace('{INPUT_DIR}', str(sarek_dir))
-                    sarek_file_launcher = sarek_file_launcher.replace('{CONFIG}', str(config_file))
-                    sarek_file_launcher = sarek_file_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir)) 
-
-                    with open(f'{sarek_dir}/sarek_mapping_{cohort_cov}x_{purity}p.sh', 'w') as outstream:
-                        outstream.write(sarek_file_launcher)
-                    sarek_file_launcher = sarek_file_launcher_orig
-                    
-                    #sarek VC sh file
-                    sarek_variant_calling_launcher_orig = sarek_variant_calling_launcher
-                    job_id=f'{cohort_cov}x_{purity}p'
-                    
-                    sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{ACCOUNT}', str(account))
-                    sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{JOB_NAME}', str(job_id))
-                    sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{INPUT_DIR}', str(sarek_dir))
-                    sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{CONFIG}', str(config_file))
-                    sarek_variant_calling_launcher = sarek_variant_calling_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir))
-                    
-                    with open(f'{sarek_dir}/sarek_variant_calling_{cohort_cov}x_{purity}p.sh', 'w') as outstream:
-                        outstream.write(sarek_variant_calling_launcher)
-                    sarek_variant_calling_launcher = sarek_variant_calling_launcher_orig
-                    
-                    #sequenza sh file
-                    sequenza_launcher_orig = sequenza_launcher
-                    job_id=f'{cohort_cov}x_{purity}p'
-                    process_path = '/'.join(str(config_file).split('/')[:-2]) + '/sequenza'
-                    
-                    sequenza_launcher = sequenza_launcher.replace('{ACCOUNT}', str(account))
-                    sequenza_launcher = sequenza_launcher.replace('{JOB_NAME}', str(job_id))
-                    sequenza_launcher = sequenza_launcher.replace('{INPUT_DIR}', str(sarek_dir))
-                    sequenza_launcher = sequenza_launcher.replace('{CONFIG}', str(config_file))
-                    sequenza_launcher = sequenza_launcher.replace('{SAREK_OUT}', str(args.sarek_output_dir))
-                    sequenza_launcher = sequenza_launcher.replace('{PROCESS_DIR}', str(process_path))
-
-                    
-                    with open(f'{sarek_dir}/sequenza_{cohort_cov}x_{purity}p.sh', 'w') as outstream:
-                        outstream.write(sequenza_launcher)
-                    sequenza_launcher = sequenza_launcher_orig
-                    
-                    #tumourevo sh file and csv file
-                    variant_callers = ['freebayes', 'strelka', 'mutect2']
-                    cn_caller = 'ascat'
-                    combinations = []
-                    for vc in variant_callers:
-                            combinations.append([vc, cn_caller])
-                    
-                    for comb in combinations:
-                        vc = comb[0]
-                        cc = comb[1]
-                        with open(f'{tumourevo_dir}/tumourevo_{cohort_cov}x_{purity}p_{vc}_{cc}.csv', 'w') as tumourevo_file:
-                            if comb[0] == 'mutect2':
-                                tumourevo_file.write('dataset,patient,tumour_sample,normal_sample,vcf,tbi,cna_segments,cna_extra,cna_caller,cancer_type')
-                            else:
-                                tumourevo_file.write('dataset,patient,tumour_sample,normal_sample,vcf,tbi,cna_segments,cna_extra,cna_caller,cancer_type,tumour_alignment,tumour_alignment_index')
-                                
-                            for sample_name in sample_names:
-                                write_tumourevo_lines(tumourevo_file, args.SPN, sample_name, comb, cohort_cov, purity, args.sarek_output_dir)
-                    
-                        tumourevo_launcher_orig = tumourevo_launcher
-                        job_id=f'{cohort_cov}x_{purity}p_{vc}_{cc}'
-                        tumourevo_launcher = tumourevo_launcher.replace('{ACCOUNT}', str(account))
-                        tumourevo_launcher = tumourevo_launcher.replace('{JOB_NAME}', str(job_id))
-                        tumourevo_launcher = tumourevo_launcher.replace('{INPUT_DIR}', str(tumourevo_dir))
-                        tumourevo_launcher = tumourevo_launcher.replace('{CONFIG}', str(config_file))
-                        tumourevo_launcher = tumourevo_launcher.replace('{TUMOUREVO_OUT}', str(args.tumourevo_output_dir))
-
-
-                        with open(f'{tumourevo_dir}/tumourevo_{cohort_cov}x_{purity}p_{vc}_{cc}.sh', 'w') as outstream:
-                            outstream.write(tumourevo_launcher)
-                        tumourevo_launcher = tumourevo_launcher_orig
-                    
-                with open('ProCESS_merge_rds.R', 'w') as outstream:
-                  outstream.write(merging_R_script)
-
-                with open('ProCESS_merge_rds.sh', 'w') as outstream:
-                  outstream.write(merging_shell_script)
+                            write_tumourevo_lines(tumourevo_file, args.SPN, sample_name, comb, cohort_cov, purity, args.sarek_output_dir)
                 
-                num_of_tumour_lots_list = [math.ceil((cohort_cov*num_of_lots)/cohorts['tumour']['max_coverage']) for cohort_cov in cohort_coverages]
-               
-                lots=''
-                for l in num_of_tumour_lots_list:
-                  lots = lots+' '+str(l)
+                    tumourevo_launcher_orig = tumourevo_launcher
+                    job_id=f'{cohort_cov}x_{purity}p_{vc}_{cc}'
+                    tumourevo_launcher = tumourevo_launcher.replace('{ACCOUNT}', str(account))
+                    tumourevo_launcher = tumourevo_launcher.replace('{JOB_NAME}', str(job_id))
+                    tumourevo_launcher = tumourevo_launcher.replace('{INPUT_DIR}', str(tumourevo_dir))
+                    tumourevo_launcher = tumourevo_launcher.replace('{CONFIG}', str(config_file))
+                    tumourevo_launcher = tumourevo_launcher.replace('{TUMOUREVO_OUT}', str(args.tumourevo_output_dir))
+
+
+                    with open(f'{tumourevo_dir}/tumourevo_{cohort_cov}x_{purity}p_{vc}_{cc}.sh', 'w') as outstream:
+                        outstream.write(tumourevo_launcher)
+                    tumourevo_launcher = tumourevo_launcher_orig
                 
-                cmd = ['sbatch', '--account={}'.format(account),
-                    '--partition={}'.format(args.partition),
-                    '--output={}/merge_tumour_{}_{}_{}.log'.format(log_dir,args.SPN, purity,cohorts['tumour']['max_coverage']),
-                    '--job-name=merge_tumour_{}_{}_{}'.format(args.SPN, purity,cohorts['tumour']['max_coverage']),
-                    ('--export=LOTS_LIST={},SPN={},INPUT_DIR={},PURITY={},TYPE={},IMAGE={},DIR={},MAX_COVERAGE={},TOT_LOTS={}').format(lots,args.SPN,
-                                                        args.output_dir,purity,seq_type,
-                                                        args.image_path, curr_dir,cohorts['tumour']['max_coverage'],num_of_lots_T),
-                    './ProCESS_merge_rds.sh']
-                subprocess.run(cmd)
+            if not args.sample_sheets_only:
+                submit_merge(group)
+
+    if pool is not None:
+        pool.shutdown()
+    executor.shutdown()
+
+    if len(scheduler.failed) != 0:
+        write_failed_lots(scheduler.failed)
+        sys.exit(1)
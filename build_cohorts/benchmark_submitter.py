@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+
+from fake_slurm import FakeSlurm, install_commands
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(fraction*len(values)))]
+
+
+def get_idle_gaps(intervals):
+    intervals = sorted(intervals)
+    gaps = list()
+    covered_up_to = intervals[0][1]
+    for start, end in intervals[1:]:
+        if start > covered_up_to:
+            gaps.append(start-covered_up_to)
+        covered_up_to = max(covered_up_to, end)
+    return gaps
+
+
+def collect_metrics(records, slots):
+    # the worker jobs and the packed lot jobs record the lots they
+    # simulated
+    lot_records = [record for record in records
+                   if record.get('lot') is not None and 'end_time' in record
+                   and 'start_time' in record and 'pack_lots' not in record]
+    for record in records:
+        lot_records.extend(record.get('pack_lots', list()))
+        lot_records.extend(record.get('worker_lots', list()))
+    if len(lot_records) == 0:
+        return None
+
+    first_submit = min(record['submit_time'] for record in records)
+    last_end = max(record['end_time'] for record in lot_records)
+    makespan = last_end - first_submit
+
+    busy_time = sum(record['end_time']-record['start_time']
+                    for record in lot_records)
+
+    # the time between the end of a lot and the submission of the
+    # lot that replaces it
+    ends = sorted(record['end_time'] for record in lot_records)
+    refill_latencies = list()
+    for record in lot_records:
+        previous_ends = [end for end in ends if end <= record['submit_time']]
+        if len(previous_ends) != 0:
+            refill_latencies.append(record['submit_time']-previous_ends[-1])
+
+    sbatch_seconds = [record['sbatch_seconds'] for record in records
+                      if 'sbatch_seconds' in record]
+    queue_waits = [record['start_time']-record['submit_time']
+                   for record in lot_records]
+
+    purities = dict()
+    for record in lot_records:
+        key = '{} {}'.format(record['lot']['type'], record['lot']['purity'])
+        purities.setdefault(key, list()).append((record['start_time'],
+                                                 record['end_time']))
+
+    purity_metrics = dict()
+    for key, intervals in sorted(purities.items()):
+        gaps = get_idle_gaps(intervals)
+        purity_metrics[key] = {
+            'lots': len(intervals),
+            'first_start': min(start for start, _ in intervals)-first_submit,
+            'last_end': max(end for _, end in intervals)-first_submit,
+            'idle_gaps': len(gaps),
+            'total_idle_gap': sum(gaps),
+            'max_idle_gap': max(gaps, default=0)
+        }
+
+    return {
+        'lots': len(lot_records),
+        'makespan': makespan,
+        'slot_utilisation': busy_time/(slots*makespan) if makespan > 0 else 0,
+        'sbatch_latency_mean': sum(sbatch_seconds)/max(1, len(sbatch_seconds)),
+        'sbatch_latency_max': max(sbatch_seconds, default=0),
+        'refill_latency_mean': sum(refill_latencies)/max(1, len(refill_latencies)),
+        'refill_latency_p95': percentile(refill_latencies, 0.95),
+        'refill_latency_max': max(refill_latencies, default=0),
+        'queue_wait_mean': sum(queue_waits)/len(queue_waits),
+        'purities': purity_metrics
+    }
+
+
+def write_report(metrics, outstream):
+    outstream.write('lots:                {}\n'.format(metrics['lots']))
+    outstream.write('makespan:            {:.2f}s\n'.format(metrics['makespan']))
+    outstream.write('slot utilisation:    {:.1%}\n'.format(metrics['slot_utilisation']))
+    outstream.write('sbatch latency:      mean {:.3f}s, max {:.3f}s\n'.format(
+        metrics['sbatch_latency_mean'], metrics['sbatch_latency_max']))
+    outstream.write('refill latency:      mean {:.2f}s, p95 {:.2f}s, max {:.2f}s\n'.format(
+        metrics['refill_latency_mean'], metrics['refill_latency_p95'],
+        metrics['refill_latency_max']))
+    outstream.write('queue wait:          mean {:.2f}s\n\n'.format(metrics['queue_wait_mean']))
+
+    outstream.write('{:<20} {:>5} {:>12} {:>12} {:>6} {:>12} {:>12}\n'.format(
+        'purity', 'lots', 'first start', 'last end', 'gaps',
+        'total gap', 'max gap'))
+    for key, purity_metrics in metrics['purities'].items():
+        outstream.write('{:<20} {:>5} {:>11.2f}s {:>11.2f}s {:>6} {:>11.2f}s {:>11.2f}s\n'.format(
+            key, purity_metrics['lots'], purity_metrics['first_start'],
+            purity_metrics['last_end'], purity_metrics['idle_gaps'],
+            purity_metrics['total_idle_gap'], purity_metrics['max_idle_gap']))
+
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(prog=sys.argv[0],
+                                     description=('Measures the throughput of a '
+                                                  + 'cohort builder on a local '
+                                                  + 'stand-in of Slurm'))
+    parser.add_argument('builder_args', nargs='*',
+                        help=("The additional builder parameters (to be "
+                              + "given after \"--\")"))
+    parser.add_argument('-b', '--builder', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'build_cohort.py'),
+                        help="The cohort builder (default: build_cohort.py)")
+    parser.add_argument('-s', '--slots', type=int, default=40,
+                        help="The number of job slots of the fake cluster")
+    parser.add_argument('-m', '--mode', choices=['model', 'run'],
+                        default='model',
+                        help=("Either sleep for the times of the timing "
+                              + "model (\"model\") or run the job scripts "
+                              + "(\"run\") (default: model)"))
+    parser.add_argument('-T', '--timing_model', type=str, default=None,
+                        help=("A JSON timing model (default: the one in "
+                              + "fake_slurm.py)"))
+    parser.add_argument('-t', '--time_scale', type=float, default=0.001,
+                        help=("The factor applied to the timing model "
+                              + "durations (default: 0.001)"))
+    parser.add_argument('-w', '--work_dir', type=str, default=None,
+                        help=("The directory in which the builder is run "
+                              + "(default: a new temporary directory)"))
+    parser.add_argument('--seed', type=int, default=0,
+                        help="The seed of the timing model")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="A JSON file for the collected metrics")
+
+    args = parser.parse_args()
+
+    if args.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='benchmark_submitter_')
+    else:
+        work_dir = os.path.abspath(args.work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+
+    state_dir = os.path.join(work_dir, 'fake_slurm')
+    bin_dir = os.path.join(work_dir, 'bin')
+    install_commands(bin_dir, state_dir)
+
+    phylogenetic_forest = os.path.join(work_dir, 'phylo_forest.sff')
+    open(phylogenetic_forest, 'a').close()
+
+    env = dict(os.environ,
+               PATH='{}:{}'.format(bin_dir, os.environ.get('PATH', '')),
+               FAKE_SLURM_DIR=state_dir,
+               FAKE_SLURM_SLOTS=str(args.slots),
+               FAKE_SLURM_MODE=args.mode,
+               FAKE_SLURM_TIME_SCALE=str(args.time_scale),
+               FAKE_SLURM_SEED=str(args.seed))
+    if args.timing_model is not None:
+        env['FAKE_SLURM_MODEL'] = os.path.abspath(args.timing_model)
+
+    cmd = [sys.executable, os.path.abspath(args.builder), 'SPN01',
+           phylogenetic_forest, os.path.join(work_dir, 'cohort'),
+           '-P', 'fake', '-A', 'fake'] + args.builder_args
+
+    sys.stdout.write('Running {} in {}\n'.format(os.path.basename(args.builder),
+                                                 work_dir))
+    sys.stdout.flush()
+
+    start = time.time()
+    with open(os.path.join(work_dir, 'builder.log'), 'w') as log:
+        process = subprocess.run(cmd, env=env, cwd=work_dir, stdout=log,
+                                 stderr=subprocess.STDOUT)
+    builder_time = time.time()-start
+
+    if process.returncode != 0:
+        sys.stderr.write('The builder failed: see {}\n'.format(
+            os.path.join(work_dir, 'builder.log')))
+        sys.exit(process.returncode)
+
+    # the builder may exit before its jobs complete, e.g., in DAG mode
+    fake_slurm = FakeSlurm(state_dir)
+    while any(record['state'] in ['PENDING', 'RUNNING']
+              for record in fake_slurm.records()):
+        time.sleep(1)
+    total_time = time.time()-start
+
+    records = fake_slurm.records()
+    metrics = collect_metrics(records, args.slots)
+    if metrics is None:
+        sys.stderr.write('No lot was run\n')
+        sys.exit(1)
+    metrics['builder_time'] = builder_time
+    metrics['total_time'] = total_time
+
+    sys.stdout.write('builder time:        {:.2f}s\n'.format(builder_time))
+    sys.stdout.write('total time:          {:.2f}s\n'.format(total_time))
+    write_report(metrics, sys.stdout)
+
+    if args.output is not None:
+        with open(args.output, 'w') as outstream:
+            json.dump(metrics, outstream, indent=2)
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import time
+import shlex
+import socket
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+
+failed_job_states = ['FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL',
+                     'CANCELLED', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+
+# the states of the jobs that may still be running some process
+active_job_states = ['PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING',
+                     'SUSPENDED', 'REQUEUED', 'RESIZING']
+
+
+class SlurmExecutor:
+    """Submits the job scripts to Slurm by using ``sbatch``."""
+
+    def __init__(self, account, partition):
+        self.account = account
+        self.partition = partition
+
+    def submit(self, script, job_name=None, env=None, output=None,
+               array=None, dependencies=None, options=None):
+        cmd = ['sbatch', '--parsable',
+               '--account={}'.format(self.account),
+               '--partition={}'.format(self.partition)]
+        if job_name is not None:
+            cmd.append('--job-name={}'.format(job_name))
+        if array is not None:
+            cmd.append('--array={}'.format(array))
+        if dependencies is not None and len(dependencies) != 0:
+            cmd.append('--dependency=afterok:{}'.format(':'.join(dependencies)))
+        if env is not None and len(env) != 0:
+            cmd.append('--export={}'.format(','.join(f'{key}={value}'
+                                                      for key, value in env.items())))
+        if output is not None:
+            cmd.append('--output={}'.format(output))
+        if options is not None:
+            cmd.extend(options)
+        cmd.append(script)
+
+        result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        job_id = result.stdout.decode().strip().split(';')[0]
+        if result.returncode != 0 or job_id == '':
+            raise RuntimeError('sbatch failed to submit {}: {}'.format(
+                script, result.stderr.decode().strip()))
+        return job_id
+
+    def wait(self, job_id, poll_interval=30):
+        while True:
+            result = subprocess.run(['squeue', '-h', '-j', job_id],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            if result.stdout.decode().strip() == '':
+                return
+            time.sleep(poll_interval)
+
+    def get_states(self, job_ids):
+        """Returns the Slurm state and the node of each of the given jobs.
+
+        The jobs unknown to ``sacct`` (e.g., the pending tasks of an array)
+        are omitted.
+        """
+        states = dict()
+        job_ids = list(job_ids)
+        for i in range(0, len(job_ids), 100):
+            result = subprocess.run(['sacct', '-n', '-X', '-P',
+                                     '--format=JobID,State,NodeList',
+                                     '-j', ','.join(job_ids[i:i+100])],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            for line in result.stdout.decode().splitlines():
+                fields = line.split('|')
+                if len(fields) == 3 and fields[1] != '':
+                    states[fields[0]] = (fields[1].split()[0], fields[2])
+        return states
+
+    def cancel(self, job_id):
+        subprocess.run(['scancel', job_id], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    def shutdown(self):
+        pass
+
+
+def get_script_cpus(script, options=None):
+    cpus = 1
+    with open(script, 'r') as script_file:
+        for line in script_file:
+            match = re.match(r'#SBATCH\s+--cpus-per-task[= ](\d+)', line)
+            if match:
+                cpus = int(match.group(1))
+    if options is not None:
+        for option in options:
+            match = re.match(r'--cpus-per-task=(\d+)', option)
+            if match:
+                cpus = int(match.group(1))
+    return cpus
+
+
+def expand_output_pattern(output, job_id, task_id):
+    array_job_id, _, array_task_id = str(task_id).partition('_')
+    output = output.replace('%A', array_job_id).replace('%a', array_task_id)
+    return output.replace('%J', str(task_id)).replace('%j', str(task_id))
+
+
+def run_job_script(script, env, output, cwd):
+    if output is None:
+        output = os.devnull
+    with open(output, 'a') as log:
+        process = subprocess.run(['bash', script], env=env, cwd=cwd,
+                                 stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode
+
+
+class LocalExecutor:
+    """Runs the job scripts on this machine by using a process pool.
+
+    The scripts are run by ``bash`` with the same environment variables
+    that Slurm would set, e.g., ``SLURM_JOB_ID``, ``SLURM_CPUS_PER_TASK``,
+    and ``SLURM_ARRAY_TASK_ID``. A job starts as soon as the CPUs it
+    requires, i.e., its ``--cpus-per-task``, are available and all its
+    dependencies completed successfully; if one of its dependencies
+    fails, the job is cancelled as Slurm does.
+    """
+
+    def __init__(self, max_cpus=None):
+        if max_cpus is None:
+            max_cpus = os.cpu_count()
+        self.max_cpus = max_cpus
+        self.free_cpus = max_cpus
+        self.pool = ProcessPoolExecutor(max_workers=max_cpus)
+        self.condition = threading.Condition()
+        self.queue = list()
+        self.states = dict()
+        self.arrays = dict()
+        self.next_job_id = 1
+
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, script, job_name=None, env=None, output=None,
+               array=None, dependencies=None, options=None):
+        cpus = min(get_script_cpus(script, options), self.max_cpus)
+
+        job_env = dict(os.environ)
+        if env is not None:
+            job_env.update({key: str(value) for key, value in env.items()})
+        if job_name is not None:
+            job_env['SLURM_JOB_NAME'] = job_name
+        job_env['SLURM_CPUS_PER_TASK'] = str(cpus)
+
+        with self.condition:
+            job_id = str(self.next_job_id)
+            self.next_job_id += 1
+
+            if array is None:
+                tasks = [(job_id, None)]
+            else:
+                indices, _, throttle = array.partition('%')
+                throttle = int(throttle) if throttle != '' else None
+                tasks = [(f'{job_id}_{index}', index)
+                         for index in expand_array_indices(indices)]
+                self.arrays[job_id] = (list(task_id for task_id, _ in tasks),
+                                       throttle)
+
+            for task_id, index in tasks:
+                task_env = dict(job_env)
+                task_env['SLURM_JOB_ID'] = task_id
+                if index is not None:
+                    task_env['SLURM_ARRAY_JOB_ID'] = job_id
+                    task_env['SLURM_ARRAY_TASK_ID'] = str(index)
+                task_output = output
+                if output is not None:
+                    task_output = expand_output_pattern(output, job_id,
+                                                        task_id)
+                self.states[task_id] = 'PENDING'
+                self.queue.append({'id': task_id, 'script': script,
+                                   'env': task_env, 'output': task_output,
+                                   'cwd': os.getcwd(), 'cpus': cpus,
+                                   'array': job_id if index is not None else None,
+                                   'dependencies': list(dependencies or [])})
+            self.condition.notify_all()
+
+        return job_id
+
+    def get_state(self, job_id):
+        with self.condition:
+            return self._get_state(job_id)
+
+    def _get_state(self, job_id):
+        if job_id in self.arrays:
+            states = [self.states[task_id]
+                      for task_id in self.arrays[job_id][0]]
+            for state in ['RUNNING', 'PENDING', 'FAILED', 'CANCELLED']:
+                if state in states:
+                    return state
+            return 'COMPLETED'
+        return self.states.get(job_id, 'COMPLETED')
+
+    def get_states(self, job_ids):
+        hostname = socket.gethostname()
+        with self.condition:
+            return {job_id: (self.states[job_id], hostname)
+                    for job_id in job_ids if job_id in self.states}
+
+    def cancel(self, job_id):
+        """Cancels a job, unless it is already running."""
+        with self.condition:
+            for task in list(self.queue):
+                if task['id'] == job_id or task['array'] == job_id:
+                    self.queue.remove(task)
+                    self.states[task['id']] = 'CANCELLED'
+            self.condition.notify_all()
+
+    def wait(self, job_id):
+        with self.condition:
+            while self._get_state(job_id) in ['PENDING', 'RUNNING']:
+                self.condition.wait()
+
+    def _running_array_tasks(self, array_id):
+        return sum(1 for task_id in self.arrays[array_id][0]
+                   if self.states[task_id] == 'RUNNING')
+
+    def _dispatch(self):
+        with self.condition:
+            while True:
+                for task in list(self.queue):
+                    dependency_states = [self._get_state(dependency)
+                                         for dependency in task['dependencies']]
+                    if any(state in ['FAILED', 'CANCELLED']
+                           for state in dependency_states):
+                        self.states[task['id']] = 'CANCELLED'
+                        self.queue.remove(task)
+                        continue
+                    if any(state != 'COMPLETED' for state in dependency_states):
+                        continue
+                    if task['cpus'] > self.free_cpus:
+                        continue
+                    if task['array'] is not None:
+                        throttle = self.arrays[task['array']][1]
+                        if (throttle is not None
+                                and self._running_array_tasks(task['array']) >= throttle):
+                            continue
+
+                    self.queue.remove(task)
+                    self.free_cpus -= task['cpus']
+                    self.states[task['id']] = 'RUNNING'
+                    future = self.pool.submit(run_job_script, task['script'],
+                                              task['env'], task['output'],
+                                              task['cwd'])
+                    future.add_done_callback(
+                        lambda future, task=task: self._done(task, future))
+                self.condition.wait()
+
+    def _done(self, task, future):
+        with self.condition:
+            if future.exception() is None and future.result() == 0:
+                self.states[task['id']] = 'COMPLETED'
+            else:
+                self.states[task['id']] = 'FAILED'
+            self.free_cpus += task['cpus']
+            self.condition.notify_all()
+
+    def shutdown(self):
+        with self.condition:
+            while (len(self.queue) != 0
+                   or any(state == 'RUNNING' for state in self.states.values())):
+                self.condition.wait()
+        self.pool.shutdown()
+
+
+def expand_array_indices(indices):
+    expanded = list()
+    for index_range in indices.split(','):
+        first, _, last = index_range.partition('-')
+        if last == '':
+            expanded.append(int(first))
+        else:
+            expanded.extend(range(int(first), int(last)+1))
+    return expanded
+
+
+command_shell_script="""#!/bin/bash
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=1
+#SBATCH --time=2:00:00
+#SBATCH --mem=8GB
+
+cd {DIR}
+
+{COMMAND}
+"""
+
+
+def write_command_script(script_filename, cmd):
+    """Writes a job script that runs ``cmd`` in the current directory."""
+    with open(script_filename, 'w') as outstream:
+        outstream.write(command_shell_script.replace('{DIR}', shlex.quote(os.getcwd()))
+                                            .replace('{COMMAND}', shlex.join(cmd)))
+
+
+def get_follow_up_command(removed_flags, added_flags):
+    """Returns the command line of this script with a different set of flags."""
+    cmd = ['python3', os.path.abspath(sys.argv[0])]
+    cmd.extend(arg for arg in sys.argv[1:] if arg not in removed_flags)
+    return cmd + added_flags
+
+
+def add_executor_arguments(parser):
+    parser.add_argument('-E', '--executor', choices=['slurm', 'local'],
+                        default='slurm',
+                        help=("The job execution backend: \"slurm\" submits "
+                              + "the jobs by using sbatch, \"local\" runs "
+                              + "them on this machine (default: slurm)"))
+    parser.add_argument('--local_cpus', type=int, default=None,
+                        help=("The number of CPUs used by the local "
+                              + "executor (default: all the CPUs)"))
+
+
+def create_executor(args, account):
+    if args.executor == 'local':
+        sys.stdout.write('Running the jobs on this machine\n')
+        sys.stdout.flush()
+        return LocalExecutor(args.local_cpus)
+    return SlurmExecutor(account, args.partition)
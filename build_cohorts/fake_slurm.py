@@ -0,0 +1,642 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import signal
+import socket
+import fnmatch
+import datetime
+import subprocess
+
+default_model = {
+    'lots': {
+        't*': {'mean': 3600, 'sd': 600},
+        'n*': {'mean': 1800, 'sd': 300}
+    },
+    'jobs': {
+        '*': {'mean': 60, 'sd': 10}
+    },
+    'lot_startup': 0,
+    'failure_rate': 0,
+    'samples': ['Sample_A', 'Sample_B']
+}
+
+active_states = ['PENDING', 'RUNNING']
+
+
+class FakeSlurm:
+    """A local stand-in for the Slurm commands used by the cohort builders.
+
+    Every job, or job array task, is run by a detached runner process
+    that waits for its dependencies and for one of the ``slots`` of the
+    fake cluster, and then either runs the job script by ``bash`` (the
+    ``run`` mode) or sleeps for a time drawn from the timing model and
+    emulates the job outputs (the ``model`` mode). In the ``model`` mode,
+    a job simulating several lots pays the ``lot_startup`` time once and
+    then runs its lots back to back, and a ``ProCESS_worker.sh`` job pays
+    it once and then runs the lots requested in its worker directory until
+    it is stopped. The job records are stored as JSON files in
+    ``state_dir``.
+    """
+
+    def __init__(self, state_dir, slots=40, mode='run', model=None,
+                 time_scale=1, seed=0):
+        self.state_dir = state_dir
+        self.slots = slots
+        self.mode = mode
+        self.model = dict(default_model)
+        if model is not None:
+            self.model.update(model)
+        self.time_scale = time_scale
+        self.seed = seed
+
+        for subdir in ['jobs', 'locks']:
+            os.makedirs(os.path.join(state_dir, subdir), exist_ok=True)
+
+    @staticmethod
+    def from_environment():
+        state_dir = os.environ.get('FAKE_SLURM_DIR')
+        if state_dir is None:
+            raise RuntimeError('FAKE_SLURM_DIR is not set')
+        model = None
+        if os.environ.get('FAKE_SLURM_MODEL', '') != '':
+            with open(os.environ['FAKE_SLURM_MODEL'], 'r') as model_file:
+                model = json.load(model_file)
+        return FakeSlurm(state_dir,
+                         slots=int(os.environ.get('FAKE_SLURM_SLOTS', 40)),
+                         mode=os.environ.get('FAKE_SLURM_MODE', 'run'),
+                         model=model,
+                         time_scale=float(os.environ.get('FAKE_SLURM_TIME_SCALE', 1)),
+                         seed=int(os.environ.get('FAKE_SLURM_SEED', 0)))
+
+    def _record_filename(self, task_id):
+        return os.path.join(self.state_dir, 'jobs', f'{task_id}.json')
+
+    def _new_job_id(self):
+        with open(os.path.join(self.state_dir, 'next_id'), 'a+') as id_file:
+            fcntl.flock(id_file, fcntl.LOCK_EX)
+            id_file.seek(0)
+            content = id_file.read().strip()
+            job_id = int(content) if content != '' else 1
+            id_file.seek(0)
+            id_file.truncate()
+            id_file.write(str(job_id+1))
+        return str(job_id)
+
+    def read_record(self, task_id):
+        with open(self._record_filename(task_id), 'r') as record_file:
+            return json.load(record_file)
+
+    def update_record(self, task_id, **fields):
+        filename = self._record_filename(task_id)
+        with open(filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            record = dict()
+            if os.path.exists(filename):
+                record = self.read_record(task_id)
+            if record.get('state') == 'CANCELLED' and 'state' in fields:
+                fields = {key: value for key, value in fields.items()
+                          if key not in ['state', 'exit_code']}
+            record.update(fields)
+            with open(filename + '.tmp', 'w') as record_file:
+                json.dump(record, record_file)
+            os.replace(filename + '.tmp', filename)
+        return record
+
+    def records(self):
+        records = list()
+        jobs_dir = os.path.join(self.state_dir, 'jobs')
+        for filename in os.listdir(jobs_dir):
+            if filename.endswith('.json'):
+                with open(os.path.join(jobs_dir, filename), 'r') as record_file:
+                    records.append(json.load(record_file))
+        return sorted(records, key=lambda record: (int(record['job_id']),
+                                                   record.get('array_task', -1)))
+
+    def select_records(self, job_ids=None):
+        if job_ids is None:
+            return self.records()
+        return [record for record in self.records()
+                if record['id'] in job_ids or record['job_id'] in job_ids]
+
+    def get_state(self, job_id):
+        filenames = [self._record_filename(job_id)]
+        if not os.path.exists(filenames[0]):
+            jobs_dir = os.path.join(self.state_dir, 'jobs')
+            filenames = [os.path.join(jobs_dir, filename)
+                         for filename in os.listdir(jobs_dir)
+                         if (filename.startswith(f'{job_id}_')
+                             and filename.endswith('.json'))]
+        states = list()
+        for filename in filenames:
+            with open(filename, 'r') as record_file:
+                states.append(json.load(record_file)['state'])
+        if len(states) == 0:
+            return None
+        for state in ['RUNNING', 'PENDING', 'FAILED', 'TIMEOUT', 'CANCELLED']:
+            if state in states:
+                return state
+        return 'COMPLETED'
+
+    def submit(self, script, options, script_args=list()):
+        submit_time = time.time()
+        job_id = self._new_job_id()
+
+        env = dict(os.environ)
+        export = options.get('export', 'ALL')
+        if export not in ['ALL', 'NONE']:
+            for assignment in export.split(','):
+                key, _, value = assignment.partition('=')
+                if key != 'ALL':
+                    env[key] = value
+
+        dependencies = list()
+        if 'dependency' in options:
+            for dependency in options['dependency'].split(','):
+                kind, _, ids = dependency.partition(':')
+                if kind != 'afterok':
+                    raise RuntimeError(f'Unsupported dependency "{kind}"')
+                dependencies.extend(ids.split(':'))
+
+        if 'array' in options:
+            indices, _, throttle = options['array'].partition('%')
+            throttle = int(throttle) if throttle != '' else None
+            tasks = [(f'{job_id}_{index}', index)
+                     for index in expand_array_indices(indices)]
+        else:
+            throttle = None
+            tasks = [(job_id, None)]
+
+        exclude = list()
+        if options.get('exclude', '') != '':
+            exclude = options['exclude'].split(',')
+
+        for task_id, index in tasks:
+            output = options.get('output', f'slurm-{task_id}.out')
+            if index is not None:
+                output = output.replace('%A', job_id).replace('%a', str(index))
+            output = output.replace('%j', task_id).replace('%J', task_id)
+
+            self.update_record(task_id, id=task_id, job_id=job_id,
+                               array_task=index, throttle=throttle,
+                               name=options.get('job-name', os.path.basename(script)),
+                               script=os.path.abspath(script),
+                               script_args=script_args, env=env,
+                               cwd=os.getcwd(), output=os.path.abspath(output),
+                               dependencies=dependencies, exclude=exclude,
+                               state='PENDING', submit_time=submit_time)
+
+        # a single detached process starts the task runners, so that
+        # sbatch returns as soon as the job records are written
+        self._spawn('_launch', job_id)
+
+        self.update_record(tasks[0][0], sbatch_seconds=time.time()-submit_time)
+        return job_id
+
+    def _spawn(self, command, job_id):
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          command, job_id],
+                         env=dict(os.environ, FAKE_SLURM_DIR=self.state_dir,
+                                  FAKE_SLURM_SLOTS=str(self.slots),
+                                  FAKE_SLURM_MODE=self.mode,
+                                  FAKE_SLURM_TIME_SCALE=str(self.time_scale),
+                                  FAKE_SLURM_SEED=str(self.seed)),
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    def launch(self, job_id):
+        for record in self.select_records([job_id]):
+            self._spawn('_run', record['id'])
+
+    def cancel(self, job_ids):
+        for record in self.select_records(job_ids):
+            if record['state'] not in active_states:
+                continue
+            self.update_record(record['id'], state='CANCELLED',
+                               end_time=time.time())
+            if 'runner_pid' in record:
+                try:
+                    os.killpg(record['runner_pid'], signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def _node_name(self, slot):
+        return 'node{}'.format(str(slot).zfill(len(str(self.slots-1))))
+
+    def _try_lock(self, lock_filename):
+        lock_file = open(lock_filename, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _acquire_slot(self, record):
+        locks_dir = os.path.join(self.state_dir, 'locks')
+        throttle_lock = None
+        if record['throttle'] is not None:
+            for position in range(record['throttle']):
+                throttle_lock = self._try_lock(os.path.join(
+                    locks_dir, 'array_{}_{}.lock'.format(record['job_id'], position)))
+                if throttle_lock is not None:
+                    break
+            if throttle_lock is None:
+                return None
+
+        for slot in range(self.slots):
+            if self._node_name(slot) in record['exclude']:
+                continue
+            slot_lock = self._try_lock(os.path.join(locks_dir,
+                                                    f'slot_{slot}.lock'))
+            if slot_lock is not None:
+                return (slot, slot_lock, throttle_lock)
+
+        if throttle_lock is not None:
+            throttle_lock.close()
+        return None
+
+    def _wait_for_resources(self, record):
+        while True:
+            dependency_states = [self.get_state(dependency)
+                                 for dependency in record['dependencies']]
+            if any(state not in active_states + ['COMPLETED', None]
+                   for state in dependency_states):
+                self.update_record(record['id'], state='CANCELLED',
+                                   reason='DependencyNeverSatisfied',
+                                   end_time=time.time())
+                return None
+
+            if all(state in ['COMPLETED', None] for state in dependency_states):
+                break
+
+            time.sleep(0.5)
+
+        # the runners whose dependencies are satisfied queue by submission
+        # order, and only the head of the queue polls for a free slot
+        ready_dir = os.path.join(self.state_dir, 'locks', 'ready')
+        os.makedirs(ready_dir, exist_ok=True)
+        ticket = '{}_{}'.format(record['job_id'].zfill(10),
+                                str(record['array_task'] or 0).zfill(10))
+        open(os.path.join(ready_dir, ticket), 'w').close()
+        try:
+            while min(os.listdir(ready_dir)) != ticket:
+                time.sleep(0.05)
+            while True:
+                acquired = self._acquire_slot(record)
+                if acquired is not None:
+                    return acquired
+                time.sleep(0.05)
+        finally:
+            os.remove(os.path.join(ready_dir, ticket))
+
+    def _get_lot(self, record):
+        env = record['env']
+        if record['array_task'] is not None and 'LOT_TABLE' in env:
+            with open(env['LOT_TABLE'], 'r') as table_file:
+                rows = table_file.read().splitlines()
+            fields = rows[record['array_task']].split()
+            return {'dest': fields[0], 'type': fields[2],
+                    'purity': fields[3], 'lot': fields[4]}
+        if 'LOT' in env and 'DEST' in env:
+            return {'dest': env['DEST'], 'type': env.get('TYPE', ''),
+                    'purity': env.get('PURITY', ''), 'lot': env['LOT']}
+        return None
+
+    def _draw_duration(self, record, lot):
+        if lot is not None:
+            rng = random.Random('{}_{}_{}'.format(self.seed, record['id'],
+                                                  lot['lot']))
+            name, timings = lot['lot'], self.model['lots']
+        else:
+            rng = random.Random('{}_{}'.format(self.seed, record['id']))
+            name, timings = record['name'], self.model['jobs']
+        timing = {'mean': 0, 'sd': 0}
+        for pattern, pattern_timing in timings.items():
+            if fnmatch.fnmatch(name, pattern):
+                timing = pattern_timing
+                break
+        duration = max(0, rng.gauss(timing['mean'], timing['sd']))
+        failed = rng.random() < self.model.get('failure_rate', 0)
+        return duration*self.time_scale, failed
+
+    def _emulate_outputs(self, record, lot):
+        env = record['env']
+        if lot is not None:
+            dest = os.path.join(record['cwd'], lot['dest'])
+            if lot['type'] == 'normal':
+                sample_names = ['normal_sample']
+            else:
+                sample_names = ['{}_{}'.format(env.get('SPN', 'SPN'), sample)
+                                for sample in self.model['samples']]
+            fastq_dir = os.path.join(dest, 'FASTQ')
+            os.makedirs(fastq_dir, exist_ok=True)
+            for sample_name in sample_names:
+                for read in ['R1', 'R2']:
+                    open(os.path.join(fastq_dir, '{}_{}.{}.fastq.gz'.format(
+                        lot['lot'], sample_name, read)), 'w').close()
+            open(os.path.join(dest, '{}_final.done'.format(lot['lot'])),
+                 'w').close()
+        elif 'PHYLO_FOREST' in env and 'gender' in os.path.basename(record['script']):
+            gender_filename = os.path.join(os.path.dirname(env['PHYLO_FOREST']),
+                                           'subject_gender.txt')
+            with open(gender_filename, 'w') as gender_file:
+                gender_file.write('XX\n')
+
+    def _notify(self, record, lot, node, **fields):
+        address = record['env'].get('NOTIFY_ADDR', '')
+        if lot is None or address == '':
+            return
+        host, _, port = address.rpartition(':')
+        message = 'dest={} lot={} node={} {}\n'.format(
+            lot['dest'], lot['lot'], node,
+            ' '.join(f'{key}={value}' for key, value in fields.items()))
+        try:
+            with socket.create_connection((host, int(port)), timeout=10) as connection:
+                connection.sendall(message.encode())
+        except OSError:
+            pass
+
+    def _run_worker(self, record, node):
+        env = record['env']
+        worker_dir = env['WORKER_DIR']
+        idle_time = float(env.get('WORKER_IDLE_TIME', 600))*self.time_scale
+        worker_lots = list()
+        time.sleep(self.model['lot_startup']*self.time_scale)
+        last_request = time.time()
+        while True:
+            requests = sorted(filename for filename in os.listdir(worker_dir)
+                              if filename.endswith('.request'))
+            if len(requests) == 0:
+                if (os.path.exists(os.path.join(worker_dir, 'stop'))
+                        or time.time()-last_request > idle_time):
+                    return 0
+                time.sleep(0.05)
+                continue
+
+            running = os.path.join(worker_dir,
+                                   requests[0][:-len('.request')] + '.running')
+            submit_time = os.path.getmtime(os.path.join(worker_dir,
+                                                        requests[0]))
+            os.replace(os.path.join(worker_dir, requests[0]), running)
+            with open(running, 'r') as request_file:
+                lot_args = request_file.read().split()
+            for lot_name in lot_args[2].split(':'):
+                lot = {'dest': lot_args[4], 'type': lot_args[6],
+                       'purity': lot_args[9], 'lot': lot_name}
+                start_time = int(time.time())
+                self._notify(record, lot, node, event='start',
+                             start=start_time)
+                duration, failed = self._draw_duration(record, lot)
+                time.sleep(duration)
+                if not failed:
+                    self._emulate_outputs(record, lot)
+                self._notify(record, lot, node, event='end',
+                             status=1 if failed else 0, start=start_time,
+                             end=int(time.time()))
+                worker_lots.append({'lot': lot, 'submit_time': submit_time,
+                                    'start_time': start_time,
+                                    'end_time': time.time()})
+                self.update_record(record['id'], worker_lots=worker_lots)
+            os.unlink(running)
+            last_request = time.time()
+
+    def run(self, task_id):
+        record = self.read_record(task_id)
+        self.update_record(task_id, runner_pid=os.getpid())
+
+        def terminate(signum, frame):
+            self.update_record(task_id, state='CANCELLED',
+                               end_time=time.time())
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, terminate)
+
+        acquired = self._wait_for_resources(record)
+        if acquired is None:
+            return
+        slot = acquired[0]
+        node = self._node_name(slot)
+
+        lot = self._get_lot(record)
+        self.update_record(task_id, state='RUNNING', node=node,
+                           start_time=time.time(), lot=lot)
+
+        if self.mode == 'model' and 'WORKER_DIR' in record['env']:
+            exit_code = self._run_worker(record, node)
+        elif self.mode == 'model':
+            if lot is None:
+                lots = [None]
+            else:
+                lots = [dict(lot, lot=lot_name)
+                        for lot_name in lot['lot'].split(':')]
+                time.sleep(self.model['lot_startup']*self.time_scale)
+            exit_code = 0
+            pack_lots = list()
+            for job_lot in lots:
+                start_time = int(time.time())
+                self._notify(record, job_lot, node, event='start',
+                             start=start_time)
+                duration, failed = self._draw_duration(record, job_lot)
+                time.sleep(duration)
+                exit_code = 1 if failed else 0
+                if not failed:
+                    self._emulate_outputs(record, job_lot)
+                self._notify(record, job_lot, node, event='end',
+                             status=exit_code, start=start_time,
+                             end=int(time.time()))
+                if len(lots) > 1:
+                    pack_lots.append({'lot': job_lot,
+                                      'submit_time': record['submit_time'],
+                                      'start_time': start_time,
+                                      'end_time': time.time()})
+                    self.update_record(task_id, pack_lots=pack_lots)
+                if failed:
+                    break
+        else:
+            env = dict(record['env'], SLURM_JOB_ID=task_id,
+                       SLURM_JOB_NAME=record['name'],
+                       SLURMD_NODENAME=node, SLURM_CPUS_PER_TASK='1')
+            if record['array_task'] is not None:
+                env['SLURM_ARRAY_JOB_ID'] = record['job_id']
+                env['SLURM_ARRAY_TASK_ID'] = str(record['array_task'])
+            with open(record['output'], 'a') as log:
+                process = subprocess.run(['bash', record['script']]
+                                         + record['script_args'],
+                                         env=env, cwd=record['cwd'],
+                                         stdout=log, stderr=subprocess.STDOUT)
+            exit_code = process.returncode
+
+        self.update_record(task_id, end_time=time.time(), exit_code=exit_code,
+                           state='COMPLETED' if exit_code == 0 else 'FAILED')
+
+
+def expand_array_indices(indices):
+    expanded = list()
+    for index_range in indices.split(','):
+        first, _, last = index_range.partition('-')
+        if last == '':
+            expanded.append(int(first))
+        else:
+            expanded.extend(range(int(first), int(last)+1))
+    return expanded
+
+
+def parse_options(argv, short_options=dict(), flags=list()):
+    options = dict()
+    positional = list()
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('--') and len(positional) == 0:
+            key, sep, value = arg[2:].partition('=')
+            if sep == '' and key not in flags:
+                i += 1
+                value = argv[i]
+            options[key] = value if sep != '' or key not in flags else True
+        elif arg.startswith('-') and len(arg) > 1 and len(positional) == 0:
+            key = short_options.get(arg[1], arg[1])
+            if key in flags:
+                options[key] = True
+            elif len(arg) > 2:
+                options[key] = arg[2:]
+            else:
+                i += 1
+                options[key] = argv[i]
+        else:
+            positional.append(arg)
+        i += 1
+    return options, positional
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return 'Unknown'
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def format_elapsed(record):
+    start = record.get('start_time')
+    if start is None:
+        return '00:00:00'
+    elapsed = int(record.get('end_time', time.time()) - start)
+    return '{:02d}:{:02d}:{:02d}'.format(elapsed//3600, (elapsed//60) % 60,
+                                         elapsed % 60)
+
+
+def sacct_field(record, field):
+    field = field.lower()
+    if field == 'jobid':
+        return record['id']
+    if field == 'jobname':
+        return record['name']
+    if field == 'state':
+        return record['state']
+    if field == 'exitcode':
+        return '{}:0'.format(record.get('exit_code', 0))
+    if field == 'nodelist':
+        return record.get('node', 'None assigned')
+    if field == 'submit':
+        return format_time(record.get('submit_time'))
+    if field == 'start':
+        return format_time(record.get('start_time'))
+    if field == 'end':
+        return format_time(record.get('end_time'))
+    if field == 'elapsed':
+        return format_elapsed(record)
+    return ''
+
+
+def sbatch_main(fake_slurm, argv):
+    options, positional = parse_options(argv, {'J': 'job-name',
+                                               'o': 'output',
+                                               'a': 'array',
+                                               'd': 'dependency',
+                                               'x': 'exclude',
+                                               'A': 'account',
+                                               'p': 'partition'},
+                                        ['parsable'])
+    job_id = fake_slurm.submit(positional[0], options, positional[1:])
+    if options.get('parsable', False):
+        sys.stdout.write(f'{job_id}\n')
+    else:
+        sys.stdout.write(f'Submitted batch job {job_id}\n')
+
+
+def squeue_main(fake_slurm, argv):
+    options, _ = parse_options(argv, {'j': 'jobs', 'h': 'noheader',
+                                      'u': 'user', 'o': 'format'},
+                               ['noheader'])
+    job_ids = options['jobs'].split(',') if 'jobs' in options else None
+    if not options.get('noheader', False):
+        sys.stdout.write('JOBID NAME ST TIME NODELIST(REASON)\n')
+    for record in fake_slurm.select_records(job_ids):
+        if record['state'] not in active_states:
+            continue
+        short_state = 'R' if record['state'] == 'RUNNING' else 'PD'
+        sys.stdout.write('{} {} {} {} {}\n'.format(
+            record['id'], record['name'], short_state,
+            format_elapsed(record), record.get('node', '(Resources)')))
+
+
+def sacct_main(fake_slurm, argv):
+    options, _ = parse_options(argv, {'j': 'jobs', 'n': 'noheader',
+                                      'P': 'parsable2', 'o': 'format',
+                                      'X': 'allocations'},
+                               ['noheader', 'parsable2', 'allocations',
+                                'parsable'])
+    job_ids = options['jobs'].split(',') if 'jobs' in options else None
+    fields = options.get('format', 'JobID,JobName,State,ExitCode').split(',')
+    separator = '|' if options.get('parsable2', False) else ' '
+    if not options.get('noheader', False):
+        sys.stdout.write(separator.join(fields) + '\n')
+    for record in fake_slurm.select_records(job_ids):
+        sys.stdout.write(separator.join(sacct_field(record, field)
+                                        for field in fields) + '\n')
+
+
+def scancel_main(fake_slurm, argv):
+    _, job_ids = parse_options(argv)
+    fake_slurm.cancel(job_ids)
+
+
+commands = {
+    'sbatch': sbatch_main,
+    'squeue': squeue_main,
+    'sacct': sacct_main,
+    'scancel': scancel_main
+}
+
+
+def install_commands(bin_dir, state_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for command in commands:
+        command_filename = os.path.join(bin_dir, command)
+        with open(command_filename, 'w') as command_file:
+            command_file.write('#!/bin/bash\n')
+            command_file.write('export FAKE_SLURM_DIR=${{FAKE_SLURM_DIR:-{}}}\n'.format(
+                os.path.abspath(state_dir)))
+            command_file.write('exec {} {} {} "$@"\n'.format(
+                sys.executable, os.path.abspath(__file__), command))
+        os.chmod(command_filename, 0o755)
+
+
+if (__name__ == '__main__'):
+    if len(sys.argv) < 2 or sys.argv[1] not in list(commands) + ['_launch', '_run']:
+        sys.stderr.write('Usage: {} {{{}}} [OPTIONS]\n'.format(
+            sys.argv[0], ','.join(commands)))
+        sys.exit(1)
+
+    fake_slurm = FakeSlurm.from_environment()
+    if sys.argv[1] == '_launch':
+        fake_slurm.launch(sys.argv[2])
+    elif sys.argv[1] == '_run':
+        fake_slurm.run(sys.argv[2])
+    else:
+        commands[sys.argv[1]](fake_slurm, sys.argv[2:])
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+fastq_writer_script = """#!/bin/bash
+# Writes the FASTQ files of a sample from the SAM stream on its standard
+# input.
+#
+#   ProCESS_fastq_writer.sh <codec> <level> <threads> <prefix>
+#
+# The files <prefix>.{R1,R2,unpaired,singleton}.fastq.gz are compressed
+# by "samtools fastq" itself, i.e., in BGZF blocks, when <codec> is "bgzf",
+# or by "pigz", "libdeflate-gzip", or "gzip" reading the FASTQ records from
+# named pipes. A missing compressor falls back to BGZF.
+
+CODEC=$1
+LEVEL=$2
+THREADS=$3
+PREFIX=$4
+SUFFIXES="R1 R2 unpaired singleton"
+
+write_bgzf() {
+    exec samtools fastq -@ ${THREADS} -c ${LEVEL} -N \\
+        -1 ${PREFIX}.R1.fastq.gz -2 ${PREFIX}.R2.fastq.gz \\
+        -0 ${PREFIX}.unpaired.fastq.gz -s ${PREFIX}.singleton.fastq.gz -
+}
+
+case ${CODEC} in
+    bgzf)
+        write_bgzf ;;
+    pigz)
+        COMPRESSOR="pigz -p $(( THREADS/2+1 )) -${LEVEL} -c" ;;
+    libdeflate)
+        COMPRESSOR="libdeflate-gzip -${LEVEL} -c" ;;
+    gzip)
+        COMPRESSOR="gzip -${LEVEL} -c" ;;
+    *)
+        echo "Unknown FASTQ compression codec \\"${CODEC}\\"" >&2
+        exit 1 ;;
+esac
+
+if ! command -v ${COMPRESSOR%% *} > /dev/null; then
+    echo "${COMPRESSOR%% *} not found: using BGZF" >&2
+    LEVEL=$(( LEVEL > 9 ? 9 : LEVEL ))
+    write_bgzf
+fi
+
+for SUFFIX in ${SUFFIXES}; do
+    rm -f ${PREFIX}.${SUFFIX}.fastq
+    mkfifo ${PREFIX}.${SUFFIX}.fastq
+    ${COMPRESSOR} < ${PREFIX}.${SUFFIX}.fastq > ${PREFIX}.${SUFFIX}.fastq.gz &
+done
+
+samtools fastq -N -1 ${PREFIX}.R1.fastq -2 ${PREFIX}.R2.fastq \\
+    -0 ${PREFIX}.unpaired.fastq -s ${PREFIX}.singleton.fastq -
+STATUS=$?
+
+# the compressors of the pipes that "samtools fastq" did not open are
+# still waiting for a writer
+for SUFFIX in ${SUFFIXES}; do
+    : <> ${PREFIX}.${SUFFIX}.fastq
+done
+wait
+for SUFFIX in ${SUFFIXES}; do
+    rm -f ${PREFIX}.${SUFFIX}.fastq
+done
+
+exit ${STATUS}
+"""
+
+fastq_writer_filename = 'ProCESS_fastq_writer.sh'
+
+compression_levels = {'bgzf': range(0, 10),
+                      'pigz': range(0, 10),
+                      'libdeflate': range(1, 13),
+                      'gzip': range(1, 10)}
+
+compressors = {'bgzf': 'samtools',
+               'pigz': 'pigz',
+               'libdeflate': 'libdeflate-gzip',
+               'gzip': 'gzip'}
+
+default_compression_level = 6
+
+
+def parse_compression_profile(profile):
+    """Parses a ``<codec>[:<level>]`` FASTQ compression profile.
+
+    Returns the codec and the level, which is 6 if it is not given.
+    """
+    codec, _, level = profile.partition(':')
+    if codec not in compression_levels:
+        raise argparse.ArgumentTypeError(
+            'unknown codec "{}": it must be one of {}'.format(
+                codec, ', '.join(compression_levels)))
+    if level == '':
+        level = default_compression_level
+    else:
+        try:
+            level = int(level)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'the level "{}" is not an integer'.format(level))
+    levels = compression_levels[codec]
+    if level not in levels:
+        raise argparse.ArgumentTypeError(
+            'the {} levels range from {} to {}'.format(codec, levels[0],
+                                                       levels[-1]))
+    return codec, level
+
+
+def write_fastq_writer_script(directory='.'):
+    with open(os.path.join(directory, fastq_writer_filename), 'w') as outstream:
+        outstream.write(fastq_writer_script)
+
+
+def add_compression_arguments(parser):
+    parser.add_argument('--fastq_compression', type=parse_compression_profile,
+                        default=('bgzf', 9),
+                        help=("The FASTQ compression profile, i.e., a codec "
+                              + "among bgzf, pigz, libdeflate, and gzip, "
+                              + "optionally followed by a colon and a level "
+                              + "(default: bgzf:9)"))
+
+
+def get_compression_env(args):
+    """Returns the lot environment setting the FASTQ compression profile."""
+    return {'FASTQ_COMPRESSION': '{}:{}'.format(*args.fastq_compression)}
+
+
+def measure_profile(BAM_file, codec, level, threads, work_dir):
+    """Converts a BAM file into compressed FASTQ files.
+
+    Returns the elapsed time and the overall size of the FASTQ files.
+    """
+    prefix = os.path.join(work_dir, '{}_{}'.format(codec, level))
+    writer = os.path.join(work_dir, fastq_writer_filename)
+    cmd = 'samtools view -h {} | bash {} {} {} {} {}'.format(
+        BAM_file, writer, codec, level, threads, prefix)
+
+    start = time.time()
+    subprocess.run(cmd, shell=True, check=True)
+    elapsed = time.time()-start
+
+    size = 0
+    for suffix in ['R1', 'R2', 'unpaired', 'singleton']:
+        filename = '{}.{}.fastq.gz'.format(prefix, suffix)
+        if os.path.exists(filename):
+            size += os.path.getsize(filename)
+            os.unlink(filename)
+    return elapsed, size
+
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(prog=sys.argv[0],
+                                     description=('Measures the throughput and '
+                                                  + 'the output size of FASTQ '
+                                                  + 'compression profiles on '
+                                                  + 'a lot BAM file'))
+    parser.add_argument('BAM_file', type=str,
+                        help="A lot BAM file, or a sample of it")
+    parser.add_argument('-p', '--profiles', type=parse_compression_profile,
+                        nargs='+',
+                        default=[('bgzf', 9), ('bgzf', 6), ('bgzf', 1),
+                                 ('pigz', 6), ('libdeflate', 6)],
+                        help=("The compression profiles to be measured "
+                              + "(default: bgzf:9 bgzf:6 bgzf:1 pigz:6 "
+                              + "libdeflate:6)"))
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help=("The number of additional compression threads "
+                              + "(default: 4)"))
+    parser.add_argument('-w', '--work_dir', type=str, default=None,
+                        help=("The directory in which the FASTQ files are "
+                              + "written (default: a new temporary "
+                              + "directory)"))
+
+    args = parser.parse_args()
+
+    BAM_size = os.path.getsize(args.BAM_file)
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        write_fastq_writer_script(work_dir)
+
+        sys.stdout.write('{:<14} {:>10} {:>12} {:>12} {:>12}\n'.format(
+            'profile', 'time (s)', 'BAM MB/s', 'FASTQ MB', 'FASTQ/BAM'))
+        for codec, level in args.profiles:
+            profile = '{}:{}'.format(codec, level)
+            if shutil.which(compressors[codec]) is None:
+                sys.stdout.write('{:<14} {} not found\n'.format(
+                    profile, compressors[codec]))
+                continue
+            elapsed, size = measure_profile(os.path.abspath(args.BAM_file),
+                                            codec, level, args.threads,
+                                            work_dir)
+            sys.stdout.write('{:<14} {:>10.1f} {:>12.1f} {:>12.1f} '
+                             '{:>12.2f}\n'.format(profile, elapsed,
+                                                  BAM_size/2**20/elapsed,
+                                                  size/2**20,
+                                                  size/BAM_size))
+            sys.stdout.flush()
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# the staged files are checked by the MD5 checksum of their first and last
+# MB, as ProCESS_stage.sh computes it
+fast_checksum_block = 2**20
+
+
+def get_checksum(filename, block_size=2**24):
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as instream:
+        for block in iter(lambda: instream.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def get_fast_checksum(filename):
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as instream:
+        checksum.update(instream.read(fast_checksum_block))
+        instream.seek(max(0, os.path.getsize(filename)-fast_checksum_block))
+        checksum.update(instream.read())
+    return checksum.hexdigest()
+
+
+def read_manifest(done_file):
+    """Returns the entries of the manifest in a lot done file.
+
+    Every entry is a dictionary with the keys of the manifest header, i.e.,
+    ``file``, ``size``, ``reads``, ``md5``, and ``fast_md5``. Returns
+    ``None`` if the done file is empty, as the ones written before the
+    manifests were introduced.
+    """
+    with open(done_file, 'r') as instream:
+        lines = instream.read().splitlines()
+    if len(lines) == 0:
+        return None
+    header = lines[0].split('\t')
+    return [dict(zip(header, line.split('\t'))) for line in lines[1:]]
+
+
+def verify_manifest(done_file, full=False):
+    """Verifies the files listed in the manifest of a lot done file.
+
+    The files must exist and have the listed sizes and fast checksums and,
+    when ``full`` is set, the listed MD5 checksums. Returns the list of the
+    problems found, which is empty if the files are verified or if the
+    done file has no manifest.
+    """
+    try:
+        manifest = read_manifest(done_file)
+    except (OSError, UnicodeDecodeError) as error:
+        return [str(error)]
+    if manifest is None:
+        return list()
+
+    problems = list()
+    done_file_dir = os.path.dirname(done_file)
+    for entry in manifest:
+        filename = os.path.join(done_file_dir, entry['file'])
+        try:
+            size = os.path.getsize(filename)
+            if size != int(entry['size']):
+                problems.append('{} has {} bytes rather than {}'.format(
+                    entry['file'], size, entry['size']))
+            elif get_fast_checksum(filename) != entry['fast_md5']:
+                problems.append('{} has a wrong fast checksum'.format(
+                    entry['file']))
+            elif full and get_checksum(filename) != entry['md5']:
+                problems.append('{} has a wrong MD5 checksum'.format(
+                    entry['file']))
+        except OSError as error:
+            problems.append('{}: {}'.format(entry['file'], error.strerror))
+        except (KeyError, ValueError):
+            problems.append('malformed manifest entry {}'.format(entry))
+    return problems
+
+
+def verify_done_files(done_files, full=False, num_of_threads=16):
+    """Verifies the manifests of lot done files in parallel.
+
+    Returns a dictionary mapping the done files that fail verification to
+    their problems.
+    """
+    done_files = list(done_files)
+    with ThreadPoolExecutor(max_workers=max(1, num_of_threads)) as pool:
+        problems = pool.map(lambda done_file: verify_manifest(done_file, full),
+                            done_files)
+        return {done_file: done_file_problems
+                for done_file, done_file_problems in zip(done_files, problems)
+                if len(done_file_problems) != 0}
+
+
+def discard_unverified_lots(output_dir, lot_prefix, store=None, full=False,
+                            num_of_threads=16):
+    """Removes the done files whose outputs fail verification.
+
+    The ``_final.done`` and ``_BAM.done`` files of the lots in
+    ``output_dir`` are verified, and the failing ones are removed, so that
+    their lots are simulated again, or resumed from their BAM file, and
+    their states are reset in ``store``, if given. Returns the names of the
+    lots whose ``_final.done`` files were removed.
+    """
+    done_files = glob.glob(os.path.join(output_dir, f'{lot_prefix}*.done'))
+    failures = verify_done_files(done_files, full, num_of_threads)
+
+    lot_names = list()
+    for done_file, problems in sorted(failures.items()):
+        lot_name, _, done_type = os.path.basename(done_file).rpartition('_')
+        sys.stdout.write('Discarding {}: {}\n'.format(done_file,
+                                                      '; '.join(problems)))
+        os.unlink(done_file)
+        if done_type == 'final.done':
+            lot_names.append(lot_name)
+            if store is not None:
+                store.reset(output_dir, lot_name)
+    sys.stdout.flush()
+
+    return lot_names
+
+
+def discard_unverified_cohort_lots(output_dir, store=None, full=False,
+                                   num_of_threads=16):
+    """Discards the unverified lots of all the purities of a cohort."""
+    lot_names = list()
+    for purity_dir in sorted(glob.glob(os.path.join(output_dir, '*',
+                                                    'purity_*'))):
+        lot_names.extend(discard_unverified_lots(purity_dir, '', store, full,
+                                                 num_of_threads))
+    return lot_names
+
+
+def add_manifest_arguments(parser):
+    parser.add_argument('--verify_outputs', choices=['none', 'fast', 'full'],
+                        default='fast',
+                        help=("How the outputs of the completed lots are "
+                              + "verified against their manifests: their "
+                              + "sizes and the checksums of their first and "
+                              + "last MB (\"fast\"), also their full MD5 "
+                              + "checksums (\"full\"), or not at all "
+                              + "(\"none\") (default: fast)"))
+    parser.add_argument('--verification_threads', type=int, default=16,
+                        help=("The number of lot manifests verified in "
+                              + "parallel (default: 16)"))
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import math
+
+from resource_sizing import ResourceRequest
+
+
+def get_pack_size(lot_request, max_lots, time_limit, memory_budget,
+                  memory_growth):
+    """Returns the number of lots to be simulated back to back by a job.
+
+    The time limit of a pack is the sum of the time limits of its lots and
+    it must not exceed ``time_limit`` (in seconds), unless ``time_limit``
+    is ``None``. A pack keeps the
+    phylogenetic forest in memory across its lots and R does not give all
+    the memory of a lot back to the system, so every lot after the first
+    one is assumed to add ``memory_growth`` times the lot memory; the pack
+    memory must not exceed ``memory_budget`` (in GB).
+    """
+    if time_limit is None:
+        by_time = max_lots
+    else:
+        by_time = math.floor(time_limit/lot_request.time_limit)
+    if memory_growth > 0:
+        by_memory = 1 + math.floor((memory_budget/lot_request.memory-1)
+                                   / memory_growth)
+    else:
+        by_memory = max_lots
+    return max(1, min(max_lots, by_time, by_memory))
+
+
+def get_pack_request(lot_request, pack_size, memory_growth):
+    memory = math.ceil(lot_request.memory*(1+memory_growth*(pack_size-1)))
+    return ResourceRequest(memory, lot_request.cpus,
+                           lot_request.time_limit*pack_size)
+
+
+def pack_work_items(work_items, get_pack_size):
+    """Splits the work items in packs of lots of the same group.
+
+    ``get_pack_size`` is called with a ``LotGroup`` and returns the
+    maximum number of lots in the packs of that group.
+    """
+    packs = list()
+    pack_sizes = dict()
+    for work_item in work_items:
+        group = work_item.group
+        if group not in pack_sizes:
+            pack_sizes[group] = get_pack_size(group)
+        if (len(packs) == 0 or packs[-1][0].group is not group
+                or len(packs[-1]) >= pack_sizes[group]):
+            packs.append(list())
+        packs[-1].append(work_item)
+    return packs
+
+
+def get_array_task_ids(array_job_id, packs, group):
+    """Returns the ids of the array tasks simulating the lots of a group.
+
+    The task ``i`` of the array ``array_job_id`` simulates ``packs[i]``.
+    """
+    return ['{}_{}'.format(array_job_id, task_id)
+            for task_id, pack in enumerate(packs) if pack[0].group is group]
+
+
+def get_pack_name(pack):
+    if len(pack) == 1:
+        return pack[0].lot_name
+    return '{}-{}'.format(pack[0].lot_name, pack[-1].lot_name)
+
+
+def add_packing_arguments(parser):
+    parser.add_argument('--pack_lots', type=int, default=1,
+                        help=("The maximum number of lots simulated back "
+                              + "to back by one job, which loads the "
+                              + "phylogenetic forest and copies the "
+                              + "reference genome only once (default: 1)"))
+    parser.add_argument('--pack_time_limit', type=str, default=None,
+                        help=("The maximum time limit of a job simulating "
+                              + "several lots (default: the lot time limit "
+                              + "times --pack_lots)"))
+    parser.add_argument('--pack_memory_growth', type=float, default=0.1,
+                        help=("The fraction of the lot memory added to a "
+                              + "job by every further lot it simulates "
+                              + "(default: 0.1)"))
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import json
+import math
+import heapq
+import itertools
+from fractions import Fraction
+
+from resource_sizing import (usage_dir_name, lot_plan_filename,
+                             parse_time_report, format_time_limit,
+                             read_lot_plan)
+
+
+def get_lot_step(max_coverage, tiers):
+    """Returns the least number of lots splitting the tiers exactly.
+
+    The lots of a sequencing type have the same coverage and every tier
+    must be the coverage of the first lots, hence the number of lots must
+    be a multiple of the returned value.
+    """
+    step = 1
+    for tier in tiers:
+        step = math.lcm(step, Fraction(tier, max_coverage).denominator)
+    return step
+
+
+def estimate_makespan(durations, slots):
+    """Estimates the makespan of running the jobs in order on the slots."""
+    finish_times = [0]*max(1, min(slots, len(durations)))
+    for duration in durations:
+        heapq.heapreplace(finish_times, finish_times[0]+duration)
+    return max(finish_times)
+
+
+def write_lot_plan(output_dir, plan):
+    os.makedirs(output_dir, exist_ok=True)
+    filename = os.path.join(output_dir, lot_plan_filename)
+    with open(filename + '.tmp', 'w') as outstream:
+        json.dump(plan, outstream, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def measure_seconds_per_x(cohort_dirs, seq_type, lot_overhead):
+    """Returns the mean lot time per coverage unit of earlier lots.
+
+    The lot times are read from the ``usage`` reports of the cohorts having
+    a lot plan, which provides their lot coverage, and the lot overhead is
+    subtracted from them. Returns ``None`` if no lot of ``seq_type``
+    completed.
+    """
+    costs = list()
+    for cohort_dir in cohort_dirs:
+        plan = read_lot_plan(cohort_dir)
+        if plan is None or seq_type not in plan['lot_coverages']:
+            continue
+        lot_coverage = plan['lot_coverages'][seq_type]
+        pattern = os.path.join(cohort_dir, seq_type, 'purity_*',
+                               usage_dir_name, f'lot.{seq_type}.*.time')
+        for filename in glob.glob(pattern):
+            try:
+                measurement = parse_time_report(filename)
+            except (OSError, ValueError):
+                continue
+            if measurement is None:
+                continue
+            num_of_lots = os.path.basename(filename).count(':')+1
+            lot_time = measurement['elapsed']/num_of_lots
+            costs.append(max(0, lot_time-lot_overhead)/lot_coverage)
+
+    if len(costs) == 0:
+        return None
+    return sum(costs)/len(costs)
+
+
+class LotPlanner:
+    """Picks the number of lots of every sequencing type.
+
+    ``cohorts`` maps the sequencing types to their maximum coverage and
+    purities and ``tiers`` lists the tumour cohort coverages, which must be
+    covered exactly by the first tumour lots. A lot of coverage ``c`` is
+    assumed to take ``lot_overhead + seconds_per_x[seq_type]*c`` seconds and
+    the number of lots running at once is bounded by the nodes, their
+    cores, memory, and scratch, and by ``max_parallel``. A plan is
+    admissible if its lots fit in a node and end within their time limit.
+    The planner estimates the makespan of every admissible plan with up to
+    ``max_lots`` lots per purity and picks the fastest one, preferring
+    fewer lots among the plans within 1% of it.
+    """
+
+    def __init__(self, cohorts, tiers, num_of_nodes, cores_per_node,
+                 mem_per_node, scratch_per_node, max_parallel, seconds_per_x,
+                 lot_overhead, max_lots=200):
+        self.cohorts = cohorts
+        self.tiers = tiers
+        self.num_of_nodes = num_of_nodes
+        self.cores_per_node = cores_per_node
+        self.mem_per_node = mem_per_node
+        self.scratch_per_node = scratch_per_node
+        self.max_parallel = max_parallel
+        self.seconds_per_x = seconds_per_x
+        self.lot_overhead = lot_overhead
+        self.max_lots = max_lots
+
+    def get_slots(self, lot_request, lot_scratch):
+        """Returns the number of lots running at once, 0 if none fits."""
+        per_node = min(self.cores_per_node//lot_request.cpus,
+                       math.floor(self.mem_per_node/lot_request.memory),
+                       math.floor(self.scratch_per_node/lot_scratch))
+        return min(self.max_parallel, self.num_of_nodes*per_node)
+
+    def get_candidates(self, seq_type):
+        max_coverage = self.cohorts[seq_type]['max_coverage']
+        if seq_type == 'tumour':
+            step = get_lot_step(max_coverage, self.tiers)
+        else:
+            step = 1
+        return range(step, max(step, self.max_lots)+1, step)
+
+    def estimate_makespan(self, num_of_lots, get_lot_request,
+                          get_lot_scratch):
+        """Returns the estimated makespan of a plan, ``None`` if inadmissible."""
+        durations = list()
+        slots = self.max_parallel
+        for seq_type, lots in num_of_lots.items():
+            cohort = self.cohorts[seq_type]
+            lot_coverage = cohort['max_coverage']/lots
+            lot_request = get_lot_request(seq_type, lot_coverage)
+            duration = (self.lot_overhead
+                        + self.seconds_per_x[seq_type]*lot_coverage)
+            if duration > lot_request.time_limit:
+                return None
+            slots = min(slots, self.get_slots(lot_request,
+                                              get_lot_scratch(seq_type,
+                                                              lot_coverage)))
+            durations.extend([duration]*(lots*len(cohort['purities'])))
+        if slots == 0:
+            return None
+        return estimate_makespan(durations, slots)
+
+    def plan(self, get_lot_request, get_lot_scratch):
+        """Returns the number of lots of every sequencing type.
+
+        ``get_lot_request`` is called with a sequencing type and a lot
+        coverage and returns the lot ``ResourceRequest``, while
+        ``get_lot_scratch`` is called with a sequencing type and a lot
+        coverage and returns the node scratch used by such a lot (in GB).
+        The estimated makespan of the plan is returned too. Raises a
+        ``RuntimeError`` if no plan is admissible.
+        """
+        seq_types = list(self.cohorts)
+        plans = list()
+        for num_of_lots in itertools.product(*(self.get_candidates(seq_type)
+                                               for seq_type in seq_types)):
+            num_of_lots = dict(zip(seq_types, num_of_lots))
+            makespan = self.estimate_makespan(num_of_lots, get_lot_request,
+                                              get_lot_scratch)
+            if makespan is not None:
+                plans.append((makespan, num_of_lots))
+
+        if len(plans) == 0:
+            raise RuntimeError('No plan with up to {} lots per purity fits '
+                               'the lots in a node and in their time '
+                               'limit'.format(self.max_lots))
+
+        best_makespan = min(makespan for makespan, _ in plans)
+        makespan, num_of_lots = min(((makespan, num_of_lots)
+                                     for makespan, num_of_lots in plans
+                                     if makespan <= 1.01*best_makespan),
+                                    key=lambda plan: sum(plan[1].values()))
+        return num_of_lots, makespan
+
+
+def read_num_of_lots(output_dir, default_num_of_lots):
+    plan = read_lot_plan(output_dir)
+    if plan is None:
+        return dict(default_num_of_lots)
+    return plan['num_of_lots']
+
+
+def plan_num_of_lots(args, cohorts, tiers, default_num_of_lots,
+                     get_lot_request, get_lot_scratch):
+    """Returns the number of lots of every sequencing type of a cohort.
+
+    The lot plan is written in the output directory the first time and
+    read from it afterwards, so that all the runs on a cohort split it in
+    the same lots. A new cohort is planned by ``LotPlanner`` when the
+    number of nodes is given and no lot completed yet, otherwise it gets
+    ``default_num_of_lots``. The lot times per coverage unit are measured
+    on the cohorts passed by ``--usage_dirs`` when possible.
+    """
+    plan = read_lot_plan(args.output_dir)
+    if plan is not None:
+        return plan['num_of_lots']
+
+    num_of_lots = dict(default_num_of_lots)
+    makespan = None
+    done_files = glob.glob(os.path.join(args.output_dir, '*', 'purity_*',
+                                        '*_final.done'))
+    if args.nodes is not None and len(done_files) == 0:
+        seconds_per_x = dict()
+        for seq_type in cohorts:
+            seconds_per_x[seq_type] = measure_seconds_per_x(args.usage_dirs,
+                                                            seq_type,
+                                                            args.lot_overhead)
+            if seconds_per_x[seq_type] is None:
+                seconds_per_x[seq_type] = args.seconds_per_x
+        planner = LotPlanner(cohorts, tiers, args.nodes, args.cores_per_node,
+                             args.mem_per_node, args.scratch_per_node,
+                             args.parallel_jobs*args.pack_lots, seconds_per_x,
+                             args.lot_overhead, args.max_lots)
+        num_of_lots, makespan = planner.plan(get_lot_request, get_lot_scratch)
+
+    lot_coverages = {seq_type: cohorts[seq_type]['max_coverage']/lots
+                     for seq_type, lots in num_of_lots.items()}
+    for seq_type, lots in num_of_lots.items():
+        sys.stdout.write('Splitting the {} cohorts in {} lots of {}x\n'.format(
+            seq_type, lots, lot_coverages[seq_type]))
+    if makespan is not None:
+        sys.stdout.write('Estimated lot makespan: {}\n'.format(
+            format_time_limit(makespan)))
+    sys.stdout.flush()
+
+    write_lot_plan(args.output_dir, {'num_of_lots': num_of_lots,
+                                     'lot_coverages': lot_coverages,
+                                     'estimated_makespan': makespan})
+    return num_of_lots
+
+
+def add_planning_arguments(parser):
+    parser.add_argument('--nodes', type=int, default=None,
+                        help=("The number of nodes available to the lots; "
+                              + "when it is given, the number of lots of a "
+                              + "new cohort is chosen to minimise the "
+                              + "estimated makespan"))
+    parser.add_argument('--cores_per_node', type=int, default=64,
+                        help=("The number of cores of each node "
+                              + "(default: 64)"))
+    parser.add_argument('--seconds_per_x', type=float, default=1800,
+                        help=("The seconds needed by a lot per coverage "
+                              + "unit when no earlier lot was measured "
+                              + "(default: 1800)"))
+    parser.add_argument('--lot_overhead', type=float, default=600,
+                        help=("The seconds needed by a lot to load the "
+                              + "phylogenetic forest and the reference "
+                              + "genome (default: 600)"))
+    parser.add_argument('--max_lots', type=int, default=200,
+                        help=("The maximum number of lots per purity "
+                              + "considered by the planner (default: 200)"))
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+import sys
+import math
+import time
+from collections import deque, namedtuple
+
+from lot_tracking import scratch_deferral
+
+LotWorkItem = namedtuple('LotWorkItem', ['group', 'lot_id', 'lot_name'])
+
+
+class LotGroup:
+    """The lots of one sequencing type and purity.
+
+    All the lots of a group share the output directory, in which their
+    ``_final.done`` files are written, and the lot coverage.
+    """
+
+    def __init__(self, seq_type, purity, output_dir, log_dir, lot_prefix,
+                 lot_coverage, num_of_lots):
+        self.seq_type = seq_type
+        self.purity = purity
+        self.output_dir = output_dir
+        self.log_dir = log_dir
+        self.lot_prefix = lot_prefix
+        self.lot_coverage = lot_coverage
+        self.num_of_lots = num_of_lots
+        self.zeros = math.ceil(math.log10(num_of_lots))
+
+    def get_lot_name(self, lot_id):
+        return '{}{}'.format(self.lot_prefix, str(lot_id).zfill(self.zeros))
+
+    def __repr__(self):
+        return f'{self.seq_type} purity {self.purity}'
+
+
+class LotScheduler:
+    """Keeps ``parallel_jobs`` lots running across all the lot groups.
+
+    The missing lots of all the groups are queued in a single work queue,
+    in the order in which the groups were added, and a new lot is submitted
+    as soon as a running one completes, regardless of its group.
+    When ``parallel_jobs`` is ``None``, all the lots are submitted at once
+    and the throttling is left to the submission function (e.g., to a
+    Slurm job array).
+
+    If a ``LotFailureMonitor`` is given, the failed lots are resubmitted
+    up to ``max_retries`` times, waiting ``retry_delay`` seconds before the
+    first resubmission and doubling the delay at every further one. The
+    lots that fail more often are collected in ``failed`` and their groups
+    are never yielded as completed. The lots deferred because their node
+    scratch was full are resubmitted after ``retry_delay`` seconds without
+    counting a failure. If a ``LotSpeculator`` is given and
+    ``parallel_jobs`` is not ``None``, the free job slots left once all the
+    lots have been submitted are used to run copies of the straggler lots.
+    When the lots are packed in jobs, ``parallel_jobs`` counts the lots and
+    new lots are submitted only once ``batch_size`` of them, or all the
+    pending ones, can be.
+    """
+
+    def __init__(self, tracker, parallel_jobs=None, monitor=None,
+                 max_retries=3, retry_delay=300, speculator=None,
+                 batch_size=1):
+        self.tracker = tracker
+        self.parallel_jobs = parallel_jobs
+        self.monitor = monitor
+        self.speculator = speculator
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.groups = list()
+        self.failures = dict()
+        self.failed = list()
+
+    def add_group(self, group):
+        self.groups.append(group)
+
+    def get_missing_lots(self):
+        """Returns the work items of the lots that are not completed yet."""
+        missing = list()
+        for group in self.groups:
+            completed = set(self.tracker.get_completed(group.output_dir,
+                                                       group.lot_prefix,
+                                                       group.zeros))
+            for lot_id in range(group.num_of_lots):
+                if lot_id not in completed:
+                    missing.append(LotWorkItem(group, lot_id,
+                                               group.get_lot_name(lot_id)))
+        return missing
+
+    def run(self, submit):
+        """Submits the missing lots and yields the groups once completed.
+
+        ``submit`` is called with the list of the ``LotWorkItem`` to be
+        submitted. The scheduling is suspended while the caller handles a
+        completed group.
+        """
+        pending = deque(self.get_missing_lots())
+        num_of_pending = {group: 0 for group in self.groups}
+        running = {group: set() for group in self.groups}
+        for work_item in pending:
+            num_of_pending[work_item.group] += 1
+
+        retries = list()
+        remaining = list(self.groups)
+        while len(remaining) != 0:
+            for group in remaining:
+                if len(running[group]) != 0:
+                    completed = self.tracker.get_completed(group.output_dir,
+                                                           group.lot_prefix,
+                                                           group.zeros)
+                    running[group].difference_update(completed)
+
+            running_items = [LotWorkItem(group, lot_id,
+                                         group.get_lot_name(lot_id))
+                             for group in remaining
+                             for lot_id in running[group]]
+            if self.speculator is not None:
+                for work_item in self.speculator.update(running_items):
+                    running[work_item.group].discard(work_item.lot_id)
+                    running_items.remove(work_item)
+
+            if self.monitor is not None:
+                # the lots having a copy fail only if their copy fails
+                if self.speculator is not None:
+                    running_items = [work_item for work_item in running_items
+                                     if not self.speculator.has_copy(work_item)]
+                for work_item, reason in self.monitor.get_failed(running_items):
+                    running[work_item.group].discard(work_item.lot_id)
+                    retry_time = self._handle_failure(work_item, reason)
+                    if retry_time is not None:
+                        retries.append((retry_time, work_item))
+                        num_of_pending[work_item.group] += 1
+
+            for group in list(remaining):
+                if len(running[group]) == 0 and num_of_pending[group] == 0:
+                    remaining.remove(group)
+                    if not any(work_item.group is group
+                               for work_item in self.failed):
+                        yield group
+
+            for retry in sorted(retries, key=lambda retry: retry[0], reverse=True):
+                if retry[0] <= time.time():
+                    retries.remove(retry)
+                    pending.appendleft(retry[1])
+
+            if self.parallel_jobs is None:
+                to_be_submitted = len(pending)
+            else:
+                num_of_running = sum(len(lots) for lots in running.values())
+                if self.speculator is not None:
+                    num_of_running += self.speculator.num_of_copies()
+                to_be_submitted = min(self.parallel_jobs - num_of_running,
+                                      len(pending))
+
+            if to_be_submitted > 0 and (to_be_submitted >= self.batch_size
+                                        or to_be_submitted == len(pending)):
+                work_items = [pending.popleft()
+                              for _ in range(to_be_submitted)]
+                submit(work_items)
+                for work_item in work_items:
+                    num_of_pending[work_item.group] -= 1
+                    running[work_item.group].add(work_item.lot_id)
+
+            if (self.speculator is not None and self.parallel_jobs is not None
+                    and len(pending) == 0):
+                num_of_running = sum(len(lots) for lots in running.values())
+                free_slots = (self.parallel_jobs - num_of_running
+                              - self.speculator.num_of_copies())
+                if free_slots > 0:
+                    self.speculator.launch([LotWorkItem(group, lot_id,
+                                                        group.get_lot_name(lot_id))
+                                            for group in remaining
+                                            for lot_id in running[group]],
+                                           free_slots)
+
+            if len(remaining) != 0:
+                self.tracker.wait()
+
+    def _handle_failure(self, work_item, reason):
+        if reason == scratch_deferral:
+            sys.stdout.write('Lot {} of {} deferred ({}): resubmitting it in '
+                             '{:.0f} seconds\n'.format(work_item.lot_name,
+                                                       work_item.group, reason,
+                                                       self.retry_delay))
+            sys.stdout.flush()
+            return time.time() + self.retry_delay
+
+        key = (work_item.group.output_dir, work_item.lot_name)
+        failures = self.failures.get(key, 0) + 1
+        self.failures[key] = failures
+        if failures > self.max_retries:
+            sys.stdout.write('Lot {} of {} failed ({}): giving up after {} '
+                             'attempts\n'.format(work_item.lot_name,
+                                                 work_item.group, reason,
+                                                 failures))
+            sys.stdout.flush()
+            self.failed.append(work_item)
+            return None
+
+        delay = self.retry_delay * 2**(failures-1)
+        sys.stdout.write('Lot {} of {} failed ({}): resubmitting it in {:.0f} '
+                         'seconds\n'.format(work_item.lot_name, work_item.group,
+                                             reason, delay))
+        sys.stdout.flush()
+        return time.time() + delay
+
+
+def write_lot_table(table_filename, packs, get_lot_scratch):
+    """Writes the lot table of a job array.
+
+    The ``i``-th line of the table describes the pack of lots of the
+    ``i``-th array task: their output directory, coverage, type, purity,
+    colon-separated names and seeds, and node scratch space (in GB).
+    """
+    with open(table_filename, 'w') as table_file:
+        for pack in packs:
+            group = pack[0].group
+            table_file.write('{} {} {} {} {} {} {}\n'.format(
+                group.output_dir, group.lot_coverage,
+                group.seq_type, group.purity,
+                ':'.join(work_item.lot_name for work_item in pack),
+                ':'.join(str(work_item.lot_id) for work_item in pack),
+                get_lot_scratch(group)))
+
+
+def write_failed_lots(work_items, outstream=sys.stdout):
+    outstream.write('The following lots failed permanently:\n')
+    for work_item in work_items:
+        outstream.write('  {} of {} (log: {}lot_{}.log)\n'.format(
+            work_item.lot_name, work_item.group, work_item.group.log_dir,
+            work_item.lot_name))
+    outstream.flush()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import shutil
+
+from executors import failed_job_states, active_job_states
+
+speculative_dir_name = 'speculative'
+
+
+def get_percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values)-1, int(fraction*len(values)))]
+
+
+def move_lot_outputs(source_dir, dest_dir):
+    """Moves the files of ``source_dir`` into the same paths of ``dest_dir``.
+
+    The ``_final.done`` files are moved last, so that a lot is never
+    marked as completed before all its outputs are in place.
+    """
+    done_files = list()
+    for root, _, filenames in os.walk(source_dir):
+        target_root = os.path.join(dest_dir, os.path.relpath(root, source_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for filename in filenames:
+            source = os.path.join(root, filename)
+            target = os.path.join(target_root, filename)
+            if filename.endswith('_final.done'):
+                done_files.append((source, target))
+            else:
+                os.replace(source, target)
+    for source, target in done_files:
+        os.replace(source, target)
+
+
+class LotSpeculator:
+    """Runs a second copy of the straggler lots.
+
+    Once some job slots are free, a running lot whose running time exceeds
+    the ``percentile`` of the durations of the completed lots of its group
+    (if at least ``min_samples`` of them completed) is submitted again by
+    ``submit_copy(work_item, copy_dir, node)`` with the same seed. The copy
+    must avoid ``node``, i.e., the node of the original job, and write into
+    ``copy_dir``, i.e., ``<output_dir>/speculative/<lot>``. The first copy
+    to complete is kept: if the second copy wins, the original job is
+    cancelled and, once it has terminated, the outputs of the copy are
+    moved into the lot output directory; otherwise, the second copy is
+    cancelled and removed. The copy job states are checked at most once
+    every ``check_interval`` seconds, while the states of the cancelled
+    originals at every update. Every lot is copied at most once.
+    """
+
+    def __init__(self, executor, store, tracker, submit_copy, percentile=0.9,
+                 min_samples=5, check_interval=300):
+        self.executor = executor
+        self.store = store
+        self.tracker = tracker
+        self.submit_copy = submit_copy
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.check_interval = check_interval
+        self.last_check = time.time()
+        self.copies = dict()
+        self.copied = set()
+
+    def num_of_copies(self):
+        return len(self.copies)
+
+    def has_copy(self, work_item):
+        return work_item in self.copies
+
+    def _discard(self, work_item, cancel=True):
+        copy = self.copies.pop(work_item)
+        if cancel:
+            self.executor.cancel(copy['job_id'])
+        shutil.rmtree(copy['dir'], ignore_errors=True)
+
+    def _write(self, message, work_item, *args):
+        sys.stdout.write(message.format(work_item.lot_name, work_item.group,
+                                        *args))
+        sys.stdout.flush()
+
+    def update(self, running_items):
+        """Resolves the copies and returns the lots completed by a copy."""
+        running_items = set(running_items)
+        for work_item in list(self.copies):
+            if work_item not in running_items:
+                self._discard(work_item)
+
+        job_states = dict()
+        if (len(self.copies) != 0
+                and time.time()-self.last_check >= self.check_interval):
+            job_states = self.executor.get_states(copy['job_id']
+                                                  for copy in self.copies.values())
+            self.last_check = time.time()
+
+        # scancel is asynchronous: the outputs of a copy are moved only
+        # once its cancelled original stopped writing into the lot output
+        # directory
+        cancelled = [copy['cancelled'] for copy in self.copies.values()
+                     if copy['cancelled'] is not None]
+        if len(cancelled) != 0:
+            original_states = self.executor.get_states(cancelled)
+
+        completed = list()
+        for work_item, copy in list(self.copies.items()):
+            lot_name = work_item.lot_name
+            dest = work_item.group.output_dir
+            if os.path.exists(os.path.join(copy['dir'], f'{lot_name}_final.done')):
+                if (copy['cancelled'] is None
+                        and not os.path.exists(os.path.join(dest, f'{lot_name}_final.done'))):
+                    original = self.store.get_lot(dest, lot_name)
+                    if original is not None and original['job_id'] is not None:
+                        self.executor.cancel(original['job_id'])
+                        copy['cancelled'] = original['job_id']
+                        self._write('The copy of lot {} of {} completed '
+                                    'first: cancelling the original job\n',
+                                    work_item)
+                        continue
+                if copy['cancelled'] is not None:
+                    state = original_states.get(copy['cancelled'],
+                                                ('PENDING', None))[0]
+                    if state in active_job_states:
+                        continue
+                    if not os.path.exists(os.path.join(dest, f'{lot_name}_final.done')):
+                        move_lot_outputs(copy['dir'], dest)
+                        self._write('The outputs of the copy of lot {} of {} '
+                                    'replaced the original ones\n', work_item)
+                elif not os.path.exists(os.path.join(dest, f'{lot_name}_final.done')):
+                    move_lot_outputs(copy['dir'], dest)
+                    self._write('The copy of lot {} of {} completed first\n',
+                                work_item)
+                self.tracker.add_completed(dest, lot_name)
+                self._discard(work_item, cancel=False)
+                completed.append(work_item)
+            elif (job_states.get(copy['job_id'], (None, None))[0]
+                    in failed_job_states + ['COMPLETED']):
+                self._write('The copy of lot {} of {} failed\n', work_item)
+                self._discard(work_item, cancel=False)
+
+        return completed
+
+    def launch(self, work_items, free_slots):
+        """Submits copies of the stragglers among ``work_items``."""
+        thresholds = dict()
+        stragglers = list()
+        for work_item in work_items:
+            if work_item in self.copied:
+                continue
+            group = work_item.group
+            if group not in thresholds:
+                durations = self.store.get_durations(group.output_dir,
+                                                     group.lot_prefix)
+                if len(durations) >= self.min_samples:
+                    thresholds[group] = get_percentile(durations,
+                                                       self.percentile)
+                else:
+                    thresholds[group] = None
+            if thresholds[group] is None:
+                continue
+
+            lot = self.store.get_lot(group.output_dir, work_item.lot_name)
+            if (lot is None or lot['state'] != 'RUNNING'
+                    or lot['start_time'] is None):
+                continue
+            running_time = time.time()-lot['start_time']
+            if running_time > thresholds[group]:
+                stragglers.append((running_time, work_item, lot['node']))
+
+        stragglers.sort(key=lambda straggler: straggler[0], reverse=True)
+        for running_time, work_item, node in stragglers[:free_slots]:
+            copy_dir = os.path.join(work_item.group.output_dir,
+                                    speculative_dir_name, work_item.lot_name)
+            shutil.rmtree(copy_dir, ignore_errors=True)
+            os.makedirs(copy_dir)
+
+            self._write('Lot {} of {} has been running for {:.0f} seconds: '
+                        + 'submitting a copy of it\n', work_item, running_time)
+            job_id = self.submit_copy(work_item, copy_dir, node)
+            self.copies[work_item] = {'job_id': job_id, 'dir': copy_dir,
+                                      'cancelled': None}
+            self.copied.add(work_item)
+
+
+def add_speculation_arguments(parser):
+    parser.add_argument('--speculation', action='store_true',
+                        help=("A Boolean flag to run copies of the "
+                              + "straggler lots on free job slots"))
+    parser.add_argument('--speculation_percentile', type=float, default=0.9,
+                        help=("The percentile of the completed lot "
+                              + "durations after which a running lot is "
+                              + "copied when some job slots are free "
+                              + "(default: 0.9)"))
+
+
+def check_speculation_arguments(parser, args):
+    """Rejects the speculation of lots sharing their jobs.
+
+    The original job of a straggler is cancelled when its copy wins, so
+    the lots of a pack (``--pack_lots``) or of a worker (``--workers``),
+    which share their job with other lots, cannot be copied.
+    """
+    if args.speculation and (args.pack_lots > 1 or args.workers > 0):
+        parser.error('--speculation cannot be used together with '
+                     '--pack_lots greater than 1 or --workers')
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import queue
+import socket
+import threading
+
+from executors import failed_job_states
+from scratch_ledger import deferred_exit_status
+
+# the failure reason of the lots deferred because of their node scratch
+scratch_deferral = 'not enough node scratch'
+
+
+def parse_notification(line):
+    notification = dict()
+    for field in line.split():
+        key, sep, value = field.partition('=')
+        if sep != '':
+            notification[key] = value
+    return notification
+
+
+class CompletionListener:
+    def __init__(self, host=None, port=0):
+        self.notifications = queue.Queue()
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('', port))
+        self.server.listen(128)
+
+        if host is None or host == '':
+            host = socket.getfqdn()
+        self.address = '{}:{}'.format(host, self.server.getsockname()[1])
+
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            with connection:
+                connection.settimeout(10)
+                data = b''
+                try:
+                    while True:
+                        chunk = connection.recv(4096)
+                        if not chunk:
+                            break
+                        data += chunk
+                except OSError:
+                    pass
+            for line in data.decode(errors='replace').splitlines():
+                notification = parse_notification(line)
+                if 'dest' in notification and 'lot' in notification:
+                    self.notifications.put(notification)
+
+    def wait(self, timeout):
+        notifications = list()
+        try:
+            notifications.append(self.notifications.get(timeout=timeout))
+            while True:
+                notifications.append(self.notifications.get_nowait())
+        except queue.Empty:
+            pass
+        return notifications
+
+    def close(self):
+        self.server.close()
+
+
+class LotCompletionTracker:
+    """Collects the completed lots of every output directory.
+
+    Completions are learnt from the lot notifications, if a listener is
+    available, and confirmed by checking the lot ``_final.done`` file.
+    The directory globbing function ``get_completed_jobs`` is still used,
+    but only once every ``poll_interval`` seconds, to catch the lots whose
+    notifications were lost. If a ``JobStateStore`` is given, the lot
+    states are recorded in it and the completed lots of a directory already
+    known to the store are read from it rather than globbed.
+    """
+
+    def __init__(self, get_completed_jobs, listener=None, poll_interval=60,
+                 store=None):
+        self.get_completed_jobs = get_completed_jobs
+        self.listener = listener
+        self.poll_interval = poll_interval
+        self.store = store
+        self.completed = dict()
+        self.last_globs = dict()
+
+    def _key(self, done_file_dir, lot_prefix):
+        return (os.path.normpath(done_file_dir), lot_prefix)
+
+    def get_completed(self, done_file_dir, lot_prefix, zeros=0):
+        key = self._key(done_file_dir, lot_prefix)
+        completed = self.completed.setdefault(key, set())
+
+        last_glob = self.last_globs.get(key)
+        if (last_glob is None and self.store is not None
+                and self.store.has_lots(done_file_dir)):
+            completed.update(self.store.get_completed(done_file_dir, lot_prefix))
+            self.last_globs[key] = last_glob = time.time()
+
+        if last_glob is None or time.time()-last_glob >= self.poll_interval:
+            globbed = set(self.get_completed_jobs(done_file_dir, lot_prefix))
+            if self.store is not None:
+                for lot_id in globbed.difference(completed):
+                    self.store.mark_completed(done_file_dir,
+                                              '{}{}'.format(lot_prefix,
+                                                            str(lot_id).zfill(zeros)))
+            completed.update(globbed)
+            self.last_globs[key] = time.time()
+
+        return list(completed)
+
+    def forget(self, done_file_dir, lot_prefix):
+        key = self._key(done_file_dir, lot_prefix)
+        self.completed.pop(key, None)
+        self.last_globs.pop(key, None)
+
+    def _record(self, notification):
+        dest = os.path.normpath(notification['dest'])
+        lot_name = notification['lot']
+        if notification.get('event') == 'start':
+            if self.store is not None:
+                self.store.record_notification(notification)
+            return
+        done_file = os.path.join(dest, f'{lot_name}_final.done')
+        if notification.get('status', '0') != '0':
+            if os.path.exists(done_file):
+                return
+            sys.stdout.write('Lot {} in {} exited with status {}\n'.format(
+                lot_name, dest, notification['status']))
+            sys.stdout.flush()
+            if self.store is not None:
+                self.store.record_notification(notification)
+            return
+        if not os.path.exists(done_file):
+            return
+        if self.store is not None:
+            self.store.record_notification(notification)
+
+        self._add_completed(dest, lot_name)
+
+    def _add_completed(self, dest, lot_name):
+        for (done_file_dir, lot_prefix), completed in self.completed.items():
+            if (done_file_dir == dest and lot_name.startswith(lot_prefix)
+                    and lot_name[len(lot_prefix):].isdigit()):
+                completed.add(int(lot_name[len(lot_prefix):]))
+
+    def add_completed(self, dest, lot_name):
+        """Records the completion of a lot learnt by other means."""
+        dest = os.path.normpath(dest)
+        if self.store is not None:
+            self.store.mark_completed(dest, lot_name)
+        self._add_completed(dest, lot_name)
+
+    def wait(self):
+        if self.listener is None:
+            time.sleep(self.poll_interval)
+            return
+
+        for notification in self.listener.wait(self.poll_interval):
+            self._record(notification)
+
+
+class LotFailureMonitor:
+    """Detects the lots whose jobs terminated without completing them.
+
+    A lot failed if its end notification reported a non-zero exit status,
+    which the tracker records in the store, or if its job is in a failed
+    Slurm state or completed without writing the lot ``_final.done`` file.
+    The lots that exited with ``deferred_exit_status`` are reported with
+    ``scratch_deferral`` as reason and do not count against their node.
+    The executor is queried at most once every ``check_interval`` seconds.
+    The nodes on which ``node_failure_limit`` lots failed since the last
+    lot completed on them, and those that failed themselves, are excluded
+    from the following submissions, but never more than half of the nodes
+    that ran some lot.
+    """
+
+    def __init__(self, executor, store, check_interval=300,
+                 node_failure_limit=2):
+        self.executor = executor
+        self.store = store
+        self.check_interval = check_interval
+        self.node_failure_limit = node_failure_limit
+        self.last_check = time.time()
+        self.node_failures = dict()
+        self.excluded_nodes = set()
+
+    def _add_node_failure(self, node, state):
+        if node is None or node in ['', 'None assigned']:
+            return
+        last_completion = self.store.get_last_completion(node) or 0
+        failures = [failure_time
+                    for failure_time in self.node_failures.get(node, list())
+                    if failure_time > last_completion] + [time.time()]
+        self.node_failures[node] = failures
+        known_nodes = self.node_failures.keys() | set(self.store.get_nodes())
+        if (node not in self.excluded_nodes
+                and 2*(len(self.excluded_nodes)+1) <= len(known_nodes)
+                and (state == 'NODE_FAIL'
+                     or len(failures) >= self.node_failure_limit)):
+            self.excluded_nodes.add(node)
+            sys.stdout.write('Excluding node {} after {} failed lots\n'.format(
+                node, len(failures)))
+            sys.stdout.flush()
+
+    def get_failed(self, work_items):
+        """Returns the failed lots among ``work_items`` and their reasons."""
+        lots = dict()
+        for work_item in work_items:
+            lot = self.store.get_lot(work_item.group.output_dir,
+                                     work_item.lot_name)
+            if lot is not None:
+                lots[work_item] = lot
+
+        job_states = dict()
+        if time.time()-self.last_check >= self.check_interval:
+            job_states = self.executor.get_states(lot['job_id']
+                                                  for lot in lots.values()
+                                                  if lot['job_id'] is not None)
+            self.last_check = time.time()
+
+        failed = list()
+        for work_item, lot in lots.items():
+            dest = work_item.group.output_dir
+            if os.path.exists(os.path.join(dest, f'{work_item.lot_name}_final.done')):
+                continue
+
+            state, node = job_states.get(lot['job_id'], (None, lot['node']))
+            if (lot['state'] == 'FAILED'
+                    and lot['exit_code'] == deferred_exit_status):
+                reason = scratch_deferral
+            elif lot['state'] == 'FAILED':
+                reason = 'exit status {}'.format(lot['exit_code'])
+            elif state in failed_job_states:
+                reason = state
+            elif state == 'COMPLETED':
+                reason = 'missing done file'
+            else:
+                continue
+
+            if lot['state'] != 'FAILED':
+                self.store.mark_failed(dest, work_item.lot_name, node or None)
+            if reason != scratch_deferral:
+                self._add_node_failure(node or lot['node'], state)
+            failed.append((work_item, reason))
+
+        return failed
+
+    def get_exclude_options(self, exclude=''):
+        nodes = [node for node in exclude.split(',') if node != '']
+        nodes.extend(sorted(self.excluded_nodes.difference(nodes)))
+        if len(nodes) == 0:
+            return list()
+        return ['--exclude={}'.format(','.join(nodes))]
+
+
+def add_failure_arguments(parser):
+    parser.add_argument('--max_retries', type=int, default=3,
+                        help=("The number of times a failed lot is "
+                              + "resubmitted (default: 3)"))
+    parser.add_argument('--retry_delay', type=float, default=300,
+                        help=("The number of seconds before the first "
+                              + "resubmission of a failed lot, doubled at "
+                              + "every further one (default: 300)"))
+    parser.add_argument('--failure_check_interval', type=float, default=300,
+                        help=("The number of seconds between two checks "
+                              + "of the Slurm states of the running lots "
+                              + "(default: 300)"))
+    parser.add_argument('--node_failure_limit', type=int, default=2,
+                        help=("The number of failed lots after which a "
+                              + "node is excluded (default: 2)"))
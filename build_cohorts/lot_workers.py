@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import time
+import shutil
+
+from executors import failed_job_states
+from scratch_ledger import deferred_exit_status
+
+worker_shell_script = """#!/bin/bash
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=5
+
+{MODULES}
+
+WORKER_SCRATCH=${NODE_SCRATCH}/${SPN}_worker_$$
+mkdir -p ${WORKER_SCRATCH}
+
+if [ -n "${REFERENCE_CACHE_MIN_FREE}" ]; then
+    export REFERENCE_CACHE_DIR=${NODE_SCRATCH}/ProCESS_reference_cache
+    export REFERENCE_CACHE_SCRIPT={SCRIPT_DIR}ProCESS_reference_cache.sh
+fi
+export FASTQ_WRITER_SCRIPT={SCRIPT_DIR}ProCESS_fastq_writer.sh
+export STAGE_SCRIPT={SCRIPT_DIR}ProCESS_stage.sh
+export SCRATCH_LEDGER_SCRIPT={SCRIPT_DIR}ProCESS_scratch_ledger.sh
+
+{RUNNER}Rscript {SCRIPT_DIR}ProCESS_worker.R ${WORKER_DIR} ${WORKER_SCRATCH} ${WORKER_IDLE_TIME} {SCRIPT_DIR}ProCESS_seq.R
+WORKER_STATUS=$?
+
+rm -rf ${WORKER_SCRATCH}
+
+exit ${WORKER_STATUS}
+"""
+
+worker_R_script = """rm(list = ls())
+library(ProCESS)
+library(dplyr)
+
+args <- commandArgs(trailingOnly = TRUE)
+
+if (length(args) != 4) {
+  stop(paste("Syntax error: ProCESS_worker.R",
+             "<worker_dir> <node_local_dir>",
+             "<idle_time> <seq_script>"),
+       call. = FALSE)
+}
+
+worker_dir <- args[1]
+node_local_dir <- args[2]
+idle_time <- as.double(args[3])
+seq_script <- args[4]
+
+# ProCESS_seq.R finds the cache through its enclosing environment and
+# keeps the phylogenetic forest and the reference genome copy in it
+worker_cache <- new.env()
+worker_cache$ref_local_dir <- file.path(node_local_dir, "reference")
+
+notify <- function(dest, lot_name, fields) {
+  address <- Sys.getenv("NOTIFY_ADDR")
+  if (address == "") {
+    return(invisible(NULL))
+  }
+  message <- paste0("dest=", dest, " lot=", lot_name, " node=",
+                    Sys.info()[["nodename"]], " ", fields)
+  try({
+    con <- socketConnection(host = sub(":[^:]*$", "", address),
+                            port = as.integer(sub(".*:", "", address)),
+                            open = "w", timeout = 10)
+    writeLines(message, con)
+    close(con)
+  }, silent = TRUE)
+}
+
+get_lot_size <- function(dest, lot_name) {
+  lot_files <- Sys.glob(file.path(dest, "*", paste0(lot_name, "_*")))
+  sum(file.info(lot_files)$size, na.rm = TRUE)
+}
+
+# reserves the node scratch of a request in the ledger of the lot jobs
+reserve_scratch <- function(reservation, lot_scratch) {
+  if (Sys.getenv("SCRATCH_PER_NODE") == "") {
+    return(TRUE)
+  }
+  status <- system2("bash", c(Sys.getenv("SCRATCH_LEDGER_SCRIPT"), "reserve",
+                              Sys.getenv("NODE_SCRATCH"),
+                              Sys.getenv("SCRATCH_PER_NODE"), Sys.getpid(),
+                              lot_scratch, reservation))
+  status == 0
+}
+
+release_scratch <- function(reservation) {
+  if (Sys.getenv("SCRATCH_PER_NODE") != "") {
+    invisible(system2("bash", c(Sys.getenv("SCRATCH_LEDGER_SCRIPT"),
+                                "release", Sys.getenv("NODE_SCRATCH"),
+                                Sys.getpid(), reservation)))
+  }
+}
+
+# writes the usage of a request as "/usr/bin/time -v" does; the maximum
+# resident set size is the peak of the worker process so far
+write_usage <- function(usage_file, command, usage, status) {
+  elapsed <- usage[["elapsed"]]
+  cpu_time <- sum(usage[c("user.self", "sys.self",
+                          "user.child", "sys.child")], na.rm = TRUE)
+  max_rss <- 0
+  if (file.exists("/proc/self/status")) {
+    vm_hwm <- grep("^VmHWM:", readLines("/proc/self/status"), value = TRUE)
+    max_rss <- as.numeric(gsub("[^0-9]", "", vm_hwm))
+  }
+  dir.create(dirname(usage_file), showWarnings = FALSE)
+  writeLines(c(paste0("\\tCommand being timed: \\"", command, "\\""),
+               sprintf("\\tPercent of CPU this job got: %d%%",
+                       round(100*cpu_time/max(elapsed, 0.01))),
+               sprintf("\\tElapsed (wall clock) time (h:mm:ss or m:ss): %d:%02d:%05.2f",
+                       elapsed %/% 3600, (elapsed %% 3600) %/% 60,
+                       elapsed %% 60),
+               sprintf("\\tMaximum resident set size (kbytes): %.0f", max_rss),
+               sprintf("\\tExit status: %d", status)),
+             usage_file)
+}
+
+last_request <- Sys.time()
+repeat {
+  requests <- sort(list.files(worker_dir, pattern = "\\\\.request$"))
+  if (length(requests) == 0) {
+    if (file.exists(file.path(worker_dir, "stop")) ||
+        difftime(Sys.time(), last_request, units = "secs") > idle_time) {
+      break
+    }
+    Sys.sleep(1)
+    next
+  }
+
+  running_file <- file.path(worker_dir,
+                            sub("\\\\.request$", ".running", requests[1]))
+  file.rename(file.path(worker_dir, requests[1]), running_file)
+  request_args <- scan(running_file, what = character(), quiet = TRUE)
+  worker_args <- request_args[1:10]
+  worker_args[4] <- node_local_dir
+
+  dest <- worker_args[5]
+  lot_names <- strsplit(worker_args[3], ":")[[1]]
+  reservation <- paste0(worker_args[2], "_", worker_args[3])
+  if (!reserve_scratch(reservation, request_args[11])) {
+    # the builder resubmits the deferred lots without counting a failure
+    cat(paste("Deferring", reservation, ": not enough node scratch\\n"))
+    for (lot_name in lot_names) {
+      notify(dest, lot_name, "event=end status={DEFERRED_STATUS}")
+    }
+    unlink(running_file)
+    last_request <- Sys.time()
+    next
+  }
+
+  start <- as.integer(Sys.time())
+  for (lot_name in lot_names) {
+    notify(dest, lot_name, paste0("event=start start=", start))
+  }
+
+  cat(paste("Simulating", worker_args[3], "in", dest, "\\n"))
+  usage_start <- proc.time()
+  status <- tryCatch({
+    source(seq_script, local = new.env())
+    0
+  }, error = function(e) {
+    cat(paste("Error:", conditionMessage(e), "\\n"))
+    1
+  })
+  write_usage(file.path(dest, "usage", paste0("lot.", worker_args[7], ".",
+                                              worker_args[3], ".time")),
+              paste(c(seq_script, worker_args), collapse = " "),
+              proc.time() - usage_start, status)
+  release_scratch(reservation)
+
+  end <- as.integer(Sys.time())
+  for (lot_name in lot_names) {
+    notify(dest, lot_name,
+           paste0("event=end status=", status, " start=", start,
+                  " end=", end, " size=", get_lot_size(dest, lot_name)))
+  }
+  unlink(running_file)
+  last_request <- Sys.time()
+}
+
+if (!is.null(worker_cache$release_args)) {
+  invisible(system2("bash", worker_cache$release_args))
+}
+unlink(worker_cache$ref_local_dir, recursive = TRUE)
+"""
+
+
+def write_worker_scripts(modules, runner='', script_dir=''):
+    """Writes ``ProCESS_worker.sh`` and ``ProCESS_worker.R``.
+
+    ``modules`` are the commands preparing the job environment, ``runner``
+    prefixes the ``Rscript`` command (e.g., a ``singularity exec`` call),
+    and ``script_dir`` is the directory of the R scripts as seen by it.
+    """
+    with open('ProCESS_worker.R', 'w') as outstream:
+        outstream.write(worker_R_script.replace('{DEFERRED_STATUS}',
+                                                str(deferred_exit_status)))
+
+    with open('ProCESS_worker.sh', 'w') as outstream:
+        outstream.write(worker_shell_script.replace('{MODULES}', modules)
+                        .replace('{RUNNER}', runner)
+                        .replace('{SCRIPT_DIR}', script_dir))
+
+
+class LotWorkerPool:
+    """Dispatches the lots to long-lived ProCESS workers.
+
+    Every worker is a job running ``ProCESS_worker.R``, which keeps the
+    phylogenetic forest and a copy of the reference genome loaded and
+    simulates the lots queued in its directory one request at a time.
+    A request is a ``<number>.request`` file holding the ``ProCESS_seq.R``
+    arguments followed by the node scratch of its lots (in GB): the worker
+    renames it into ``<number>.running`` while simulating its lots and
+    removes it afterwards. ``submit_worker`` is called with the worker
+    directory and returns the worker job id. The workers whose jobs
+    terminated are replaced at most once every ``check_interval`` seconds.
+    The requests queued to a worker that exited idle are left to its
+    replacement and, if a ``JobStateStore`` is given, their lots are
+    marked as submitted to it, unless they were already found failed;
+    those of a failed worker are dropped, as its lots are resubmitted.
+    """
+
+    def __init__(self, executor, queue_dir, num_of_workers, submit_worker,
+                 check_interval=300, store=None):
+        self.executor = executor
+        self.submit_worker = submit_worker
+        self.check_interval = check_interval
+        self.store = store
+        self.last_check = time.time()
+        self.next_request = 0
+        self.workers = list()
+        for worker_id in range(num_of_workers):
+            worker_dir = os.path.abspath(os.path.join(queue_dir,
+                                                      f'worker_{worker_id}'))
+            shutil.rmtree(worker_dir, ignore_errors=True)
+            os.makedirs(worker_dir)
+            self.workers.append({'dir': worker_dir,
+                                 'job_id': submit_worker(worker_dir)})
+
+    def _get_requests(self, worker):
+        return (glob.glob(os.path.join(worker['dir'], '*.request'))
+                + glob.glob(os.path.join(worker['dir'], '*.running')))
+
+    def _replace_terminated(self):
+        if time.time()-self.last_check < self.check_interval:
+            return
+        job_states = self.executor.get_states(worker['job_id']
+                                              for worker in self.workers)
+        self.last_check = time.time()
+        for worker in self.workers:
+            state = job_states.get(worker['job_id'], (None, None))[0]
+            if state in failed_job_states + ['COMPLETED']:
+                sys.stdout.write('Worker {} terminated ({}): replacing '
+                                 'it\n'.format(worker['job_id'], state))
+                sys.stdout.flush()
+                old_job_id = worker['job_id']
+                worker['job_id'] = self.submit_worker(worker['dir'])
+                for request in self._get_requests(worker):
+                    if (state != 'COMPLETED' or request.endswith('.running')
+                            or not self._requeue(request, old_job_id,
+                                                 worker['job_id'])):
+                        os.unlink(request)
+
+    def _requeue(self, request, old_job_id, job_id):
+        """Marks the lots of a request as submitted to ``job_id``.
+
+        Returns ``False`` if any of them is no longer waiting for the
+        worker ``old_job_id``.
+        """
+        if self.store is None:
+            return True
+        with open(request, 'r') as instream:
+            lot_args = instream.read().split()
+        dest, lot_names = lot_args[4], lot_args[2].split(':')
+        for lot_name in lot_names:
+            lot = self.store.get_lot(dest, lot_name)
+            if (lot is None or lot['job_id'] != old_job_id
+                    or lot['state'] == 'FAILED'):
+                return False
+        for lot_name in lot_names:
+            self.store.mark_submitted(dest, lot_name, job_id)
+        return True
+
+    def submit(self, lot_args, lot_scratch):
+        """Queues a request to the least loaded worker.
+
+        ``lot_scratch`` is the node scratch of the lots, in GB. Returns the
+        job id of the worker.
+        """
+        self._replace_terminated()
+        worker = min(self.workers,
+                     key=lambda worker: len(self._get_requests(worker)))
+        request = os.path.join(worker['dir'],
+                               '{:08d}.request'.format(self.next_request))
+        self.next_request += 1
+        with open(request + '.tmp', 'w') as outstream:
+            outstream.write(' '.join(str(arg) for arg in lot_args + [lot_scratch])
+                            + '\n')
+        os.replace(request + '.tmp', request)
+        return worker['job_id']
+
+    def shutdown(self):
+        """Lets the workers exit once their queues are empty."""
+        for worker in self.workers:
+            open(os.path.join(worker['dir'], 'stop'), 'w').close()
+
+
+def add_worker_arguments(parser):
+    parser.add_argument('--workers', type=int, default=0,
+                        help=("The number of long-lived ProCESS worker "
+                              + "jobs that keep the phylogenetic forest "
+                              + "loaded and simulate the lots dispatched "
+                              + "to them (default: 0, i.e., one job per "
+                              + "lot)"))
+    parser.add_argument('--worker_time_limit', type=str, default='48:00:00',
+                        help=("The time limit of the worker jobs "
+                              + "(default: 48:00:00)"))
+    parser.add_argument('--worker_idle_time', type=float, default=600,
+                        help=("The number of seconds after which an idle "
+                              + "worker exits (default: 600)"))
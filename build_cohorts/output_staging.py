@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+import os
+
+stage_script = """#!/bin/bash
+# Moves lot outputs from the node scratch to the shared storage.
+#
+#   ProCESS_stage.sh <token_dir> <slots> <source_dir> <dest_dir> <done_file>
+#
+# Every file in <source_dir> is copied into <dest_dir> under a temporary
+# name, its MD5 checksum is compared with the one of the source, and the
+# copy is renamed into place; then, <source_dir> is removed and the
+# manifest of the files is written in <done_file>, unless it is "-". The
+# manifest lists the path of every file, relative to the directory of
+# <done_file>, its size, its number of reads (FASTQ files only), its MD5
+# checksum, and the MD5 checksum of its first and last MB (see
+# lot_manifest.py). When <slots> is positive, the copies are made holding
+# one of the <slots> tokens in <token_dir>, a directory on the shared
+# storage, so that at most <slots> stagers in the cluster write at once.
+# The tokens are flock(2) locks, which are released when their holders die.
+
+TOKEN_DIR=$1
+SLOTS=$2
+SOURCE_DIR=$3
+DEST_DIR=$4
+DONE_FILE=$5
+
+acquire_token() {
+    mkdir -p ${TOKEN_DIR}
+    while true; do
+        for (( SLOT=0; SLOT<SLOTS; SLOT++ )); do
+            exec 9>>${TOKEN_DIR}/token_${SLOT}
+            if flock -n 9; then
+                return
+            fi
+            exec 9>&-
+        done
+        sleep $(( RANDOM%10+5 ))
+    done
+}
+
+checksum() {
+    md5sum < $1 | cut -d ' ' -f 1
+}
+
+fast_checksum() {
+    { head -c 1048576 $1; tail -c 1048576 $1; } | md5sum | cut -d ' ' -f 1
+}
+
+count_reads() {
+    case $1 in
+        *.fastq.gz)
+            LINES=$(set -o pipefail; gzip -cd $1 | wc -l) || return 1
+            echo $(( LINES/4 )) ;;
+        *)
+            echo NA ;;
+    esac
+}
+
+if [ "${DONE_FILE}" == "-" ]; then
+    MANIFEST_DIR=${DEST_DIR}
+else
+    MANIFEST_DIR=$(dirname ${DONE_FILE})
+fi
+
+# the manifest only reads the node scratch: it is made before taking a token
+MANIFEST=${SOURCE_DIR}.manifest
+trap "rm -f ${MANIFEST}" EXIT
+declare -A CHECKSUMS
+printf 'file\tsize\treads\tmd5\tfast_md5\n' > ${MANIFEST}
+for SOURCE in ${SOURCE_DIR}/*; do
+    if [ ! -f "${SOURCE}" ]; then
+        continue
+    fi
+    NAME=$(basename ${SOURCE})
+    if ! READS=$(count_reads ${SOURCE}); then
+        echo "${NAME} is corrupted" >&2
+        exit 1
+    fi
+    CHECKSUMS[${NAME}]=$(checksum ${SOURCE})
+    printf '%s\t%s\t%s\t%s\t%s\n' \
+        $(realpath -m --relative-to=${MANIFEST_DIR} ${DEST_DIR}/${NAME}) \
+        $(stat -L -c %s ${SOURCE}) ${READS} \
+        ${CHECKSUMS[${NAME}]} $(fast_checksum ${SOURCE}) >> ${MANIFEST}
+done
+
+if [ "${SLOTS}" -gt 0 ]; then
+    acquire_token
+fi
+
+mkdir -p ${DEST_DIR}
+for SOURCE in ${SOURCE_DIR}/*; do
+    if [ ! -f "${SOURCE}" ]; then
+        continue
+    fi
+    NAME=$(basename ${SOURCE})
+    CHECKSUM=${CHECKSUMS[${NAME}]}
+    TMP_FILE=${DEST_DIR}/.${NAME}.staging_$(hostname)_$$
+    for ATTEMPT in 1 2 3; do
+        if cp ${SOURCE} ${TMP_FILE} && [ "$(checksum ${TMP_FILE})" == "${CHECKSUM}" ]; then
+            break
+        fi
+        echo "Failed to copy ${NAME} into ${DEST_DIR} (attempt ${ATTEMPT})" >&2
+        rm -f ${TMP_FILE}
+    done
+    if [ ! -f ${TMP_FILE} ]; then
+        exit 1
+    fi
+    mv ${TMP_FILE} ${DEST_DIR}/${NAME}
+    rm -f ${SOURCE}
+done
+
+exec 9>&-
+rm -rf ${SOURCE_DIR}
+if [ "${DONE_FILE}" != "-" ]; then
+    cp ${MANIFEST} ${DONE_FILE}.tmp_$$ && mv ${DONE_FILE}.tmp_$$ ${DONE_FILE}
+fi
+"""
+
+
+def write_stage_script():
+    with open('ProCESS_stage.sh', 'w') as outstream:
+        outstream.write(stage_script)
+
+
+def add_staging_arguments(parser):
+    parser.add_argument('--staging_slots', type=int, default=8,
+                        help=("The maximum number of lots copying their "
+                              + "outputs to the shared storage at once, in "
+                              + "background; 0 makes the lots copy them "
+                              + "before going on, without any limit "
+                              + "(default: 8)"))
+    parser.add_argument('--staging_token_dir', type=str, default=None,
+                        help=("A directory on the shared storage holding "
+                              + "the staging tokens; cohorts sharing it "
+                              + "share the staging slots (default: "
+                              + "<output_dir>/staging_tokens)"))
+
+
+def get_staging_env(args):
+    """Returns the lot environment that configures the output staging."""
+    token_dir = args.staging_token_dir
+    if token_dir is None:
+        token_dir = os.path.join(args.output_dir, 'staging_tokens')
+    return {'STAGE_SLOTS': args.staging_slots,
+            'STAGE_TOKEN_DIR': os.path.abspath(token_dir)}
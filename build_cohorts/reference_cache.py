@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+reference_cache_script = """#!/bin/bash
+# Shares the reference genome copies among the lots running on a node.
+#
+#   ProCESS_reference_cache.sh acquire <cache_dir> <reference> <pid> <min_free>
+#   ProCESS_reference_cache.sh release <cache_dir> <cached_reference> <pid>
+#
+# The copies are stored in <cache_dir>/<MD5 of the reference>, read-only,
+# and an index maps the path, the size, and the modification time of the
+# references to their MD5s, so the references are read once per node.
+# "acquire" prints the path of the cached copy and registers the process
+# <pid> as one of its users, "release" unregisters it. Before copying a
+# reference, the least recently used copies without running users are
+# evicted until the copy leaves <min_free> GB free in the cache filesystem.
+
+ACTION=$1
+CACHE_DIR=$2
+
+if [ "${ACTION}" == "release" ]; then
+    rm -f $(dirname $3)/users/$4
+    exit 0
+fi
+
+SOURCE=$(readlink -f $3)
+USER_PID=$4
+MIN_FREE=$5
+
+mkdir -p ${CACHE_DIR}/index
+exec 9>>${CACHE_DIR}/.lock
+flock 9
+
+in_use() {
+    for USER_FILE in $1/users/*; do
+        if [ -e "${USER_FILE}" ] && [ -d /proc/$(basename ${USER_FILE}) ]; then
+            return 0
+        fi
+        rm -f "${USER_FILE}"
+    done
+    return 1
+}
+
+evict() {
+    NEEDED=$(( $1/1024 + MIN_FREE*1024*1024 ))
+    while [ $(df -Pk ${CACHE_DIR} | awk 'NR==2 {print $4}') -lt ${NEEDED} ]; do
+        VICTIM=
+        for LAST_USED in $(ls -1tr ${CACHE_DIR}/*/last_used 2>/dev/null); do
+            if ! in_use $(dirname ${LAST_USED}); then
+                VICTIM=$(dirname ${LAST_USED})
+                break
+            fi
+        done
+        if [ -z "${VICTIM}" ]; then
+            return
+        fi
+        echo "Evicting the cached reference ${VICTIM}" >&2
+        rm -rf ${VICTIM}
+    done
+}
+
+# only the lock holder copies references: the other copies are stale
+rm -rf ${CACHE_DIR}/tmp_*
+
+KEY=$(stat -L -c '%n %s %Y' ${SOURCE} | md5sum | cut -d ' ' -f 1)
+HASH=$(cat ${CACHE_DIR}/index/${KEY} 2>/dev/null)
+if [ -z "${HASH}" ] || [ ! -f ${CACHE_DIR}/${HASH}/reference.fasta ]; then
+    evict $(stat -L -c %s ${SOURCE})
+
+    TMP_DIR=${CACHE_DIR}/tmp_$$
+    mkdir ${TMP_DIR}
+    if ! cp ${SOURCE} ${TMP_DIR}/reference.fasta; then
+        rm -rf ${TMP_DIR}
+        exit 1
+    fi
+    chmod a-w ${TMP_DIR}/reference.fasta
+    HASH=$(md5sum ${TMP_DIR}/reference.fasta | cut -d ' ' -f 1)
+    if [ -f ${CACHE_DIR}/${HASH}/reference.fasta ]; then
+        rm -rf ${TMP_DIR}
+    else
+        rm -rf ${CACHE_DIR}/${HASH}
+        mv ${TMP_DIR} ${CACHE_DIR}/${HASH}
+    fi
+    echo ${HASH} > ${CACHE_DIR}/index/${KEY}
+fi
+
+mkdir -p ${CACHE_DIR}/${HASH}/users
+touch ${CACHE_DIR}/${HASH}/users/${USER_PID} ${CACHE_DIR}/${HASH}/last_used
+echo ${CACHE_DIR}/${HASH}/reference.fasta
+"""
+
+
+def write_reference_cache_script():
+    with open('ProCESS_reference_cache.sh', 'w') as outstream:
+        outstream.write(reference_cache_script)
+
+
+def add_reference_cache_arguments(parser):
+    parser.add_argument('--no_reference_cache', action='store_true',
+                        help=("A Boolean flag to copy the reference genome "
+                              + "into the scratch of every lot rather than "
+                              + "sharing it among the lots of a node"))
+    parser.add_argument('--reference_cache_min_free', type=int, default=50,
+                        help=("The node scratch space, in GB, left free "
+                              + "when a reference genome enters the node "
+                              + "cache by evicting the least recently used "
+                              + "ones (default: 50)"))
+
+
+def get_reference_cache_env(args):
+    """Returns the lot environment that enables the node reference cache."""
+    if args.no_reference_cache:
+        return dict()
+    return {'REFERENCE_CACHE_MIN_FREE': args.reference_cache_min_free}
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+
+import os
+import re
+import glob
+import json
+import math
+
+usage_dir_name = 'usage'
+lot_plan_filename = 'lot_plan.json'
+
+
+def parse_elapsed(elapsed):
+    seconds = 0
+    for field in elapsed.split(':'):
+        seconds = 60*seconds + float(field)
+    return seconds
+
+
+def parse_time_report(filename):
+    """Parses the reports written by ``/usr/bin/time -v``.
+
+    A file may contain several reports, e.g., when it is written by
+    ``/usr/bin/time -a``: the elapsed times of the reports are summed up,
+    while the memory and CPU usages are their maxima. The memory usage is
+    the maximum resident set size multiplied by the number of CPUs used:
+    ``/usr/bin/time`` only reports the resident set size of the largest
+    process and the commands may fork parallel workers, e.g., by
+    ``parallel::mclapply``.
+
+    Returns ``None`` if the file does not contain any report or if any of
+    the reported commands failed.
+    """
+    reports = list()
+    with open(filename, 'r') as instream:
+        for line in instream:
+            if line.strip().startswith('Command being timed'):
+                reports.append(dict())
+                continue
+            key, sep, value = line.strip().rpartition(': ')
+            if sep == '' or len(reports) == 0:
+                continue
+            report = reports[-1]
+            if key == 'Percent of CPU this job got':
+                report['cpus'] = max(0.01, float(value.rstrip('%'))/100)
+            elif key.startswith('Elapsed (wall clock) time'):
+                report['elapsed'] = parse_elapsed(value)
+            elif key == 'Maximum resident set size (kbytes)':
+                report['max_rss'] = int(value)*1024
+            elif key == 'Exit status':
+                report['exit_status'] = int(value)
+            elif key.startswith('Command terminated by signal'):
+                report['exit_status'] = -1
+
+    reports = [report for report in reports
+               if 'elapsed' in report and 'max_rss' in report]
+    if (len(reports) == 0
+            or any(report.get('exit_status', 0) != 0 for report in reports)):
+        return None
+
+    return {'memory': max(report['max_rss']*math.ceil(report.get('cpus', 1))
+                          for report in reports),
+            'cpus': max(report.get('cpus', 1) for report in reports),
+            'elapsed': sum(report['elapsed'] for report in reports)}
+
+
+def read_lot_plan(output_dir):
+    filename = os.path.join(output_dir, lot_plan_filename)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as instream:
+        return json.load(instream)
+
+
+def format_time_limit(seconds):
+    seconds = math.ceil(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds//3600, (seconds//60) % 60,
+                                     seconds % 60)
+
+
+class ResourceRequest:
+    """The memory (in GB), CPUs, and time limit (in seconds) of a job."""
+
+    def __init__(self, memory, cpus, time_limit):
+        self.memory = memory
+        self.cpus = cpus
+        self.time_limit = time_limit
+
+    def get_options(self):
+        return ['--mem={}G'.format(self.memory),
+                '--cpus-per-task={}'.format(self.cpus),
+                '--time={}'.format(format_time_limit(self.time_limit))]
+
+    def __str__(self):
+        return '{}GB, {} CPUs, {}'.format(self.memory, self.cpus,
+                                          format_time_limit(self.time_limit))
+
+
+def get_script_request(script):
+    """Returns the resources requested by the ``#SBATCH`` lines of a script."""
+    memory, cpus, time_limit = 1, 1, 3600
+    with open(script, 'r') as script_file:
+        for line in script_file:
+            match = re.match(r'#SBATCH\s+--mem[= ](\d+)([KMGT]?)B?\s*$', line)
+            if match:
+                scale = {'K': 1/1024**2, 'M': 1/1024, '': 1/1024,
+                         'G': 1, 'T': 1024}[match.group(2)]
+                memory = math.ceil(int(match.group(1))*scale)
+            match = re.match(r'#SBATCH\s+--cpus-per-task[= ](\d+)', line)
+            if match:
+                cpus = int(match.group(1))
+            match = re.match(r'#SBATCH\s+--time[= ]([\d:]+)\s*$', line)
+            if match:
+                time_limit = parse_elapsed(match.group(1))
+                if ':' not in match.group(1):
+                    time_limit *= 60
+
+    return ResourceRequest(memory, cpus, time_limit)
+
+
+class ResourceSizer:
+    """Sizes the job requests from the resource usage of earlier jobs.
+
+    The job scripts write the ``/usr/bin/time -v`` reports of their
+    commands in the ``usage`` directories of the cohort purity directories
+    in files named ``<job>.<sequencing type>.<name>.time``, where the name
+    of a job simulating several lots lists them separated by colons and
+    its elapsed time is split among them. The sizer reads them from the
+    current cohort and from the cohorts of earlier SPNs, and it sets the
+    memory and the time limit of a job to the observed peaks plus a margin
+    and its CPUs to the observed CPU usage plus a margin.
+    The lot measurements of the cohorts having a lot plan are rescaled to
+    the coverage of the requested lots.
+    The reports of the ``/usr/bin/time`` calls in the ``TIME`` directories
+    of the lots only bound the lot memory from below, as they measure
+    single lot steps.
+    """
+
+    def __init__(self, cohort_dirs, margin=0.2, min_samples=3,
+                 min_time_limit=600):
+        self.cohort_dirs = list(cohort_dirs)
+        self.margin = margin
+        self.min_samples = min_samples
+        self.min_time_limit = min_time_limit
+        self.measurements = dict()
+
+    def refresh(self):
+        for cohort_dir in self.cohort_dirs:
+            plan = read_lot_plan(cohort_dir)
+            lot_coverages = dict() if plan is None else plan['lot_coverages']
+
+            pattern = os.path.join(cohort_dir, '*', 'purity_*',
+                                   usage_dir_name, '*.time')
+            for filename in glob.glob(pattern):
+                if filename not in self.measurements:
+                    job, seq_type, name = os.path.basename(filename).split('.', 2)
+                    self._add(filename, job, seq_type, True,
+                              lot_coverages.get(seq_type), name.count(':')+1)
+
+            pattern = os.path.join(cohort_dir, '*', 'purity_*', 'TIME', 'out_*')
+            for filename in glob.glob(pattern):
+                if filename not in self.measurements:
+                    seq_type = os.path.basename(os.path.dirname(
+                        os.path.dirname(os.path.dirname(filename))))
+                    self._add(filename, 'lot', seq_type, False,
+                              lot_coverages.get(seq_type))
+
+    def _add(self, filename, job, seq_type, whole_job, lot_coverage=None,
+             num_of_lots=1):
+        try:
+            measurement = parse_time_report(filename)
+        except (OSError, ValueError):
+            return
+        if measurement is None:
+            return
+        measurement['elapsed'] /= num_of_lots
+        measurement.update({'job': job, 'seq_type': seq_type,
+                            'whole_job': whole_job,
+                            'lot_coverage': lot_coverage})
+        self.measurements[filename] = measurement
+
+    def get_measurements(self, job, seq_type):
+        return [measurement for measurement in self.measurements.values()
+                if measurement['job'] == job
+                and measurement['seq_type'] == seq_type]
+
+    def get_request(self, job, seq_type, default, min_memory=1,
+                    lot_coverage=None, min_cpus=1):
+        """Returns the request of a job given its default request.
+
+        The default request is kept if less than ``min_samples`` jobs of
+        the same kind completed. When ``lot_coverage`` is given, the
+        elapsed times of the measured lots are scaled by the ratio between
+        it and their coverage, while their memory peaks are only scaled
+        up, as most of the lot memory does not depend on the coverage. The
+        CPUs range from ``min_cpus``, i.e., the threads used by the job, to
+        the default ones.
+        """
+        measurements = self.get_measurements(job, seq_type)
+        whole_jobs = [measurement for measurement in measurements
+                      if measurement['whole_job']]
+        if len(whole_jobs) < self.min_samples:
+            return default
+
+        def get_scale(measurement):
+            if lot_coverage is None or not measurement['lot_coverage']:
+                return 1
+            return lot_coverage/measurement['lot_coverage']
+
+        peak_memory = max(measurement['memory']*max(1, get_scale(measurement))
+                          for measurement in measurements)
+        memory = math.ceil(peak_memory*(1+self.margin)/1024**3)
+
+        peak_cpus = max(measurement['cpus'] for measurement in whole_jobs)
+        cpus = min(default.cpus, max(min_cpus,
+                                     math.ceil(peak_cpus*(1+self.margin))))
+
+        peak_time = max(measurement['elapsed']*get_scale(measurement)
+                        for measurement in whole_jobs)
+        time_limit = max(self.min_time_limit,
+                         60*math.ceil(peak_time*(1+self.margin)/60))
+
+        return ResourceRequest(max(memory, min_memory), max(cpus, 1),
+                               time_limit)
+
+
+def get_max_request(requests):
+    requests = list(requests)
+    return ResourceRequest(max(request.memory for request in requests),
+                           max(request.cpus for request in requests),
+                           max(request.time_limit for request in requests))
+
+
+def add_resource_arguments(parser):
+    parser.add_argument('-U', '--usage_dirs', type=str, nargs='*', default=[],
+                        help=("The output directories of earlier cohorts "
+                              + "whose job resource usage sizes the job "
+                              + "requests of this cohort"))
+    parser.add_argument('--resource_margin', type=float, default=0.2,
+                        help=("The margin added to the observed resource "
+                              + "usage peaks (default: 0.2)"))
+    parser.add_argument('--fixed_resources', action='store_true',
+                        help=("A Boolean flag to use the default resource "
+                              + "requests of the job scripts"))
+
+
+def create_resource_sizer(args):
+    if args.fixed_resources:
+        return None
+    return ResourceSizer([args.output_dir] + args.usage_dirs,
+                         args.resource_margin)
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import math
+
+scratch_ledger_script = """#!/bin/bash
+# Reserves node scratch space for the lots in a per-node ledger.
+#
+#   ProCESS_scratch_ledger.sh reserve <node_scratch> <capacity> <pid> <size> <name>
+#   ProCESS_scratch_ledger.sh release <node_scratch> <pid> <name>
+#
+# The ledger <node_scratch>/.ProCESS_scratch_ledger lists the reservations
+# of the running lots: the PID of the process owning them, their size (in
+# GB), and their name. The reservations of dead processes are dropped.
+# "reserve" grants a reservation if it fits in <capacity> GB together with
+# the others, or if there are no others, and fails at once otherwise, so
+# that the lot does not wait for the scratch in its job allocation.
+
+ACTION=$1
+LEDGER=$2/.ProCESS_scratch_ledger
+
+mkdir -p $2
+touch ${LEDGER}
+exec 9>>${LEDGER}.lock
+flock 9
+
+if [ "${ACTION}" == "release" ]; then
+    grep -v "^$3 [0-9]* $4\\$" ${LEDGER} > ${LEDGER}.$$
+    mv ${LEDGER}.$$ ${LEDGER}
+    exit 0
+fi
+
+CAPACITY=$3
+OWNER=$4
+SIZE=$5
+NAME=$6
+
+USED=0
+while read PID RESERVED RESERVATION; do
+    if [ -d /proc/${PID} ]; then
+        echo "${PID} ${RESERVED} ${RESERVATION}"
+        USED=$((USED+RESERVED))
+    fi
+done < ${LEDGER} > ${LEDGER}.$$
+
+STATUS=1
+if [ ${USED} -eq 0 ] || [ $((USED+SIZE)) -le ${CAPACITY} ]; then
+    echo "${OWNER} ${SIZE} ${NAME}" >> ${LEDGER}.$$
+    STATUS=0
+else
+    echo "${SIZE}GB of node scratch needed, ${USED}GB of ${CAPACITY}GB reserved" >&2
+fi
+mv ${LEDGER}.$$ ${LEDGER}
+exit ${STATUS}
+"""
+
+# the exit status of the lots deferred because their node scratch is full:
+# the builders resubmit them without counting a failure
+deferred_exit_status = 75
+
+
+def write_scratch_ledger_script():
+    with open('ProCESS_scratch_ledger.sh', 'w') as outstream:
+        outstream.write(scratch_ledger_script)
+
+
+def estimate_lot_scratch(lot_coverage, num_of_samples, scratch_per_x):
+    """Estimates the node scratch space, in GB, used by a lot.
+
+    A lot writes its per-chromosome SAM files, their merged BAM file, and
+    the gzipped FASTQ files of its samples into the node scratch
+    directory. All of them grow linearly with the lot coverage and with
+    the number of samples, hence the estimate is their product times the
+    space used per sample and per coverage unit.
+    """
+    return max(1, math.ceil(lot_coverage*num_of_samples*scratch_per_x))
+
+
+def add_scratch_arguments(parser):
+    parser.add_argument('--scratch_per_x', type=float, default=5,
+                        help=("The node scratch space used by a lot per "
+                              + "sample and per coverage unit (in GB, "
+                              + "default: 5)"))
+    parser.add_argument('--num_of_samples', type=int, default=3,
+                        help=("The number of tumour samples assumed until "
+                              + "the FASTQ files of the first lot are "
+                              + "available (default: 3)"))
+    parser.add_argument('--scratch_gres', type=str, default=None,
+                        help=("The name of a consumable Slurm GRES that "
+                              + "counts the GB of node scratch; when it is "
+                              + "given, the lots request their scratch as "
+                              + "this GRES rather than reserving it in the "
+                              + "node scratch ledger"))
+
+
+def get_scratch_env(args):
+    """Returns the lot environment that enables the node scratch ledger."""
+    if args.scratch_gres is not None:
+        return dict()
+    return {'SCRATCH_PER_NODE': math.floor(args.scratch_per_node)}
+
+
+def get_scratch_options(args, lot_scratch):
+    if args.scratch_gres is None:
+        return list()
+    return ['--gres={}:{}'.format(args.scratch_gres, lot_scratch)]
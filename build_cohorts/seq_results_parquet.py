@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import shlex
+import argparse
+import tempfile
+import subprocess
+
+converter_R_script = """rm(list = ls())
+args <- commandArgs(trailingOnly = TRUE)
+
+if (length(args) == 0) {
+  stop(paste("Syntax error: ProCESS_seq_results_to_parquet.R",
+             "<RDS file> [<RDS file> ...]"),
+       call. = FALSE)
+}
+
+save_seq_results_parquet <- function(seq_results, rds_file) {
+    parquet_dir <- paste0(tools::file_path_sans_ext(rds_file), ".parquet")
+    tmp_dir <- paste0(parquet_dir, ".tmp_", Sys.getpid())
+    arrow::write_dataset(dplyr::ungroup(seq_results), tmp_dir,
+                         format = "parquet", partitioning = "chr")
+    unlink(parquet_dir, recursive = TRUE)
+    if (!file.rename(tmp_dir, parquet_dir)) {
+        stop(paste("Failed to rename", tmp_dir, "into", parquet_dir))
+    }
+}
+
+for (rds_file in args) {
+    message(paste0("Converting ", rds_file, "..."))
+    save_seq_results_parquet(readRDS(rds_file), rds_file)
+}
+"""
+
+converter_filename = 'ProCESS_seq_results_to_parquet.R'
+
+# the mutation tables of the lots and the merged ones, as saved by the
+# cohort builders
+seq_results_patterns = [os.path.join('*', 'purity_*', 'data',
+                                     'seq_results_*.rds'),
+                        os.path.join('*', 'purity_*', 'data', 'mutations',
+                                     'seq_results_muts_*.rds')]
+
+
+def get_parquet_dir(rds_file):
+    return os.path.splitext(rds_file)[0] + '.parquet'
+
+
+def find_unconverted_seq_results(cohort_dir, force=False):
+    """Returns the mutation tables of a cohort lacking up-to-date Parquet
+    copies."""
+    rds_files = list()
+    for pattern in seq_results_patterns:
+        rds_files.extend(glob.glob(os.path.join(cohort_dir, pattern)))
+
+    unconverted = list()
+    for rds_file in sorted(rds_files):
+        parquet_dir = get_parquet_dir(rds_file)
+        if (force or not os.path.exists(parquet_dir)
+                or os.path.getmtime(parquet_dir) < os.path.getmtime(rds_file)):
+            unconverted.append(rds_file)
+    return unconverted
+
+
+def read_seq_results(parquet_dir, columns=None, chromosomes=None):
+    """Reads a Parquet mutation table as a ``pyarrow.Table``.
+
+    Only the ``columns`` and the ``chromosomes`` given, if any, are read
+    from the memory-mapped files.
+    """
+    import pyarrow
+    import pyarrow.dataset
+
+    partitioning = pyarrow.dataset.partitioning(
+        pyarrow.schema([('chr', pyarrow.string())]), flavor='hive')
+    dataset = pyarrow.dataset.dataset(parquet_dir, format='parquet',
+                                      partitioning=partitioning)
+    row_filter = None
+    if chromosomes is not None:
+        row_filter = pyarrow.dataset.field('chr').isin(
+            [str(chromosome) for chromosome in chromosomes])
+    return dataset.to_table(columns=columns, filter=row_filter)
+
+
+def add_parquet_arguments(parser):
+    parser.add_argument('--seq_results_parquet', action='store_true',
+                        help=("Save the mutation tables also as Parquet "
+                              + "datasets partitioned by chromosome (it "
+                              + "requires the R package arrow)"))
+
+
+def get_parquet_env(args):
+    """Returns the lot environment enabling the Parquet mutation tables."""
+    if args.seq_results_parquet:
+        return {'SEQ_RESULTS_PARQUET': 1}
+    return {}
+
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(prog=sys.argv[0],
+                                     description=('Converts the mutation '
+                                                  + 'tables of a cohort into '
+                                                  + 'Parquet datasets '
+                                                  + 'partitioned by '
+                                                  + 'chromosome'))
+    parser.add_argument('cohort_dir', type=str,
+                        help="The output directory of a cohort builder")
+    parser.add_argument('-R', '--rscript', type=str, default='Rscript',
+                        help=("The command running the R scripts, e.g., "
+                              + "\"singularity exec <image> Rscript\" "
+                              + "(default: Rscript)"))
+    parser.add_argument('-f', '--force', action='store_true',
+                        help=("Convert also the tables having up-to-date "
+                              + "Parquet datasets"))
+
+    args = parser.parse_args()
+
+    rds_files = find_unconverted_seq_results(args.cohort_dir, args.force)
+    if len(rds_files) == 0:
+        sys.stdout.write('All the mutation tables are converted\n')
+        sys.exit(0)
+
+    sys.stdout.write('Converting {} mutation tables...\n'.format(len(rds_files)))
+    sys.stdout.flush()
+    with tempfile.TemporaryDirectory() as work_dir:
+        script = os.path.join(work_dir, converter_filename)
+        with open(script, 'w') as outstream:
+            outstream.write(converter_R_script)
+
+        cmd = shlex.split(args.rscript) + [script] + rds_files
+        sys.exit(subprocess.run(cmd).returncode)
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import sqlite3
+
+state_db_filename = 'cohort_state.sqlite'
+
+
+class JobStateStore:
+    """Records the state of the lots of a cohort in an SQLite database.
+
+    The database is stored in the cohort output directory and it holds one
+    row per lot, identified by its output directory and name, with its
+    state, Slurm job id, node, timestamps, exit code, and output size.
+    The submitter is the only writer: the lot scripts report their start
+    and end through the lot notifications (see ``lot_tracking.py``), so
+    that the database is never written concurrently from the nodes.
+    """
+
+    def __init__(self, output_dir):
+        self.filename = os.path.join(output_dir, state_db_filename)
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS lots (
+                dest TEXT NOT NULL,
+                lot TEXT NOT NULL,
+                state TEXT NOT NULL,
+                job_id TEXT,
+                node TEXT,
+                submit_time REAL,
+                start_time REAL,
+                end_time REAL,
+                exit_code INTEGER,
+                output_size INTEGER,
+                PRIMARY KEY (dest, lot))""")
+        self.connection.execute("""
+            CREATE INDEX IF NOT EXISTS lots_by_state ON lots (dest, state)""")
+        self.connection.commit()
+
+    def _upsert(self, dest, lot, reset=False, **fields):
+        dest = os.path.normpath(dest)
+        if not reset:
+            fields = {column: value for column, value in fields.items()
+                      if value is not None}
+        columns = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        updates = ', '.join(f'{column}=excluded.{column}' for column in fields)
+        with self.connection:
+            self.connection.execute(
+                f'INSERT INTO lots (dest, lot, {columns}) '
+                + f'VALUES (?, ?, {placeholders}) '
+                + f'ON CONFLICT (dest, lot) DO UPDATE SET {updates}',
+                [dest, lot] + list(fields.values()))
+
+    def mark_submitted(self, dest, lot, job_id):
+        self._upsert(dest, lot, reset=True, state='SUBMITTED', job_id=job_id,
+                     submit_time=time.time(), node=None, start_time=None,
+                     end_time=None, exit_code=None, output_size=None)
+
+    def mark_running(self, dest, lot, node=None, start_time=None):
+        self._upsert(dest, lot, state='RUNNING', node=node,
+                     start_time=start_time)
+
+    def mark_completed(self, dest, lot, node=None, end_time=None,
+                       exit_code=0, output_size=None):
+        self._upsert(dest, lot, state='COMPLETED', node=node,
+                     end_time=end_time, exit_code=exit_code,
+                     output_size=output_size)
+
+    def mark_failed(self, dest, lot, node=None, end_time=None,
+                    exit_code=None):
+        self._upsert(dest, lot, state='FAILED', node=node,
+                     end_time=end_time, exit_code=exit_code)
+
+    def get_lot(self, dest, lot):
+        cursor = self.connection.execute(
+            'SELECT * FROM lots WHERE dest=? AND lot=?',
+            [os.path.normpath(dest), lot])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def get_last_completion(self, node):
+        cursor = self.connection.execute(
+            "SELECT MAX(end_time) FROM lots WHERE node=? AND state='COMPLETED'",
+            [node])
+        return cursor.fetchone()[0]
+
+    def get_nodes(self):
+        cursor = self.connection.execute(
+            'SELECT DISTINCT node FROM lots WHERE node IS NOT NULL')
+        return [node for node, in cursor.fetchall()]
+
+    def has_lots(self, dest):
+        cursor = self.connection.execute(
+            'SELECT 1 FROM lots WHERE dest=? LIMIT 1',
+            [os.path.normpath(dest)])
+        return cursor.fetchone() is not None
+
+    def get_lots(self, dest, lot_prefix, state):
+        cursor = self.connection.execute(
+            'SELECT lot FROM lots WHERE dest=? AND state=? AND lot LIKE ?',
+            [os.path.normpath(dest), state, f'{lot_prefix}%'])
+        return [lot for lot, in cursor.fetchall()]
+
+    def get_completed(self, dest, lot_prefix):
+        return [int(lot[len(lot_prefix):])
+                for lot in self.get_lots(dest, lot_prefix, 'COMPLETED')
+                if lot[len(lot_prefix):].isdigit()]
+
+    def get_durations(self, dest, lot_prefix):
+        cursor = self.connection.execute(
+            "SELECT end_time-start_time FROM lots WHERE dest=? AND lot LIKE ? "
+            + "AND state='COMPLETED' AND start_time IS NOT NULL "
+            + "AND end_time IS NOT NULL",
+            [os.path.normpath(dest), f'{lot_prefix}%'])
+        return [duration for duration, in cursor.fetchall()]
+
+    def reset(self, dest, lot_prefix):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM lots WHERE dest=? AND lot LIKE ?',
+                [os.path.normpath(dest), f'{lot_prefix}%'])
+
+    def record_notification(self, notification):
+        def get_number(key, convert=float):
+            try:
+                return convert(notification[key])
+            except (KeyError, ValueError):
+                return None
+
+        dest = notification['dest']
+        lot = notification['lot']
+        node = notification.get('node')
+        if notification.get('event') == 'start':
+            self.mark_running(dest, lot, node, get_number('start'))
+            return
+
+        end_time = get_number('end')
+        if end_time is None:
+            end_time = time.time()
+        exit_code = get_number('status', int)
+        if exit_code == 0:
+            self.mark_completed(dest, lot, node, end_time, exit_code,
+                                get_number('size', int))
+        else:
+            self.mark_failed(dest, lot, node, end_time, exit_code)
+
+    def reconcile(self):
+        """Marks as completed the lots whose done file has been written."""
+        cursor = self.connection.execute(
+            "SELECT dest, lot FROM lots WHERE state!='COMPLETED'")
+        for dest, lot in cursor.fetchall():
+            if os.path.exists(os.path.join(dest, f'{lot}_final.done')):
+                self.mark_completed(dest, lot)
+
+    def get_summary(self):
+        cursor = self.connection.execute(
+            'SELECT dest, state, COUNT(*), SUM(output_size) FROM lots '
+            + 'GROUP BY dest, state ORDER BY dest, state')
+        return cursor.fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def write_status(store, outstream=sys.stdout):
+    summary = dict()
+    for dest, state, num_of_lots, output_size in store.get_summary():
+        dest_summary = summary.setdefault(dest, {'size': 0})
+        dest_summary[state] = num_of_lots
+        dest_summary['size'] += output_size or 0
+
+    states = ['SUBMITTED', 'RUNNING', 'COMPLETED', 'FAILED']
+    outstream.write('{:<40} {}  {:>10}\n'.format('directory',
+                                                 ' '.join(f'{state:>9}' for state in states),
+                                                 'size (GB)'))
+    for dest, dest_summary in summary.items():
+        outstream.write('{:<40} {}  {:>10.1f}\n'.format(
+            dest, ' '.join('{:>9}'.format(dest_summary.get(state, 0))
+                           for state in states),
+            dest_summary['size']/1e9))
@@ -0,0 +1,51 @@
+from benchmark_submitter import collect_metrics, get_idle_gaps
+
+
+def get_lot(name, purity=0.3):
+    return {'dest': 'purity_{}'.format(purity), 'type': 'tumour',
+            'purity': str(purity), 'lot': name}
+
+
+def test_get_idle_gaps():
+    assert get_idle_gaps([(0, 5), (2, 4), (7, 9), (8, 12), (13, 14)]) == [2,
+                                                                          1]
+
+
+def test_metrics_count_the_lot_jobs():
+    records = [{'submit_time': 0, 'start_time': 1, 'end_time': 5,
+                'lot': get_lot('t0')},
+               {'submit_time': 0, 'start_time': 1, 'end_time': 9,
+                'lot': get_lot('t1')},
+               {'submit_time': 0, 'start_time': 5, 'end_time': 10,
+                'lot': get_lot('t2', 0.6)},
+               {'submit_time': 0, 'sbatch_seconds': 0.5}]
+
+    metrics = collect_metrics(records, 2)
+    assert metrics['lots'] == 3
+    assert metrics['makespan'] == 10
+    assert metrics['slot_utilisation'] == 0.85
+    assert metrics['refill_latency_max'] == 0
+    assert metrics['purities']['tumour 0.3']['lots'] == 2
+    assert metrics['purities']['tumour 0.6']['first_start'] == 5
+
+
+def test_metrics_count_the_lots_of_the_packs():
+    records = [{'submit_time': 0, 'start_time': 1, 'end_time': 5,
+                'lot': get_lot('t0')},
+               {'submit_time': 0, 'start_time': 1, 'end_time': 9,
+                'lot': get_lot('t1:t2'),
+                'pack_lots': [{'lot': get_lot('t1'), 'submit_time': 0,
+                               'start_time': 1, 'end_time': 5},
+                              {'lot': get_lot('t2'), 'submit_time': 0,
+                               'start_time': 5, 'end_time': 9}]},
+               {'submit_time': 0, 'start_time': 0, 'end_time': 10,
+                'worker_lots': [{'lot': get_lot('t3', 0.6), 'submit_time': 2,
+                                 'start_time': 2, 'end_time': 10}]},
+               {'submit_time': 0, 'sbatch_seconds': 0.5}]
+
+    metrics = collect_metrics(records, 2)
+    assert metrics['lots'] == 4
+    assert metrics['makespan'] == 10
+    assert metrics['slot_utilisation'] == 1
+    assert metrics['purities']['tumour 0.3']['lots'] == 3
+    assert metrics['purities']['tumour 0.6']['lots'] == 1
@@ -0,0 +1,175 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+import build_cohort
+import benchmark_build_cohort
+import benchmark_build_cohort_general
+from fake_slurm import FakeSlurm, install_commands
+from output_staging import stage_script
+
+builders = [build_cohort, benchmark_build_cohort,
+            benchmark_build_cohort_general]
+
+
+def run_builder(tmp_path, builder_args, builder='build_cohort.py'):
+    state_dir = str(tmp_path / 'fake_slurm')
+    bin_dir = str(tmp_path / 'bin')
+    install_commands(bin_dir, state_dir)
+
+    phylogenetic_forest = tmp_path / 'phylo_forest.sff'
+    phylogenetic_forest.touch()
+
+    env = dict(os.environ,
+               PATH='{}:{}'.format(bin_dir, os.environ.get('PATH', '')),
+               FAKE_SLURM_DIR=state_dir, FAKE_SLURM_SLOTS='4',
+               FAKE_SLURM_MODE='model', FAKE_SLURM_TIME_SCALE='0.0001')
+    cmd = [sys.executable,
+           os.path.join(os.path.dirname(os.path.abspath(__file__)), builder),
+           'SPN01', str(phylogenetic_forest), str(tmp_path / 'cohort'),
+           '-P', 'fake', '-A', 'fake'] + builder_args
+    process = subprocess.run(cmd, env=env, cwd=str(tmp_path),
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+
+    # the jobs are not needed once they have been submitted
+    fake_slurm = FakeSlurm(state_dir)
+    records = fake_slurm.records()
+    fake_slurm.cancel(set(record['job_id'] for record in records))
+
+    assert process.returncode == 0, process.stdout
+    return records
+
+
+def get_job(records, suffix):
+    jobs = [record for record in records if record['name'].endswith(suffix)]
+    assert len(set(record['job_id'] for record in jobs)) == 1
+    return jobs
+
+
+def test_array_lots_are_read_from_the_lot_table(tmp_path):
+    records = run_builder(tmp_path, ['--array_jobs', '--parallel_jobs', '7'])
+    lot_tasks = get_job(records, '_lots')
+    assert sorted(task['array_task'] for task in lot_tasks) == list(range(160))
+    assert all(task['throttle'] == 7 for task in lot_tasks)
+
+    # one line per array task with the lot output directory and name
+    with open(lot_tasks[0]['env']['LOT_TABLE']) as table:
+        lots = [line.split() for line in table.read().splitlines()]
+    assert len(lots) == 160
+    assert len(set((lot[0], lot[4]) for lot in lots)) == 160
+    assert [lot[2] for lot in lots].count('tumour') == 120
+
+
+def test_dag_reaches_the_sample_sheets(tmp_path):
+    records = run_builder(tmp_path, ['--dag'], 'benchmark_build_cohort.py')
+    sample_sheets, = get_job(records, '_sample_sheets')
+    gender = get_job(records, '_gender.sh')
+    lot_tasks = get_job(records, '_lots')
+
+    ancestors = set()
+    dependencies = list(sample_sheets['dependencies'])
+    while len(dependencies) != 0:
+        job_id = dependencies.pop()
+        for record in records:
+            if (job_id in [record['id'], record['job_id']]
+                    and record['id'] not in ancestors):
+                ancestors.add(record['id'])
+                dependencies.extend(record['dependencies'])
+    assert ancestors == set(record['id'] for record in gender + lot_tasks)
+
+    # every merging job waits for the lots of its purity
+    lot_task_ids = set(task['id'] for task in lot_tasks)
+    merges = [record for record in records
+              if record['name'].startswith('merge_')]
+    assert len(merges) == 4
+    for merge in merges:
+        assert set(merge['dependencies']) <= lot_task_ids
+    assert sorted(task_id for merge in merges
+                  for task_id in merge['dependencies']) == sorted(lot_task_ids)
+
+
+def test_dag_sample_sheets_depend_on_the_lot_array(tmp_path):
+    records = run_builder(tmp_path, ['--dag', '--parallel_jobs', '7'])
+
+    lot_tasks = get_job(records, '_lots')
+    assert all(task['throttle'] == 7 for task in lot_tasks)
+
+    sample_sheets, = get_job(records, '_sample_sheets')
+    assert lot_tasks[0]['job_id'] in sample_sheets['dependencies']
+
+
+@pytest.fixture(scope='module')
+def lot_scripts(tmp_path_factory):
+    """Returns the lot environment and the scripts written by the builder."""
+    tmp_path = tmp_path_factory.mktemp('lot_scripts')
+    records = run_builder(tmp_path, ['--dag', '--shard_chromosomes',
+                                     '--stream_sams', '--fastq_only',
+                                     '--staging_slots', '3'])
+    scripts = dict()
+    for filename in os.listdir(str(tmp_path)):
+        if filename.startswith('ProCESS_'):
+            with open(str(tmp_path / filename)) as script:
+                scripts[filename] = script.read()
+    assert scripts['ProCESS_seq.R'] == build_cohort.R_script
+
+    return get_job(records, '_lots')[0]['env'], scripts
+
+
+def assert_in_R_scripts(*commands):
+    for builder in builders:
+        for command in commands:
+            assert command in builder.R_script
+
+
+def test_lot_chromosomes_are_simulated_longest_first(lot_scripts):
+    env, _ = lot_scripts
+    assert env['SHARD_CHROMOSOMES'] == '1'
+    assert_in_R_scripts('Sys.getenv("SHARD_CHROMOSOMES")',
+                        'tasks[order(tasks$length, decreasing = TRUE), ]')
+
+
+def test_chromosome_sams_are_streamed_into_bams(lot_scripts):
+    env, _ = lot_scripts
+    assert env['STREAM_SAMS'] == '1'
+    assert_in_R_scripts('Sys.getenv("STREAM_SAMS")',
+                        'system2("mkfifo", SAM_pipe)',
+                        'c("view", "-b", "-o", paste0(chr_file, ".bam")')
+
+
+def test_chromosome_files_are_concatenated():
+    assert_in_R_scripts('paste("samtools cat -h", header_file, "-o", BAM_file',
+                        '"samtools merge -fc -@"')
+
+
+def test_fastq_only_lots_skip_the_lot_bam(lot_scripts):
+    env, _ = lot_scripts
+    assert env['FASTQ_ONLY'] == '1'
+    assert_in_R_scripts('Sys.getenv("FASTQ_ONLY")',
+                        'if (!fastq_only && !file.exists(bam_dir))')
+
+
+def test_fastqs_are_routed_in_a_single_pass():
+    assert_in_R_scripts("'/^@/ { header = header $0 ORS; next }'",
+                        "'  print | writers[rg]'")
+
+
+def test_samtools_threads_share_the_lot_cpus(lot_scripts):
+    _, scripts = lot_scripts
+    assert '#SBATCH --cpus-per-task=5' in scripts['ProCESS_seq.sh']
+    assert_in_R_scripts('Sys.getenv("SLURM_CPUS_PER_TASK")',
+                        'get_samtools_threads <- function(num_of_threads, '
+                        'num_of_processes = 1)')
+
+
+def test_lot_outputs_are_staged_through_the_staging_slots(lot_scripts):
+    env, scripts = lot_scripts
+    assert env['STAGE_SLOTS'] == '3'
+    assert env['STAGE_TOKEN_DIR'].endswith(os.path.join('cohort',
+                                                        'staging_tokens'))
+    assert 'export STAGE_SCRIPT=ProCESS_stage.sh' in scripts['ProCESS_seq.sh']
+    assert scripts['ProCESS_stage.sh'] == stage_script
+    assert_in_R_scripts('Sys.getenv("STAGE_SLOTS", "0")',
+                        'stagers[[length(stagers) + 1]] <<- parallel::mcparallel(')
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from executors import SlurmExecutor, expand_array_indices
+
+
+def write_fake_sbatch(bin_dir, body):
+    sbatch = bin_dir / 'sbatch'
+    sbatch.write_text('#!/bin/bash\n' + body + '\n')
+    sbatch.chmod(0o755)
+
+
+def test_submit_returns_the_job_id(tmp_path, monkeypatch):
+    write_fake_sbatch(tmp_path, 'echo "1234;cluster"')
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+
+    executor = SlurmExecutor('account', 'partition')
+    assert executor.submit('job.sh') == '1234'
+
+
+def test_submit_raises_when_sbatch_fails(tmp_path, monkeypatch):
+    write_fake_sbatch(tmp_path, 'echo "invalid account" >&2; exit 1')
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+
+    executor = SlurmExecutor('account', 'partition')
+    with pytest.raises(RuntimeError, match='invalid account'):
+        executor.submit('job.sh', dependencies=['1', '2'])
+
+
+def test_expand_array_indices():
+    assert expand_array_indices('0-3,7,9-10') == [0, 1, 2, 3, 7, 9, 10]
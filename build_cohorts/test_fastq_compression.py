@@ -0,0 +1,24 @@
+import argparse
+
+import pytest
+
+from fastq_compression import (add_compression_arguments, get_compression_env,
+                               parse_compression_profile)
+
+
+def test_parse_compression_profile():
+    assert parse_compression_profile('pigz') == ('pigz', 6)
+    assert parse_compression_profile('libdeflate:12') == ('libdeflate', 12)
+    assert parse_compression_profile('pigz:0') == ('pigz', 0)
+    for profile in ['zstd:3', 'gzip:0', 'bgzf:x', 'gzip:10']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_compression_profile(profile)
+
+
+def test_compression_env():
+    parser = argparse.ArgumentParser()
+    add_compression_arguments(parser)
+    assert get_compression_env(parser.parse_args([])) == {
+        'FASTQ_COMPRESSION': 'bgzf:9'}
+    args = parser.parse_args(['--fastq_compression', 'gzip:1'])
+    assert get_compression_env(args) == {'FASTQ_COMPRESSION': 'gzip:1'}
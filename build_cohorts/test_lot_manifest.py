@@ -0,0 +1,54 @@
+import gzip
+import subprocess
+
+from lot_manifest import (discard_unverified_lots, read_manifest,
+                          verify_manifest)
+from output_staging import stage_script
+
+
+def stage_lot(tmp_path):
+    source_dir = tmp_path / 'scratch' / 'SPN01_t00_FASTQ'
+    source_dir.mkdir(parents=True)
+    with gzip.open(source_dir / 't00_normal_sample.R1.fastq.gz', 'wt') as fastq:
+        fastq.write('@read1\nACGT\n+\nIIII\n' * 3)
+    (source_dir / 't00.bam').write_bytes(bytes(range(256)) * 10000)
+
+    script = tmp_path / 'ProCESS_stage.sh'
+    script.write_text(stage_script)
+    output_dir = tmp_path / 'purity_1'
+    done_file = output_dir / 't00_final.done'
+    output_dir.mkdir()
+    subprocess.run(['bash', str(script), str(tmp_path / 'tokens'), '0',
+                    str(source_dir), str(output_dir / 'FASTQ'),
+                    str(done_file)], check=True)
+    return output_dir, done_file
+
+
+def test_staged_manifests_are_verified(tmp_path):
+    output_dir, done_file = stage_lot(tmp_path)
+    manifest = {entry['file']: entry for entry in read_manifest(str(done_file))}
+    assert sorted(manifest) == ['FASTQ/t00.bam',
+                                'FASTQ/t00_normal_sample.R1.fastq.gz']
+    assert manifest['FASTQ/t00_normal_sample.R1.fastq.gz']['reads'] == '3'
+    assert manifest['FASTQ/t00.bam']['reads'] == 'NA'
+    assert manifest['FASTQ/t00.bam']['size'] == '2560000'
+    assert verify_manifest(str(done_file), full=True) == []
+
+    # a change in the middle of a file escapes the fast checksums only
+    with open(output_dir / 'FASTQ' / 't00.bam', 'r+b') as bam_file:
+        bam_file.seek(1280000)
+        bam_file.write(b'\xff')
+    assert verify_manifest(str(done_file)) == []
+    assert len(verify_manifest(str(done_file), full=True)) == 1
+
+    (output_dir / 'FASTQ' / 't00_normal_sample.R1.fastq.gz').unlink()
+    assert len(verify_manifest(str(done_file))) == 1
+    assert discard_unverified_lots(str(output_dir), 't') == ['t00']
+    assert not done_file.exists()
+
+
+def test_empty_done_files_have_no_manifest(tmp_path):
+    done_file = tmp_path / 't00_final.done'
+    done_file.write_text('')
+    assert read_manifest(str(done_file)) is None
+    assert verify_manifest(str(done_file)) == []
@@ -0,0 +1,40 @@
+from lot_packing import (get_pack_size, get_pack_request, pack_work_items,
+                         get_array_task_ids, get_pack_name)
+from lot_scheduler import LotGroup, LotWorkItem
+from resource_sizing import ResourceRequest
+
+
+def get_work_items(group, num_of_lots):
+    return [LotWorkItem(group, lot_id, group.get_lot_name(lot_id))
+            for lot_id in range(num_of_lots)]
+
+
+def test_get_pack_size():
+    lot_request = ResourceRequest(100, 8, 8*3600)
+
+    assert get_pack_size(lot_request, 4, None, 1000, 0.1) == 4
+    assert get_pack_size(lot_request, 4, 24*3600, 1000, 0.1) == 3
+    assert get_pack_size(lot_request, 4, 24*3600, 110, 0.1) == 2
+    assert get_pack_size(lot_request, 4, 3600, 1000, 0.1) == 1
+    assert get_pack_size(lot_request, 4, None, 50, 0) == 4
+
+
+def test_get_pack_request():
+    request = get_pack_request(ResourceRequest(100, 8, 3600), 3, 0.1)
+    assert (request.memory, request.cpus, request.time_limit) == (120, 8,
+                                                                   3*3600)
+
+
+def test_packs_and_array_tasks():
+    normal = LotGroup('normal', 1, 'normal', 'log', 'n', 5, 3)
+    tumour = LotGroup('tumour', 0.3, 'tumour', 'log', 't', 5, 5)
+    work_items = get_work_items(normal, 3) + get_work_items(tumour, 5)
+
+    packs = pack_work_items(work_items,
+                            lambda group: 2 if group is normal else 3)
+    assert [get_pack_name(pack) for pack in packs] == ['n0-n1', 'n2',
+                                                       't0-t2', 't3-t4']
+
+    assert get_array_task_ids('7', packs, normal) == ['7_0', '7_1']
+    assert get_array_task_ids('7', packs, tumour) == ['7_2', '7_3']
+    assert get_array_task_ids(None, list(), tumour) == []
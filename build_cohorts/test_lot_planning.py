@@ -0,0 +1,59 @@
+import pytest
+
+from lot_planning import LotPlanner, estimate_makespan, get_lot_step
+from resource_sizing import ResourceRequest
+
+
+def get_lot_request(seq_type, lot_coverage):
+    return ResourceRequest(100, 8, 8*3600)
+
+
+def get_lot_scratch(seq_type, lot_coverage):
+    return 5*lot_coverage
+
+
+def get_planner(num_of_nodes=8, seconds_per_x=1800, scratch_per_node=1000):
+    cohorts = {'tumour': {'max_coverage': 200, 'purities': [0.3, 0.6, 0.9]},
+               'normal': {'max_coverage': 30, 'purities': [1]}}
+    return LotPlanner(cohorts, [50, 100, 150, 200], num_of_nodes, 64, 512,
+                      scratch_per_node, 40,
+                      {'tumour': seconds_per_x, 'normal': seconds_per_x},
+                      600, max_lots=60)
+
+
+def test_get_lot_step():
+    assert get_lot_step(200, [50, 100, 150, 200]) == 4
+    assert get_lot_step(200, [75, 200]) == 8
+
+
+def test_estimate_makespan():
+    assert estimate_makespan([3, 3, 3, 3], 2) == 6
+    assert estimate_makespan([5, 1, 1], 2) == 5
+
+
+def test_plans_are_multiples_of_the_lot_step():
+    num_of_lots, makespan = get_planner().plan(get_lot_request,
+                                               get_lot_scratch)
+    assert num_of_lots['tumour'] % 4 == 0
+    assert makespan > 0
+
+
+def test_lots_exceeding_the_time_limit_are_rejected():
+    planner = get_planner(num_of_nodes=1, seconds_per_x=3600)
+    assert planner.estimate_makespan({'tumour': 16, 'normal': 6},
+                                     get_lot_request, get_lot_scratch) is None
+
+    num_of_lots, _ = planner.plan(get_lot_request, get_lot_scratch)
+    # 200x/28 lots take 7.3 hours, 200x/24 ones 8.5 hours
+    assert num_of_lots['tumour'] >= 28
+
+
+def test_lots_exceeding_the_node_scratch_are_rejected():
+    planner = get_planner(scratch_per_node=100)
+    assert planner.get_slots(get_lot_request(None, None), 101) == 0
+    num_of_lots, _ = planner.plan(get_lot_request, get_lot_scratch)
+    assert 200/num_of_lots['tumour']*5 <= 100
+
+    planner = get_planner(scratch_per_node=10)
+    with pytest.raises(RuntimeError):
+        planner.plan(get_lot_request, get_lot_scratch)
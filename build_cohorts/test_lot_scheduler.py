@@ -0,0 +1,71 @@
+import time
+
+from lot_scheduler import (LotGroup, LotScheduler, LotWorkItem,
+                           write_lot_table)
+
+
+class FakeTracker:
+    """Completes the oldest running lot at every wait."""
+
+    def __init__(self):
+        self.completed = dict()
+        self.running = list()
+
+    def get_completed(self, output_dir, lot_prefix, zeros=0):
+        return self.completed.get(output_dir, set())
+
+    def wait(self):
+        if len(self.running) != 0:
+            work_item = self.running.pop(0)
+            self.completed.setdefault(work_item.group.output_dir,
+                                      set()).add(work_item.lot_id)
+
+
+def test_lots_are_scheduled_from_a_single_queue():
+    tracker = FakeTracker()
+    groups = [LotGroup('tumour', purity, f'purity_{purity}', 'log', 't',
+                       5, 3) for purity in [0.3, 0.6]]
+    tracker.completed['purity_0.3'] = {1}
+    scheduler = LotScheduler(tracker, parallel_jobs=2)
+    for group in groups:
+        scheduler.add_group(group)
+
+    submissions = list()
+
+    def submit(work_items):
+        submissions.append([(work_item.group.purity, work_item.lot_name)
+                            for work_item in work_items])
+        tracker.running.extend(work_items)
+        assert len(tracker.running) <= 2
+
+    assert list(scheduler.run(submit)) == groups
+    assert submissions == [[(0.3, 't0'), (0.3, 't2')], [(0.6, 't0')],
+                           [(0.6, 't1')], [(0.6, 't2')]]
+
+
+def test_write_lot_table(tmp_path):
+    group = LotGroup('tumour', 0.3, 'purity_0.3', 'log', 't', 5, 12)
+    work_items = [LotWorkItem(group, lot_id, group.get_lot_name(lot_id))
+                  for lot_id in range(3)]
+    table_filename = tmp_path / 'lot_table.txt'
+    write_lot_table(str(table_filename), [work_items[:2], work_items[2:]],
+                    lambda group: 25)
+    assert table_filename.read_text().splitlines() == [
+        'purity_0.3 5 tumour 0.3 t00:t01 0:1 25',
+        'purity_0.3 5 tumour 0.3 t02 2 25']
+
+
+def test_failed_lots_are_retried_with_doubling_delays():
+    group = LotGroup('tumour', 0.3, 'purity_0.3', 'log', 't', 5, 40)
+    work_item = LotWorkItem(group, 0, 't00')
+    scheduler = LotScheduler(None, max_retries=3, retry_delay=10)
+
+    delays = list()
+    for _ in range(3):
+        now = time.time()
+        delays.append(scheduler._handle_failure(work_item, 'exit status 1')-now)
+    assert [round(delay) for delay in delays] == [10, 20, 40]
+    assert scheduler.failed == []
+
+    assert scheduler._handle_failure(work_item, 'TIMEOUT') is None
+    assert scheduler.failed == [work_item]
@@ -0,0 +1,89 @@
+import argparse
+
+import pytest
+
+from lot_packing import add_packing_arguments
+from lot_scheduler import LotGroup, LotWorkItem
+from lot_speculation import (LotSpeculator, add_speculation_arguments,
+                             check_speculation_arguments, move_lot_outputs)
+from lot_workers import add_worker_arguments
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.states = dict()
+        self.cancelled = list()
+
+    def get_states(self, job_ids):
+        return {job_id: (self.states[job_id], 'node1')
+                for job_id in job_ids if job_id in self.states}
+
+    def cancel(self, job_id):
+        self.cancelled.append(job_id)
+
+
+class FakeStore:
+    def get_lot(self, dest, lot):
+        return {'job_id': '1', 'state': 'RUNNING'}
+
+
+class FakeTracker:
+    def __init__(self):
+        self.completed = list()
+
+    def add_completed(self, dest, lot_name):
+        self.completed.append(lot_name)
+
+
+def test_move_lot_outputs_moves_the_done_files(tmp_path):
+    source_dir = tmp_path / 'copy'
+    (source_dir / 'FASTQ').mkdir(parents=True)
+    (source_dir / 'FASTQ' / 't00_R1.fastq.gz').write_text('reads')
+    (source_dir / 't00_final.done').write_text('')
+
+    move_lot_outputs(source_dir, tmp_path / 'dest')
+    assert (tmp_path / 'dest' / 'FASTQ' / 't00_R1.fastq.gz').exists()
+    assert (tmp_path / 'dest' / 't00_final.done').exists()
+
+
+def test_copy_outputs_wait_for_the_cancelled_original(tmp_path):
+    executor = FakeExecutor()
+    tracker = FakeTracker()
+    speculator = LotSpeculator(executor, FakeStore(), tracker, None,
+                               check_interval=0)
+    group = LotGroup('tumour', 0.3, str(tmp_path / 'dest'), str(tmp_path),
+                     't', 5, 40)
+    work_item = LotWorkItem(group, 0, 't00')
+    copy_dir = tmp_path / 'copy'
+    copy_dir.mkdir()
+    (copy_dir / 't00_final.done').write_text('')
+    speculator.copies[work_item] = {'job_id': '2', 'dir': str(copy_dir),
+                                    'cancelled': None}
+    executor.states['2'] = 'COMPLETED'
+
+    assert speculator.update([work_item]) == []
+    assert executor.cancelled == ['1']
+
+    executor.states['1'] = 'RUNNING'
+    assert speculator.update([work_item]) == []
+    assert not (tmp_path / 'dest' / 't00_final.done').exists()
+
+    executor.states['1'] = 'CANCELLED'
+    assert speculator.update([work_item]) == [work_item]
+    assert (tmp_path / 'dest' / 't00_final.done').exists()
+    assert tracker.completed == ['t00']
+    assert speculator.num_of_copies() == 0
+
+
+@pytest.mark.parametrize('argv', [['--pack_lots', '2'], ['--workers', '4']])
+def test_speculation_rejects_shared_original_jobs(argv):
+    parser = argparse.ArgumentParser()
+    add_speculation_arguments(parser)
+    add_packing_arguments(parser)
+    add_worker_arguments(parser)
+
+    check_speculation_arguments(parser, parser.parse_args(argv))
+    check_speculation_arguments(parser, parser.parse_args(['--speculation']))
+    with pytest.raises(SystemExit):
+        check_speculation_arguments(parser,
+                                    parser.parse_args(['--speculation'] + argv))
@@ -0,0 +1,94 @@
+import os
+import time
+import socket
+import threading
+
+import pytest
+
+from lot_scheduler import LotGroup, LotScheduler, LotWorkItem
+from lot_tracking import (CompletionListener, LotCompletionTracker,
+                          LotFailureMonitor, scratch_deferral)
+from state_store import JobStateStore
+
+
+def get_completed_jobs(done_file_dir, lot_prefix):
+    return [int(filename[len(lot_prefix):-len('_final.done')])
+            for filename in os.listdir(done_file_dir)
+            if filename.startswith(lot_prefix)
+            and filename.endswith('_final.done')]
+
+
+def notify(address, line):
+    port = int(address.rsplit(':', 1)[1])
+    with socket.create_connection(('localhost', port), timeout=10) as connection:
+        connection.sendall(line.encode())
+
+
+def test_notifications_wake_the_tracker(tmp_path):
+    listener = CompletionListener('localhost')
+    tracker = LotCompletionTracker(get_completed_jobs, listener,
+                                   poll_interval=60)
+    assert tracker.get_completed(str(tmp_path), 't') == []
+
+    (tmp_path / 't3_final.done').write_text('')
+    line = 'dest={} lot=t3 status=0 node=node1\n'.format(tmp_path)
+    threading.Timer(0.2, notify, (listener.address, line)).start()
+
+    start = time.time()
+    tracker.wait()
+    assert time.time()-start < 10
+    # the notification is enough: no glob before the poll interval
+    assert tracker.get_completed(str(tmp_path), 't') == [3]
+    listener.close()
+
+
+def test_tracker_polls_when_the_notifications_are_lost(tmp_path):
+    listener = CompletionListener('localhost')
+    tracker = LotCompletionTracker(get_completed_jobs, listener,
+                                   poll_interval=0.2)
+    assert tracker.get_completed(str(tmp_path), 't') == []
+
+    # the lot cannot reach the listener
+    with socket.socket() as unused:
+        unused.bind(('localhost', 0))
+        unused_address = 'localhost:{}'.format(unused.getsockname()[1])
+    with pytest.raises(OSError):
+        notify(unused_address, 'dest={} lot=t3 status=0\n'.format(tmp_path))
+    (tmp_path / 't3_final.done').write_text('')
+
+    tracker.wait()
+    assert tracker.get_completed(str(tmp_path), 't') == [3]
+    listener.close()
+
+
+class NoStatesExecutor:
+    def get_states(self, job_ids):
+        return dict()
+
+
+def end_lot(store, dest, lot, status):
+    store.record_notification({'dest': dest, 'lot': lot, 'node': 'node1',
+                               'event': 'end', 'status': str(status)})
+
+
+def test_deferred_lots_are_not_failures(tmp_path):
+    store = JobStateStore(tmp_path)
+    group = LotGroup('tumour', 0.3, str(tmp_path), str(tmp_path), 't', 5, 40)
+    deferred = LotWorkItem(group, 0, 't00')
+    failed = LotWorkItem(group, 1, 't01')
+    for work_item, status in [(deferred, 75), (failed, 1)]:
+        store.mark_submitted(group.output_dir, work_item.lot_name, '1')
+        end_lot(store, group.output_dir, work_item.lot_name, status)
+
+    monitor = LotFailureMonitor(NoStatesExecutor(), store, node_failure_limit=1)
+    reasons = dict(monitor.get_failed([deferred, failed]))
+    assert reasons == {deferred: scratch_deferral, failed: 'exit status 1'}
+    # only the real failure counts against the node
+    assert list(monitor.node_failures) == ['node1']
+    assert len(monitor.node_failures['node1']) == 1
+
+    scheduler = LotScheduler(None, max_retries=0, retry_delay=0)
+    assert scheduler._handle_failure(deferred, scratch_deferral) is not None
+    assert scheduler.failures == dict()
+    assert scheduler._handle_failure(failed, 'exit status 1') is None
+    assert scheduler.failed == [failed]
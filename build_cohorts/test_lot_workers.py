@@ -0,0 +1,71 @@
+import os
+
+from lot_workers import LotWorkerPool
+from state_store import JobStateStore
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.states = dict()
+
+    def get_states(self, job_ids):
+        return {job_id: (self.states[job_id], 'node1')
+                for job_id in job_ids if job_id in self.states}
+
+
+def get_pool(tmp_path, executor, store):
+    job_ids = iter(str(job_id) for job_id in range(1, 100))
+    return LotWorkerPool(executor, str(tmp_path / 'workers'), 1,
+                         lambda worker_dir: next(job_ids), check_interval=0,
+                         store=store)
+
+
+def get_lot_args(dest, lot_name):
+    return ['forest.sff', 'SPN01', lot_name, '/scratch', dest, 5, 'tumour',
+            4, 0, 0.3]
+
+
+def submit(pool, store, dest, lot_name):
+    job_id = pool.submit(get_lot_args(dest, lot_name), 75)
+    store.mark_submitted(dest, lot_name, job_id)
+    return job_id
+
+
+def test_requests_hold_the_lot_scratch(tmp_path):
+    pool = get_pool(tmp_path, FakeExecutor(), None)
+    pool.submit(get_lot_args('dest', 't00'), 75)
+    request = os.path.join(pool.workers[0]['dir'], '00000000.request')
+    with open(request, 'r') as instream:
+        assert instream.read().split()[2:] == ['t00', '/scratch', 'dest',
+                                               '5', 'tumour', '4', '0',
+                                               '0.3', '75']
+
+
+def test_idle_workers_leave_their_requests_to_the_replacement(tmp_path):
+    executor = FakeExecutor()
+    store = JobStateStore(tmp_path)
+    pool = get_pool(tmp_path, executor, store)
+    dest = str(tmp_path)
+    assert submit(pool, store, dest, 't00') == '1'
+    assert submit(pool, store, dest, 't01') == '1'
+    store.mark_failed(dest, 't01')
+
+    executor.states['1'] = 'COMPLETED'
+    assert submit(pool, store, dest, 't02') == '2'
+    assert store.get_lot(dest, 't00')['job_id'] == '2'
+    # the failed lot is resubmitted by the builder
+    assert store.get_lot(dest, 't01')['state'] == 'FAILED'
+    assert len(pool._get_requests(pool.workers[0])) == 2
+
+
+def test_failed_workers_drop_their_requests(tmp_path):
+    executor = FakeExecutor()
+    store = JobStateStore(tmp_path)
+    pool = get_pool(tmp_path, executor, store)
+    dest = str(tmp_path)
+    submit(pool, store, dest, 't00')
+
+    executor.states['1'] = 'NODE_FAIL'
+    assert submit(pool, store, dest, 't01') == '2'
+    assert store.get_lot(dest, 't00')['job_id'] == '1'
+    assert len(pool._get_requests(pool.workers[0])) == 1
@@ -0,0 +1,64 @@
+import os
+import shutil
+import subprocess
+
+from output_staging import stage_script
+
+
+def write_command(bin_dir, name, body):
+    command = bin_dir / name
+    command.write_text('#!/bin/bash\n' + body)
+    command.chmod(0o755)
+
+
+def stage_lot(tmp_path, slots, failing_copy=None):
+    source_dir = tmp_path / 'scratch' / 'SPN01_t00_FASTQ'
+    source_dir.mkdir(parents=True)
+    for suffix in ['R1', 'R2', 'unpaired']:
+        (source_dir / 't00_normal_sample.{}.fastq'.format(suffix)).write_text(
+            '@read1\nACGT\n+\nIIII\n')
+
+    # every move into the output directory records whether the done file
+    # already exists
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    write_command(bin_dir, 'mv',
+                  'if [ -e "${DONE_FILE}" ]; then echo "$2" >> ${MOVE_LOG}; fi\n'
+                  + 'exec {} "$@"\n'.format(shutil.which('mv')))
+    if failing_copy is not None:
+        write_command(bin_dir, 'cp',
+                      'if [ "$(basename $1)" == "{}" ]; then exit 1; fi\n'.format(failing_copy)
+                      + 'exec {} "$@"\n'.format(shutil.which('cp')))
+
+    script = tmp_path / 'ProCESS_stage.sh'
+    script.write_text(stage_script)
+    output_dir = tmp_path / 'purity_1'
+    output_dir.mkdir()
+    done_file = output_dir / 't00_final.done'
+    move_log = tmp_path / 'late_moves.log'
+    env = dict(os.environ, DONE_FILE=str(done_file), MOVE_LOG=str(move_log),
+               PATH='{}:{}'.format(bin_dir, os.environ.get('PATH', '')))
+    process = subprocess.run(['bash', str(script), str(tmp_path / 'tokens'),
+                              str(slots), str(source_dir),
+                              str(output_dir / 'FASTQ'), str(done_file)],
+                             env=env, stderr=subprocess.PIPE)
+    return process.returncode, output_dir, done_file, move_log
+
+
+def test_done_file_follows_the_staged_files(tmp_path):
+    status, output_dir, done_file, move_log = stage_lot(tmp_path, 2)
+    assert status == 0
+    assert sorted(os.listdir(str(output_dir / 'FASTQ'))) == [
+        't00_normal_sample.R1.fastq', 't00_normal_sample.R2.fastq',
+        't00_normal_sample.unpaired.fastq']
+    assert done_file.exists()
+    assert not move_log.exists()
+    assert not (tmp_path / 'scratch' / 'SPN01_t00_FASTQ').exists()
+
+
+def test_failed_copies_leave_no_done_file(tmp_path):
+    status, output_dir, done_file, _ = stage_lot(
+        tmp_path, 0, failing_copy='t00_normal_sample.R2.fastq')
+    assert status != 0
+    assert not done_file.exists()
+    assert not (output_dir / 'FASTQ' / 't00_normal_sample.R2.fastq').exists()
@@ -0,0 +1,32 @@
+import os
+import subprocess
+
+from reference_cache import reference_cache_script
+
+
+def run_cache(tmp_path, *args):
+    script = tmp_path / 'ProCESS_reference_cache.sh'
+    script.write_text(reference_cache_script)
+    result = subprocess.run(['bash', str(script), args[0],
+                             str(tmp_path / 'cache')]
+                            + [str(arg) for arg in args[1:]],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            check=True)
+    return result.stdout.decode().strip()
+
+
+def test_the_lots_share_the_cached_reference(tmp_path):
+    reference = tmp_path / 'reference.fasta'
+    reference.write_text('>chr1\nACGT\n')
+    pid = os.getpid()
+
+    cached = run_cache(tmp_path, 'acquire', reference, pid, 0)
+    with open(cached, 'r') as instream:
+        assert instream.read() == '>chr1\nACGT\n'
+    assert os.stat(cached).st_mode & 0o222 == 0
+    assert run_cache(tmp_path, 'acquire', reference, pid+1, 0) == cached
+
+    users = os.path.join(os.path.dirname(cached), 'users')
+    assert sorted(os.listdir(users)) == sorted([str(pid), str(pid+1)])
+    run_cache(tmp_path, 'release', cached, pid+1)
+    assert os.listdir(users) == [str(pid)]
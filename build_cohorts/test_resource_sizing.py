@@ -0,0 +1,63 @@
+import json
+
+from resource_sizing import (ResourceRequest, ResourceSizer, parse_elapsed,
+                             usage_dir_name, lot_plan_filename)
+
+time_report = """\tCommand being timed: "Rscript ProCESS_seq.R"
+\tPercent of CPU this job got: 150%
+\tElapsed (wall clock) time (h:mm:ss or m:ss): {elapsed}
+\tMaximum resident set size (kbytes): {max_rss}
+\tExit status: 0
+"""
+
+
+def write_cohort(cohort_dir, lot_coverage, elapsed, max_rss_GB, num_of_lots=3):
+    usage_dir = cohort_dir / 'tumour' / 'purity_0.3' / usage_dir_name
+    usage_dir.mkdir(parents=True)
+    for lot in range(num_of_lots):
+        report = time_report.format(elapsed=elapsed,
+                                    max_rss=max_rss_GB*1024**2)
+        (usage_dir / f'lot.tumour.t{lot}.time').write_text(report)
+    plan = {'num_of_lots': {'tumour': 200/lot_coverage},
+            'lot_coverages': {'tumour': lot_coverage}}
+    (cohort_dir / lot_plan_filename).write_text(json.dumps(plan))
+
+
+def test_parse_elapsed():
+    assert parse_elapsed('1:02:03') == 3723
+    assert parse_elapsed('2:30.5') == 150.5
+
+
+def test_get_request_scales_the_peaks_by_lot_coverage(tmp_path):
+    write_cohort(tmp_path, 5, '1:00:00', 10)
+    sizer = ResourceSizer([tmp_path], margin=0)
+    sizer.refresh()
+    default = ResourceRequest(100, 5, 24*3600)
+
+    request = sizer.get_request('lot', 'tumour', default, lot_coverage=10)
+    assert request.time_limit == 2*3600
+    assert request.memory == 2*10*2
+
+    # the memory peaks are never scaled down
+    request = sizer.get_request('lot', 'tumour', default, lot_coverage=2.5)
+    assert request.time_limit == 1800
+    assert request.memory == 10*2
+
+
+def test_get_request_keeps_the_script_cores(tmp_path):
+    write_cohort(tmp_path, 5, '1:00:00', 10)
+    sizer = ResourceSizer([tmp_path], margin=0)
+    sizer.refresh()
+    default = ResourceRequest(100, 5, 24*3600)
+
+    assert sizer.get_request('lot', 'tumour', default).cpus == 2
+    assert sizer.get_request('lot', 'tumour', default, min_cpus=5).cpus == 5
+
+
+def test_get_request_needs_enough_samples(tmp_path):
+    write_cohort(tmp_path, 5, '1:00:00', 10, num_of_lots=2)
+    sizer = ResourceSizer([tmp_path])
+    sizer.refresh()
+    default = ResourceRequest(100, 5, 24*3600)
+
+    assert sizer.get_request('lot', 'tumour', default) is default
@@ -0,0 +1,46 @@
+import os
+import subprocess
+
+from scratch_ledger import estimate_lot_scratch, scratch_ledger_script
+
+
+def run_ledger(tmp_path, *args):
+    script = tmp_path / 'ProCESS_scratch_ledger.sh'
+    script.write_text(scratch_ledger_script)
+    node_scratch = tmp_path / 'scratch'
+    return subprocess.run(['bash', str(script), args[0], str(node_scratch)]
+                          + [str(arg) for arg in args[1:]],
+                          stderr=subprocess.DEVNULL).returncode
+
+
+def get_dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def test_estimate_lot_scratch():
+    assert estimate_lot_scratch(5, 3, 5) == 75
+    assert estimate_lot_scratch(0.01, 1, 5) == 1
+
+
+def test_reserve_fails_at_once_when_the_scratch_is_full(tmp_path):
+    pid = os.getpid()
+    assert run_ledger(tmp_path, 'reserve', 100, pid, 60, 'SPN01_t0') == 0
+    assert run_ledger(tmp_path, 'reserve', 100, pid, 60, 'SPN01_t1') == 1
+    assert run_ledger(tmp_path, 'reserve', 100, pid, 40, 'SPN01_t2') == 0
+
+    run_ledger(tmp_path, 'release', pid, 'SPN01_t0')
+    assert run_ledger(tmp_path, 'reserve', 100, pid, 60, 'SPN01_t1') == 0
+
+
+def test_reserve_drops_the_reservations_of_dead_lots(tmp_path):
+    assert run_ledger(tmp_path, 'reserve', 100, get_dead_pid(), 90,
+                      'SPN01_t0') == 0
+    assert run_ledger(tmp_path, 'reserve', 100, os.getpid(), 90,
+                      'SPN01_t1') == 0
+
+
+def test_reserve_admits_a_lot_larger_than_an_empty_node(tmp_path):
+    assert run_ledger(tmp_path, 'reserve', 100, os.getpid(), 150,
+                      'SPN01_t0') == 0
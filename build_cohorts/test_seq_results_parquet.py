@@ -0,0 +1,21 @@
+import os
+
+from seq_results_parquet import find_unconverted_seq_results, get_parquet_dir
+
+
+def test_find_unconverted_seq_results(tmp_path):
+    data_dir = tmp_path / 'tumour' / 'purity_0.3' / 'data'
+    (data_dir / 'mutations').mkdir(parents=True)
+    lot_file = data_dir / 'seq_results_SPN01_t00.rds'
+    merged_file = data_dir / 'mutations' / 'seq_results_muts_merged_50x.rds'
+    stale_file = data_dir / 'seq_results_SPN01_t01.rds'
+    for rds_file in [lot_file, merged_file, stale_file]:
+        rds_file.write_text('')
+        os.utime(rds_file, (100, 100))
+    os.mkdir(get_parquet_dir(str(lot_file)))
+    os.mkdir(get_parquet_dir(str(stale_file)))
+    os.utime(get_parquet_dir(str(stale_file)), (50, 50))
+
+    assert find_unconverted_seq_results(str(tmp_path)) == sorted(
+        [str(merged_file), str(stale_file)])
+    assert len(find_unconverted_seq_results(str(tmp_path), force=True)) == 3
@@ -0,0 +1,53 @@
+import io
+
+from state_store import JobStateStore, write_status
+
+
+def notify(store, dest, lot, **fields):
+    store.record_notification(dict({'dest': dest, 'lot': lot,
+                                     'node': 'node1'},
+                                    **{key: str(value)
+                                       for key, value in fields.items()}))
+
+
+def test_lot_life_cycle(tmp_path):
+    store = JobStateStore(tmp_path)
+    dest = str(tmp_path / 'tumour' / 'purity_0.3')
+    store.mark_submitted(dest, 't00', '12')
+    notify(store, dest, 't00', event='start', start=100)
+    lot = store.get_lot(dest, 't00')
+    assert (lot['state'], lot['job_id'], lot['node']) == ('RUNNING', '12',
+                                                          'node1')
+
+    notify(store, dest, 't00', event='end', status=0, start=100, end=160,
+           size=2000)
+    assert store.get_completed(dest, 't') == [0]
+    assert store.get_durations(dest, 't') == [60]
+    assert store.get_lot(dest + '/', 't00')['output_size'] == 2000
+
+    # a resubmission forgets the previous run
+    store.mark_submitted(dest, 't00', '13')
+    lot = store.get_lot(dest, 't00')
+    assert (lot['state'], lot['node'], lot['end_time']) == ('SUBMITTED',
+                                                            None, None)
+
+
+def test_failures_and_reconciliation(tmp_path):
+    store = JobStateStore(tmp_path)
+    dest = str(tmp_path)
+    for lot in ['t00', 't01']:
+        store.mark_submitted(dest, lot, '12')
+        notify(store, dest, lot, event='end', status=1)
+    assert store.get_lots(dest, 't', 'FAILED') == ['t00', 't01']
+
+    (tmp_path / 't01_final.done').write_text('')
+    store.reconcile()
+    assert store.get_lots(dest, 't', 'COMPLETED') == ['t01']
+
+    outstream = io.StringIO()
+    write_status(store, outstream)
+    assert outstream.getvalue().splitlines()[1].split()[1:5] == ['0', '0',
+                                                                '1', '1']
+
+    store.reset(dest, 't')
+    assert not store.has_lots(dest)
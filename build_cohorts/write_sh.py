@@ -8,6 +8,8 @@ import time
 import subprocess
 import argparse
 
+from executors import add_executor_arguments, create_executor
+
 
 ## This part is currently run sequentially
 
@@ -278,7 +280,8 @@ if (__name__ == '__main__'):
                        help="Path to sarek launching dir")
     parser.add_argument('-TD', '--tumourevo_output_dir', type=str, default="",
                        help="Path to tumourevo result path")
-    
+    add_executor_arguments(parser)
+
     cohorts = { 'normal': {
                     'max_coverage': 30,
                     'purities': list([1])
@@ -302,6 +305,8 @@ if (__name__ == '__main__'):
     else:
         account = args.account
 
+    executor = create_executor(args, account)
+
     gender_filename = os.path.join(os.path.dirname(args.phylogenetic_forest),
                                    "subject_gender.txt")
 
@@ -320,13 +325,10 @@ if (__name__ == '__main__'):
         with open('ProCESS_tumour_type.sh', 'w') as outstream:
             outstream.write(write_tumour_type_file)
 
-        cmd = ['sbatch', '--account={}'.format(account),
-            '--partition={}'.format(args.partition),
-            ('--export=DIR={},SPN={},BASEDIR={}').format(curr_dir,args.SPN,
-                                                os.path.dirname(args.phylogenetic_forest)),
-            './ProCESS_tumour_type.sh']
-
-        subprocess.run(cmd)
+        job_id = executor.submit('./ProCESS_tumour_type.sh',
+                                 env={'DIR': curr_dir, 'SPN': args.SPN,
+                                      'BASEDIR': os.path.dirname(args.phylogenetic_forest)})
+        executor.wait(job_id)
 
     with open(tumour_type_file) as cancer_type_file:
         cancer_type = cancer_type_file.read().strip()
@@ -448,3 +450,5 @@ if (__name__ == '__main__'):
                         with open(f'{tumourevo_dir}/tumourevo_{cohort_cov}x_{purity}p_{vc}_{cc}.sh', 'w') as outstream:
                             outstream.write(tumourevo_launcher)
                         tumourevo_launcher = tumourevo_launcher_orig
+
+    executor.shutdown()
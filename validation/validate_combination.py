@@ -10,6 +10,11 @@ import subprocess
 import argparse
 import fnmatch
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'build_cohorts'))
+
+from executors import add_executor_arguments, create_executor
+
 somatic_processing_shell_script="""#!/bin/bash
 #SBATCH --nodes=1
 #SBATCH --ntasks-per-node=1
@@ -101,6 +106,7 @@ if (__name__ == '__main__'):
                         help="The cluster account")
     parser.add_argument('-S', '--skip', type=str, required=False,
                         help="Which step to skip, select among: cna, somatic, germline, none")
+    add_executor_arguments(parser)
 
     
 
@@ -112,6 +118,8 @@ if (__name__ == '__main__'):
         account = process.communicate()
     else:
         account = args.account
+
+    executor = create_executor(args, account)
    
     scout_dir = "/orfeo/cephfs/scratch/cdslab/shared/SCOUT"
     with open(os.path.join(scout_dir, args.SPN, "process", "subject_gender.txt")) as gender_file:
@@ -140,33 +148,24 @@ if (__name__ == '__main__'):
 
         for chr in chromosomes:
 
-            cmd = ['sbatch','--parsable',
-                '--account={}'.format(account),
-                '--partition={}'.format(args.partition),
-                '--job-name=parsing_{}_{}_{}_{}'.format(args.SPN, args.coverage,args.purity,chr),
-                ('--export=SPN={},COVERAGE={},PURITY={},CHROMOSOME={},DIRECTORY={}').format(args.SPN,
-                                                    args.coverage, args.purity,chr,args.directory),
-                '--output={}/parsing_chr{}.log'.format(log_dir, chr),
-                './run_processing.sh'] 
-
-            result = subprocess.run(cmd, stdout=subprocess.PIPE)
-            job_id = result.stdout.decode().strip()
+            job_id = executor.submit('./run_processing.sh',
+                job_name='parsing_{}_{}_{}_{}'.format(args.SPN, args.coverage,args.purity,chr),
+                env={'SPN': args.SPN, 'COVERAGE': args.coverage,
+                     'PURITY': args.purity, 'CHROMOSOME': chr,
+                     'DIRECTORY': args.directory},
+                output='{}/parsing_chr{}.log'.format(log_dir, chr))
             chr_job_ids.append(job_id)
         
         # Run final somatic report
 
         with open('run_reports.sh', 'w') as outstream:
             outstream.write(somatic_prepare_report_shell_script)
-        dependency_str = ':'.join(chr_job_ids)
-        cmd = ['sbatch', '--account={}'.format(account),
-            '--partition={}'.format(args.partition),
-            '--job-name=somatic_report_{}_{}_{}'.format(args.SPN, args.coverage,args.purity),
-            '--dependency=afterok:{}'.format(dependency_str),
-            ('--export=SPN={},COVERAGE={},PURITY={},DIRECTORY={}').format(args.SPN,
-                                                args.coverage, args.purity,args.directory),
-            '--output={}/somatic_report_{}_{}_{}.log'.format(log_dir, args.SPN,args.coverage,args.purity),
-            './run_reports.sh']
-        subprocess.run(cmd)
+        executor.submit('./run_reports.sh',
+            job_name='somatic_report_{}_{}_{}'.format(args.SPN, args.coverage,args.purity),
+            dependencies=chr_job_ids,
+            env={'SPN': args.SPN, 'COVERAGE': args.coverage,
+                 'PURITY': args.purity, 'DIRECTORY': args.directory},
+            output='{}/somatic_report_{}_{}_{}.log'.format(log_dir, args.SPN,args.coverage,args.purity))
     
     if "cna" not in args.skip.split(","):
 
@@ -182,14 +181,12 @@ if (__name__ == '__main__'):
             outstream.write(cna_report_shell_script)
         
         for sample in sample_ids:
-            cmd = ['sbatch', '--account={}'.format(account),
-                '--partition={}'.format(args.partition),
-                '--job-name=cna_report_{}_{}_{}'.format(sample, args.coverage,args.purity),
-                ('--export=SPN={},SAMPLE={},COVERAGE={},PURITY={},DIRECTORY={}').format(args.SPN,sample,
-                                                    args.coverage, args.purity,args.directory),
-                '--output={}/cna_report_{}_{}_{}.log'.format(log_dir, sample,args.coverage,args.purity),
-                './validate_cna.sh']
-            subprocess.run(cmd)
+            executor.submit('./validate_cna.sh',
+                job_name='cna_report_{}_{}_{}'.format(sample, args.coverage,args.purity),
+                env={'SPN': args.SPN, 'SAMPLE': sample,
+                     'COVERAGE': args.coverage, 'PURITY': args.purity,
+                     'DIRECTORY': args.directory},
+                output='{}/cna_report_{}_{}_{}.log'.format(log_dir, sample,args.coverage,args.purity))
 
     if "germline" not in args.skip.split(","):
 
@@ -203,29 +200,24 @@ if (__name__ == '__main__'):
             chr_job_ids_germline = []
             
             for chr in chromosomes:
-                cmd_germline = ['sbatch', '--parsable','--account={}'.format(account),
-                    '--partition={}'.format(args.partition),
-                    '--job-name=split_chr_{}_{}_{}_{}'.format(args.SPN, args.coverage,args.purity,chr),
-                    ('--export=SPN={},COVERAGE={},PURITY={},CHROMOSOME={},DIRECTORY={}').format(args.SPN,
-                                                        args.coverage, args.purity,chr,args.directory),
-                    '--output={}/split_chr{}.log'.format(log_dir, chr),
-                    './run_processing_germline.sh'] 
-                result_germline = subprocess.run(cmd_germline, stdout=subprocess.PIPE)
-                job_id_germline = result_germline.stdout.decode().strip()
+                job_id_germline = executor.submit('./run_processing_germline.sh',
+                    job_name='split_chr_{}_{}_{}_{}'.format(args.SPN, args.coverage,args.purity,chr),
+                    env={'SPN': args.SPN, 'COVERAGE': args.coverage,
+                         'PURITY': args.purity, 'CHROMOSOME': chr,
+                         'DIRECTORY': args.directory},
+                    output='{}/split_chr{}.log'.format(log_dir, chr))
                 chr_job_ids_germline.append(job_id_germline)
                 
             ## Run germline report
             with open('run_reports_germline.sh', 'w') as outstream:
                 outstream.write(germline_report_shell_script)
-            dependency_str_germline = ':'.join(chr_job_ids_germline)
-            cmd = ['sbatch', '--account={}'.format(account),
-                '--partition={}'.format(args.partition),
-                '--job-name=germline_report_{}'.format(args.SPN),
-                '--dependency=afterok:{}'.format(dependency_str_germline),
-                ('--export=SPN={},DIRECTORY={}').format(args.SPN,args.directory),
-                '--output={}/germline_report_{}.log'.format(log_dir, args.SPN),
-                './run_reports_germline.sh']
-            subprocess.run(cmd)
+            executor.submit('./run_reports_germline.sh',
+                job_name='germline_report_{}'.format(args.SPN),
+                dependencies=chr_job_ids_germline,
+                env={'SPN': args.SPN, 'DIRECTORY': args.directory},
+                output='{}/germline_report_{}.log'.format(log_dir, args.SPN))
         
         else:
             print('Germline validation already exist!')
+
+    executor.shutdown()